@@ -1,15 +1,14 @@
+import time
+_script_started = time.perf_counter()  # Startup report: first render time of this process
 import streamlit as st
 import pandas as pd
-import os
-from dotenv import load_dotenv
-from PIL import Image
 import base64
-import io
-from llama_index.core.llms import ChatMessage, MessageRole
-from llama_index.core.schema import NodeRelationship
+import json
+from llama_index.core.llms import ChatMessage
 import re
-import tempfile
 from vector_search import *
+from tracing import STARTUP_REPORT
+startup_timer.record('import app', time.perf_counter() - _script_started)
 
 # ==========================================================
 # Section: Page Config
@@ -109,12 +108,11 @@ st.markdown("""
             """, unsafe_allow_html=True)
 
 # Title
+@st.cache_resource
 def image_to_base64(img_path):
-    img = Image.open(img_path)
-    img_data = io.BytesIO()
-    img.save(img_data, format='PNG')
-    img_base64 = base64.b64encode(img_data.getvalue()).decode('utf-8')
-    return img_base64
+    # Encoded once per process, the PNG file is embedded as is
+    with open(img_path, 'rb') as f:
+        return base64.b64encode(f.read()).decode('utf-8')
 custom_title = """
                 <style>
                     .custom-title {{
@@ -147,84 +145,108 @@ st.html("<style>[data-testid='stHeaderActionElements'] {display: none;}</style>"
 # ==========================================================
 # Section: Streamlit UI and Logic
 # ==========================================================
-def is_valid_url(url):
+@st.cache_resource
+def get_url_regex():
     """
-    Function to validate whether the string is a valid URL
+    Compiled URL pattern, shared by all sessions and reruns
     """
-    regex = re.compile(
+    return re.compile(
         r'^(https?://)'  # http:// or https://
         r'(([a-zA-Z0-9_-]+\.)+[a-zA-Z]{2,})'  # domain
         r'(/[a-zA-Z0-9@:%._\+~#=/-]*)*'  # path
         r'(\?[a-zA-Z0-9&=_%-]*)?'  # query string
         r'(#.*)?$'  # fragment locator
     )
-    return re.match(regex, url) is not None
+
+def is_valid_url(url):
+    """
+    Function to validate whether the string is a valid URL
+    """
+    return get_url_regex().match(url) is not None
 
 def get_all_sources_from_index(index):
     """
     Get unified list of all sources (websites and documents) from index
-    Returns list of dicts with 'Type' and 'Source' keys
+    Returns list of dicts with 'Type', 'Source' and 'Chunks' keys
     """
-    sources = []
-    for node_id in index.docstore.docs.keys():
-        node = index.docstore.get_node(node_id)
-        
-        # Check for document first
-        if 'file_name' in node.metadata:
-            sources.append({
-                'Type': 'Document',
-                'Source': node.metadata['file_name']
-            })
-        # Then check for website URL
-        else:
-            source_relation = node.relationships.get(NodeRelationship.SOURCE)
-            if source_relation and source_relation.node_id:
-                sources.append({
-                    'Type': 'Website',
-                    'Source': source_relation.node_id
-                })
-    
-    # Remove duplicates while preserving order
-    seen = set()
-    return [x for x in sources if not (x['Source'] in seen or seen.add(x['Source']))]
-
-def get_urls_from_index(index):
+    return [
+        {'Type': entry['type'], 'Source': entry['source'], 'Chunks': entry['chunk_count']}
+        for entry in get_source_registry(index).sources()
+    ]
+
+def get_active_indexes():
+    """
+    Get the indexes searched for the selected knowledge base and the index new sources are added to
+    The default knowledge base is the shared base index plus this session's own index (not persisted)
+    """
+    if st.session_state.knowledge_base == DEFAULT_KNOWLEDGE_BASE:
+        return [base_index, st.session_state.index], st.session_state.index
+    index = knowledge_bases.open(st.session_state.knowledge_base)
+    return [index], index
+
+def source_exists(source):
+    """
+    Check whether a source (website URL or document filename) is already in the selected knowledge base,
+    or is being added by a running ingest job
+    """
+    return (
+        any(source in get_source_registry(index) for index in get_active_indexes()[0])
+        or any(source in job.sources for job in st.session_state.ingest_jobs if not job.done)
+    )
+
+def start_ingest_job(urls=None, files=None):
+    """
+    Start adding websites or files to the selected knowledge base in the background, so the chat stays usable meanwhile
+    """
+    job = IngestJob(get_active_indexes()[1], urls=urls, files=files).start()
+    st.session_state.ingest_jobs.append(job)
+    return job
+
+def add_notice(level, message):
     """
-    Get unique website URLs from index (ONLY web sources)
+    Queue a knowledge base message ('success', 'warning' or 'error'), kept on screen until ingest jobs have finished
     """
-    urls = set()
-    for node_id in index.docstore.docs.keys():
-        node = index.docstore.get_node(node_id)
-        
-        # Only consider nodes that DON'T have document metadata
-        if 'file_name' not in node.metadata:
-            source_relation = node.relationships.get(NodeRelationship.SOURCE)
-            if source_relation and source_relation.node_id:
-                urls.add(source_relation.node_id)
-    return sorted(urls)
-
-def get_file_names_from_index(index):
+    st.session_state.ingest_notices.append((level, message))
+
+def report_finished_job(job):
     """
-    Get unique document filenames from index (ONLY document sources)
+    Queue the outcome of a finished ingest job
     """
-    file_names = set()
-    for node_id in index.docstore.docs.keys():
-        node = index.docstore.get_node(node_id)
-        # Only consider nodes with document metadata
-        if 'file_name' in node.metadata:
-            file_names.add(node.metadata['file_name'])
-    return sorted(file_names)
-
-# Initialize default URLs to be added to vector store
+    label = "website(s)" if job.source_type == 'Website' else "file(s)"
+    if job.status == 'error':
+        add_notice('error', f"Error adding {label}.")
+        return
+    # Sources whose every page was already in the knowledge base added nothing
+    duplicates = job.dedup_stats['sources']
+    added = job.total - len(job.failed) - len(duplicates)
+    if added > 0:
+        shared = f" ({job.dedup_stats['chunks']} repeated chunk(s) reused existing vectors)" if job.dedup_stats['chunks'] else ""
+        add_notice('success', f"Added {added} {label} to the knowledge base{shared}.")
+    if duplicates:
+        add_notice('warning', f"Skipped {len(duplicates)} {label} already in the knowledge base: {', '.join(duplicates)}")
+    if job.dedup_stats['documents']:
+        add_notice('warning', f"Skipped {job.dedup_stats['documents']} duplicate page(s) whose content is already in the knowledge base.")
+    if job.failed:
+        add_notice('error', f"Error loading {len(job.failed)} {label}: {', '.join(job.failed)}")
+
+# Shared read-only base index (default URLs), loaded once per process
+base_index = get_base_index()
+
+# Load the re-ranking model in the background (once per process), queries use vector order until it is ready
+reranker.start_warm_up()
+
+# Initialize per-session index for user-added sources
 if "index" not in st.session_state:
-    default_urls = [
-        "https://www.apple.com/newsroom/2024/02/apple-reports-first-quarter-results/",
-        "https://www.apple.com/newsroom/2024/05/apple-reports-second-quarter-results/",
-        "https://www.apple.com/newsroom/2024/08/apple-reports-third-quarter-results/", 
-        "https://www.apple.com/newsroom/2024/10/apple-reports-fourth-quarter-results/"
-    ]
-    st.session_state.documents = load_web_data(default_urls)
-    st.session_state.index = create_vector_store(st.session_state.documents)
+    st.session_state.index = create_vector_store([])
+
+# Initialize the selected knowledge base
+if "knowledge_base" not in st.session_state:
+    st.session_state.knowledge_base = DEFAULT_KNOWLEDGE_BASE
+
+# Initialize background ingest jobs (running, and finished ones not reported yet)
+if "ingest_jobs" not in st.session_state:
+    st.session_state.ingest_jobs = []
+    st.session_state.ingest_notices = []
 
 # Initialize chat history
 if "messages" not in st.session_state:
@@ -233,7 +255,6 @@ if "messages" not in st.session_state:
     initial_message = "Hi! I'm your AI assistant, ready to help answer your questions using the documents or websites you've added to the knowledge base. Ask me anything, and I'll provide accurate, relevant answers based on the information available!"
     st.session_state.messages.append(ChatMessage(role="assistant", content=initial_message))
 
-@st.fragment()
 def knowledge_base_layout():
     """
     Fragmented UI component for Knowledge Base
@@ -259,28 +280,39 @@ def knowledge_base_layout():
             if submitted_url and len(website_url) > 0:
                 # Check if URL is valid using regex
                 if is_valid_url(website_url):
-                    # Get EXISTING website URLs only
-                    current_urls = get_urls_from_index(st.session_state.index)
-                    # Check if URL already exists
-                    if website_url not in current_urls:
-                        try:
-                            # Load ONLY the new URL (not reloading existing ones)
-                            new_web_docs = load_web_data([website_url])
-                            
-                            # Merge with existing documents
-                            updated_documents = st.session_state.documents + new_web_docs
-                            
-                            # Update session state
-                            st.session_state.documents = updated_documents
-                            st.session_state.index = create_vector_store(updated_documents)
-                            
-                            st.success("Added 1 website to the knowledge base.", icon=":material/task_alt:")
-                        except Exception as e:
-                            st.error(f"Error loading website.", icon=":material/error:")
+                    # Check if URL already exists (base and session index)
+                    if not source_exists(website_url):
+                        # Load ONLY the new URL in the background and insert it into the existing index
+                        start_ingest_job(urls=[website_url])
                     else:
-                        st.warning("Website already exists in the knowledge base.", icon=":material/warning:")
+                        add_notice('warning', "Website already exists in the knowledge base.")
                 else:
-                    st.error("Invalid URL. Please enter a valid website link.", icon=":material/error:")
+                    add_notice('error', "Invalid URL. Please enter a valid website link.")
+
+            st.write("")  # Empty padding
+
+            # Bulk Website URL Input
+            with st.form("bulk_url_form", clear_on_submit=True, border=False):
+                bulk_urls = st.text_area(
+                    label="Websites (bulk)",
+                    placeholder="Paste many website URLs here, one per line"
+                )
+                submitted_bulk_urls = st.form_submit_button(":material/upload: Add websites")
+
+            # Process submitted URLs
+            if submitted_bulk_urls and len(bulk_urls.strip()) > 0:
+                urls = list(dict.fromkeys(url.strip() for url in bulk_urls.splitlines() if url.strip()))
+                invalid_urls = [url for url in urls if not is_valid_url(url)]
+                # Skip URLs that already exist (base and session index)
+                new_urls = [url for url in urls if is_valid_url(url) and not source_exists(url)]
+
+                if new_urls:
+                    # Fetch concurrently in the background, each page is inserted into the index as it arrives
+                    start_ingest_job(urls=new_urls)
+                if invalid_urls:
+                    add_notice('error', f"Skipped {len(invalid_urls)} invalid URL(s): {', '.join(invalid_urls)}")
+                if len(urls) - len(invalid_urls) - len(new_urls) > 0:
+                    add_notice('warning', f"Skipped {len(urls) - len(invalid_urls) - len(new_urls)} website(s) already in the knowledge base.")
 
             st.write("")  # Empty padding
 
@@ -295,44 +327,68 @@ def knowledge_base_layout():
 
             # Process uploaded document
             if submitted_file and len(uploaded_files) > 0:
-                try:
-                    # Get existing DOCUMENT sources only
-                    existing_files = get_file_names_from_index(st.session_state.index)
-                    
-                    # Filter new files
-                    new_files = [f for f in uploaded_files if f.name not in existing_files]
-                    
-                    # Check if file already exists
-                    if new_files:
-                        with tempfile.TemporaryDirectory() as temp_dir:
-                            # Save and process new files
-                            saved_paths = []
-                            for file in new_files:
-                                file_path = os.path.join(temp_dir, file.name)
-                                with open(file_path, "wb") as f:
-                                    f.write(file.getvalue())
-                                saved_paths.append(file_path)
-                            
-                            # Load new documents
-                            new_docs = load_document_data(temp_dir)
-                            
-                            # Update state
-                            updated_documents = st.session_state.documents + new_docs
-                            st.session_state.documents = updated_documents
-                            st.session_state.index = create_vector_store(updated_documents)
-                            
-                            st.success(f"Added {len(new_files)} file(s) to the knowledge base.", icon=":material/task_alt:")
-                    else:
-                        st.warning("Files already exist in knowledge base.", icon=":material/warning:")
-                except Exception as e:
-                    st.error(f"Error processing files.", icon=":material/error:")
+                # Filter new files (not in base or session index)
+                new_files = [f for f in uploaded_files if not source_exists(f.name)]
+
+                # Check if file already exists
+                if new_files:
+                    # Parse files in parallel straight from memory in the background, inserting them as they are parsed
+                    start_ingest_job(files=[(file.name, file.getvalue()) for file in new_files])
+                else:
+                    add_notice('warning', "Files already exist in knowledge base.")
+
+            # Start or stop polling with a full rerun when jobs start or finish (run_every is fixed per app run)
+            running_jobs = [job for job in st.session_state.ingest_jobs if not job.done]
+            if bool(running_jobs) != st.session_state.ingest_polling:
+                st.rerun()
+
+            # Background ingest jobs: progress while running, outcome once finished
+            for job in [job for job in st.session_state.ingest_jobs if job.done]:
+                report_finished_job(job)
+                st.session_state.ingest_jobs.remove(job)
+            for job in running_jobs:
+                label = "websites" if job.source_type == 'Website' else "files"
+                st.progress(job.progress, text=f"Adding {label}: {job.completed} of {job.total} processed...")
+            notice_icons = {'success': ":material/task_alt:", 'warning': ":material/warning:", 'error': ":material/error:"}
+            for level, message in st.session_state.ingest_notices:
+                getattr(st, level)(message, icon=notice_icons[level])
+            if not st.session_state.ingest_polling:
+                st.session_state.ingest_notices = []
 
         # Data Source Display
         with col2:
             st.subheader(":material/database: Knowledge Base")
-            
+
+            # Knowledge base selection (a full rerun switches the chat to it as well)
+            names = knowledge_bases.names()
+            selected = st.selectbox(
+                "Knowledge base",
+                names,
+                index=names.index(st.session_state.knowledge_base) if st.session_state.knowledge_base in names else 0
+            )
+            if selected != st.session_state.knowledge_base:
+                st.session_state.knowledge_base = selected
+                st.rerun()
+
+            # New knowledge base (persisted, shared by everyone who selects it)
+            with st.form("knowledge_base_form", clear_on_submit=True, border=False):
+                new_name = st.text_input(
+                    label="New knowledge base",
+                    placeholder="Type a name for a new knowledge base (e.g. team-docs)"
+                )
+                submitted_name = st.form_submit_button(":material/add: Create knowledge base")
+            if submitted_name and len(new_name.strip()) > 0:
+                try:
+                    knowledge_bases.create(new_name.strip())
+                except ValueError as e:
+                    add_notice('error', str(e))
+                else:
+                    st.session_state.knowledge_base = new_name.strip()
+                    add_notice('success', f"Created knowledge base '{new_name.strip()}'.")
+                st.rerun()
+
             # Get properly separated sources
-            sources = get_all_sources_from_index(st.session_state.index)
+            sources = [source for index in get_active_indexes()[0] for source in get_all_sources_from_index(index)]
             vector_store_df = pd.DataFrame(sources)
             
             # Display sources in vector store
@@ -341,7 +397,9 @@ def knowledge_base_layout():
                 hide_index=True,
                 use_container_width=True
             )
-knowledge_base_layout()
+# Refresh the knowledge base every second while ingest jobs are running (does not interrupt a chat answer)
+st.session_state.ingest_polling = any(not job.done for job in st.session_state.ingest_jobs)
+st.fragment(knowledge_base_layout, run_every=1 if st.session_state.ingest_polling else None)()
 
 @st.fragment
 def chat_layout():
@@ -369,22 +427,23 @@ def chat_layout():
                     with st.chat_message("user"):
                         st.markdown(user_message)
 
-                # Generate AI response
-                assistant_response, sources = chat_response(user_message, st.session_state.messages, st.session_state.index)
+                # Retrieve sources and start streaming the AI response
+                st.session_state.prompt_stats = {}
+                response_stream, sources = stream_chat_response(user_message, st.session_state.messages, get_active_indexes()[0], st.session_state.prompt_stats)
 
-                # Append "user" message to chat history
-                st.session_state.messages.append(ChatMessage(role="user", content=user_message))
-
-                # Append "assistant" message to chat history
-                st.session_state.messages.append(ChatMessage(role="assistant", content=assistant_response))
-                
                 # Store sources in session state for display in Sources section
                 st.session_state.sources = sources
 
-                # Display assistant message in Chat Display
+                # Display assistant message in Chat Display as it is generated
                 with messages_placeholder:
                     with st.chat_message("assistant"):
-                        st.markdown(assistant_response)
+                        assistant_response = st.write_stream(response_stream)
+
+                # Append "user" message to chat history
+                st.session_state.messages.append(ChatMessage(role="user", content=user_message))
+
+                # Append "assistant" message to chat history
+                st.session_state.messages.append(ChatMessage(role="assistant", content=assistant_response))
 
         # Document Sources Table
         with col2:
@@ -394,8 +453,8 @@ def chat_layout():
                 if len(st.session_state.sources) == 0:
                     st.warning("No relevant documents or websites found in knowledge base.", icon=":material/warning:")
                 else:
-                    # Create a DataFrame from the sources dict object
-                    sources_df = pd.DataFrame(st.session_state.sources)
+                    # Create a DataFrame from the sources dict object (the chunk with its neighbors is only sent to the LLM)
+                    sources_df = pd.DataFrame(st.session_state.sources).drop(columns=['expanded_text'], errors='ignore')
                     sources_df = sources_df.rename(columns={
                         'score': 'Relevance',
                         'source': 'Source',
@@ -403,8 +462,33 @@ def chat_layout():
                     })
                     # Display DataFrame
                     st.dataframe(sources_df, hide_index=True, use_container_width=True)
+                # Display prompt size of the last turn (empty when the answer came from the answer cache)
+                if st.session_state.get('prompt_stats'):
+                    stats = st.session_state.prompt_stats
+                    st.caption(f"Prompt: {stats['prompt_tokens']} tokens ({stats['context_tokens']} context, {stats['history_tokens']} history)")
             else:
                 st.info("Relevant documents or websites from the knowledge base will appear here once you start asking questions.", icon=":material/info:")
+
+    # Debug panel (only when tracing is enabled), rendered inside the fragment so it refreshes after each turn
+    if tracer.enabled:
+        with st.expander(":material/bug_report: Debug", expanded=False):
+            # Span breakdown of the last finished trace (chat turn or ingestion)
+            if tracer.traces:
+                last_trace = tracer.traces[-1]
+                st.caption(f"Last trace: {last_trace['name']} ({last_trace['duration_ms']:.0f} ms)")
+                st.dataframe(pd.DataFrame(last_trace['spans']), hide_index=True, use_container_width=True)
+            else:
+                st.caption("No traces recorded yet.")
+            # Cache hit rates and latency histograms
+            st.json({
+                'embedding_cache': get_embed_model().cache_stats() if isinstance(get_embed_model(), CachedEmbedding) else None,
+                'answer_cache': answer_cache.stats(),
+                'reranker': reranker.stats(),
+                'chunking': document_chunker.report(),
+                'startup_ms': startup_timer.report(),
+                'knowledge_bases': knowledge_bases.stats()
+            })
+            st.code(tracer.prometheus_metrics(), language="text")
 chat_layout()
 
 # ==========================================================
@@ -435,3 +519,9 @@ st.markdown("""
             <p>Made by <a href='https://github.com/ErnestAroozoo' target='_blank'>Ernest Aroozoo</a> | <a href='https://github.com/ErnestAroozoo/DeepKnowledge.net' target='_blank'>View on GitHub</a></p>
             </div>
             """, unsafe_allow_html=True)
+
+# Startup report: recorded on the first run of the script in this process
+if 'first render' not in startup_timer:
+    startup_timer.record('first render', time.perf_counter() - _script_started)
+    if STARTUP_REPORT:
+        print(json.dumps({'startup_ms': startup_timer.report()}), flush=True)
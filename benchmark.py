@@ -0,0 +1,239 @@
+import argparse
+import hashlib
+import json
+import platform
+import resource
+import sys
+import time
+
+import numpy as np
+
+import vector_search
+from vector_search import *
+from vector_store import MatrixVectorStore, VECTOR_QUANTIZATION, VECTOR_SEARCH_MODE
+from llama_index.core.embeddings import BaseEmbedding
+from llama_index.core.llms import MockLLM
+
+# Benchmark Parameters
+BENCHMARK_DIMENSION = 1536  # Same dimension as text-embedding-ada-002
+BENCHMARK_VOCABULARY_SIZE = 5000
+BENCHMARK_WORDS_PER_CHUNK = 80  # Well below the default chunk size, so every synthetic document is one chunk
+BENCHMARK_TOPICS = 64  # Clusters of the synthetic embedding matrix used for the retrieval benchmark
+BENCHMARK_TOP_K_VALUES = (1, 5, 10, 50)
+# Fake embedding scores sit well below real ones (a question shares a few words with its chunk),
+# so the production SIMILARITY_CUTOFF would leave most benchmark chat turns without any context
+BENCHMARK_CHAT_SIMILARITY_CUTOFF = 0.3
+
+class FakeEmbedding(BaseEmbedding):
+    """
+    Deterministic local embedding model: hashed bag-of-words projected onto a fixed number of dimensions
+    Texts that share words get similar vectors, so retrieval over synthetic corpora behaves like a real index
+    """
+    dimension: int = BENCHMARK_DIMENSION
+
+    def _embed(self, text):
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        for word in text.lower().split():
+            digest = int.from_bytes(hashlib.blake2b(word.encode(), digest_size=8).digest(), 'little')
+            vector[digest % self.dimension] += 1.0 if digest & 1 << 63 else -1.0
+        vector[0] += 1e-3  # Avoid zero vectors for empty texts
+        return vector.tolist()
+
+    def _get_text_embedding(self, text):
+        return self._embed(text)
+
+    def _get_query_embedding(self, query):
+        return self._embed(query)
+
+    async def _aget_query_embedding(self, query):
+        return self._embed(query)
+
+def make_vocabulary(size=BENCHMARK_VOCABULARY_SIZE, seed=0):
+    """
+    Generate a deterministic vocabulary of pseudo-words
+    """
+    rng = np.random.default_rng(seed)
+    letters = np.array(list('abcdefghijklmnopqrstuvwxyz'))
+    return [''.join(rng.choice(letters, rng.integers(3, 10))) for _ in range(size)]
+
+def make_corpus(num_chunks, words_per_chunk=BENCHMARK_WORDS_PER_CHUNK, seed=0):
+    """
+    Generate a synthetic corpus of single-chunk documents with Zipf-distributed word frequencies
+    Returns the documents and one question per document built from a sample of its words
+    """
+    rng = np.random.default_rng(seed)
+    vocabulary = np.array(make_vocabulary(seed=seed))
+    documents, questions = [], []
+    for position in range(num_chunks):
+        words = vocabulary[(rng.zipf(1.3, words_per_chunk) - 1) % len(vocabulary)]
+        text = ' '.join(words)
+        documents.append(Document(text=text, metadata={'url': f'https://benchmark.local/page/{position}'}))
+        questions.append(' '.join(rng.choice(words, 8)) + '?')
+    return documents, questions
+
+def make_embedding_matrix(num_chunks, dimension=BENCHMARK_DIMENSION, topics=BENCHMARK_TOPICS, seed=0):
+    """
+    Generate a clustered random embedding matrix (float32), a stand-in for a large embedded corpus
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((topics, dimension), dtype=np.float32)
+    matrix = np.empty((num_chunks, dimension), dtype=np.float32)
+    step = 100000  # Generate in slices to bound the temporary memory
+    for start in range(0, num_chunks, step):
+        stop = min(start + step, num_chunks)
+        matrix[start:stop] = centers[rng.integers(0, topics, stop - start)]
+        matrix[start:stop] += 0.5 * rng.standard_normal((stop - start, dimension), dtype=np.float32)
+    return matrix
+
+def percentiles(samples):
+    """
+    Summarize latency samples (seconds) as p50/p95/p99/mean in milliseconds
+    """
+    samples = 1000 * np.asarray(samples)
+    return {
+        'p50_ms': float(np.percentile(samples, 50)),
+        'p95_ms': float(np.percentile(samples, 95)),
+        'p99_ms': float(np.percentile(samples, 99)),
+        'mean_ms': float(samples.mean()),
+        'samples': int(len(samples))
+    }
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process in MB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def benchmark_ingest(num_chunks, seed=0):
+    """
+    Ingest a synthetic corpus through the full pipeline (chunking, embedding, insertion)
+    """
+    documents, questions = make_corpus(num_chunks, seed=seed)
+    start = time.perf_counter()
+    index = create_vector_store(documents)
+    seconds = time.perf_counter() - start
+    return index, questions, {
+        'documents': len(documents),
+        'chunks': index.vector_store.count,
+        'seconds': seconds,
+        'chunks_per_second': index.vector_store.count / seconds if seconds else None,
+        'embedding': embedding_scheduler.last_run,
+        'chunking': document_chunker.report()
+    }
+
+def benchmark_retrieval(num_chunks, num_queries, top_k_values, search_mode, quantization='none', seed=0):
+    """
+    Build a vector store from a synthetic embedding matrix and measure query latency per top-k
+    """
+    matrix = make_embedding_matrix(num_chunks, seed=seed)
+    queries = make_embedding_matrix(num_queries, seed=seed + 1)
+    node_ids = [f'node-{position}' for position in range(num_chunks)]
+
+    start = time.perf_counter()
+    store = MatrixVectorStore.from_arrays(node_ids, node_ids, matrix, quantization=quantization)
+    store.search_mode = search_mode
+    if search_mode == 'ivf':
+        store.build_ivf()
+    build_seconds = time.perf_counter() - start
+    del matrix
+
+    latency = {}
+    for top_k in top_k_values:
+        samples = []
+        for query in queries:
+            start = time.perf_counter()
+            store.search([query], top_k)
+            samples.append(time.perf_counter() - start)
+        latency[str(top_k)] = percentiles(samples)
+
+    # Batched retrieval amortizes the matrix scan over many questions
+    start = time.perf_counter()
+    store.search(queries, SIMILARITY_TOP_K)
+    batch_seconds = time.perf_counter() - start
+
+    result = {
+        'chunks': num_chunks,
+        'dimension': store.vectors.shape[1],
+        'search_mode': search_mode,
+        'build_seconds': build_seconds,
+        'vector_memory': store.memory_usage(),
+        'query_latency': latency,
+        'batch_ms_per_query': 1000 * batch_seconds / num_queries
+    }
+    index = VectorStoreIndex(nodes=[], storage_context=StorageContext.from_defaults(vector_store=store), embed_model=get_embed_model())
+    if search_mode == 'ivf':
+        result['ann_recall'] = measure_ann_recall(index, queries[:min(num_queries, 100)])
+    if quantization != 'none':
+        result['quantization_recall'] = measure_quantization_recall(index, queries[:min(num_queries, 100)])
+    return result
+
+def benchmark_chat(index, questions, num_turns, similarity_cutoff=BENCHMARK_CHAT_SIMILARITY_CUTOFF):
+    """
+    Measure full chat_response turn latency (retrieval, prompt building, LLM call) with a fake LLM
+    Reports the retrieved context per turn alongside, turns without context are much cheaper
+    """
+    answer_cache.clear()
+    samples, prompt_tokens, context_chunks, context_tokens = [], [], [], []
+    production_cutoff = vector_search.SIMILARITY_CUTOFF
+    vector_search.SIMILARITY_CUTOFF = similarity_cutoff
+    try:
+        for question in questions[:num_turns]:
+            prompt_stats = {}
+            start = time.perf_counter()
+            chat_response(question, [], index, prompt_stats)
+            samples.append(time.perf_counter() - start)
+            prompt_tokens.append(prompt_stats.get('prompt_tokens', 0))
+            context_chunks.append(prompt_stats.get('context_chunks', 0))
+            context_tokens.append(prompt_stats.get('context_tokens', 0))
+    finally:
+        vector_search.SIMILARITY_CUTOFF = production_cutoff
+    return {
+        'similarity_cutoff': similarity_cutoff,
+        'turn_latency': percentiles(samples),
+        'mean_prompt_tokens': float(np.mean(prompt_tokens)),
+        'mean_context_chunks': float(np.mean(context_chunks)),
+        'mean_context_tokens': float(np.mean(context_tokens)),
+        'turns_without_context': int(sum(chunks == 0 for chunks in context_chunks)),
+        'answer_cache': answer_cache.stats()
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark for ingestion, retrieval and chat turns.")
+    parser.add_argument('--chunks', type=int, default=100000, help="Size of the synthetic corpus for the retrieval benchmark (1k-1M).")
+    parser.add_argument('--ingest-chunks', type=int, default=2000, help="Chunks ingested through the full pipeline.")
+    parser.add_argument('--queries', type=int, default=200, help="Queries per top-k value.")
+    parser.add_argument('--top-k', type=int, nargs='+', default=list(BENCHMARK_TOP_K_VALUES), help="SIMILARITY_TOP_K values to measure.")
+    parser.add_argument('--chat-turns', type=int, default=50, help="Chat turns to measure.")
+    parser.add_argument('--chat-similarity-cutoff', type=float, default=BENCHMARK_CHAT_SIMILARITY_CUTOFF, help="SIMILARITY_CUTOFF for the chat turns.")
+    parser.add_argument('--search-mode', choices=['exact', 'ivf'], default=VECTOR_SEARCH_MODE)
+    parser.add_argument('--quantization', choices=['none', 'int8', 'binary'], default=VECTOR_QUANTIZATION)
+    parser.add_argument('--chunk-strategy', choices=['auto', 'markdown', 'section', 'page', 'sentence'], default=CHUNK_STRATEGY)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="Write the JSON results to this file instead of stdout.")
+    args = parser.parse_args()
+
+    # Swap in the deterministic local models (no network calls, no embedding cache)
+    vector_search.embed_model = FakeEmbedding()
+    vector_search.llm = MockLLM(max_tokens=64)
+    document_chunker.strategy = args.chunk_strategy
+
+    results = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'platform': {'python': platform.python_version(), 'machine': platform.machine(), 'numpy': np.__version__},
+        'parameters': vars(args)
+    }
+    index, questions, results['ingest'] = benchmark_ingest(args.ingest_chunks, args.seed)
+    results['chat'] = benchmark_chat(index, questions, args.chat_turns, args.chat_similarity_cutoff)
+    results['retrieval'] = benchmark_retrieval(args.chunks, args.queries, args.top_k, args.search_mode, args.quantization, args.seed)
+    results['peak_rss_mb'] = peak_rss_mb()
+
+    output = json.dumps(results, indent=2, default=str)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
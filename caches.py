@@ -0,0 +1,312 @@
+from llama_index.core.llms import MessageRole
+from llama_index.core.embeddings import BaseEmbedding
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from dotenv import load_dotenv
+from tracing import tracer
+from vector_store import content_hash
+import numpy as np
+import os
+import sqlite3
+import hashlib
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+
+# Embedding cache (persistent, per chunk text) and semantic answer cache (in memory, per retrieval context)
+
+load_dotenv()
+
+# Embedding Cache Parameters
+EMBEDDING_CACHE_PATH = os.getenv('EMBEDDING_CACHE_PATH', './cache/embeddings.db')
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv('EMBEDDING_CACHE_MAX_ENTRIES', 200000))
+
+class CachedEmbedding(BaseEmbedding):
+    """
+    Embedding model wrapper that stores text embeddings on disk (SQLite), keyed by a hash of (model name, text)
+    Entries are shared across sessions and restarts, and the least recently used ones are evicted above max_entries
+    """
+    embed_model: BaseEmbedding = Field(description="The wrapped embedding model.")
+    cache_path: str = Field(description="Path of the SQLite cache file.")
+    max_entries: int = Field(description="Maximum number of cached embeddings.")
+    _conn: sqlite3.Connection = PrivateAttr()
+    _lock: threading.Lock = PrivateAttr()
+    _hits: int = PrivateAttr(default=0)
+    _misses: int = PrivateAttr(default=0)
+
+    def __init__(self, embed_model, cache_path=EMBEDDING_CACHE_PATH, max_entries=EMBEDDING_CACHE_MAX_ENTRIES, **kwargs):
+        super().__init__(
+            embed_model=embed_model,
+            cache_path=cache_path,
+            max_entries=max_entries,
+            model_name=embed_model.model_name,
+            embed_batch_size=embed_model.embed_batch_size,
+            **kwargs
+        )
+        if os.path.dirname(cache_path):
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(cache_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._conn.commit()
+
+    @classmethod
+    def class_name(cls):
+        return "CachedEmbedding"
+
+    def _cache_key(self, text):
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode("utf-8")).hexdigest()
+
+    def _lookup(self, texts):
+        """
+        Return cached embeddings (None for misses) and the unique texts that still need to be embedded
+        """
+        keys = [self._cache_key(text) for text in texts]
+        found = {}
+        with self._lock:
+            # Query in chunks to stay below SQLite's host parameter limit
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                found.update({key: np.frombuffer(vector, dtype=np.float32).tolist() for key, vector in rows})
+            if found:
+                now = time.time()
+                self._conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+                self._conn.commit()
+            embeddings = [found.get(key) for key in keys]
+            self._hits += sum(embedding is not None for embedding in embeddings)
+            self._misses += sum(embedding is None for embedding in embeddings)
+        missing = list(dict.fromkeys(text for text, embedding in zip(texts, embeddings) if embedding is None))
+        return embeddings, missing
+
+    def _store(self, texts, embeddings):
+        """
+        Write new embeddings to the cache and evict the least recently used entries above max_entries
+        """
+        now = time.time()
+        rows = [
+            (self._cache_key(text), np.asarray(embedding, dtype=np.float32).tobytes(), now)
+            for text, embedding in zip(texts, embeddings)
+        ]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)", rows)
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+            self._conn.commit()
+
+    def _merge(self, texts, embeddings, missing, new_embeddings):
+        new_by_text = dict(zip(missing, new_embeddings))
+        return [embedding if embedding is not None else new_by_text[text] for text, embedding in zip(texts, embeddings)]
+
+    def _get_text_embeddings(self, texts):
+        embeddings, missing = self._lookup(texts)
+        new_embeddings = []
+        if missing:
+            new_embeddings = self.embed_model._get_text_embeddings(missing)
+            self._store(missing, new_embeddings)
+        return self._merge(texts, embeddings, missing, new_embeddings)
+
+    async def _aget_text_embeddings(self, texts):
+        embeddings, missing = self._lookup(texts)
+        new_embeddings = []
+        if missing:
+            new_embeddings = await self.embed_model._aget_text_embeddings(missing)
+            self._store(missing, new_embeddings)
+        return self._merge(texts, embeddings, missing, new_embeddings)
+
+    def _get_text_embedding(self, text):
+        return self._get_text_embeddings([text])[0]
+
+    async def _aget_text_embedding(self, text):
+        return (await self._aget_text_embeddings([text]))[0]
+
+    def _get_query_embedding(self, query):
+        # Queries are not cached, they are rarely repeated verbatim
+        return self.embed_model._get_query_embedding(query)
+
+    async def _aget_query_embedding(self, query):
+        return await self.embed_model._aget_query_embedding(query)
+
+    @property
+    def hits(self):
+        return self._hits
+
+    @property
+    def misses(self):
+        return self._misses
+
+    def cache_stats(self):
+        """
+        Return cache hit/miss counters and the number of stored embeddings
+        """
+        with self._lock:
+            (entries,) = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        lookups = self._hits + self._misses
+        return {
+            'hits': self._hits,
+            'misses': self._misses,
+            'hit_rate': self._hits / lookups if lookups else 0.0,
+            'entries': entries
+        }
+
+# Answer Cache Parameters
+ANSWER_CACHE_THRESHOLD = float(os.getenv('ANSWER_CACHE_THRESHOLD', 0.97))  # Minimum cosine similarity between questions
+ANSWER_CACHE_TTL = float(os.getenv('ANSWER_CACHE_TTL', 24 * 3600))  # Seconds
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv('ANSWER_CACHE_MAX_ENTRIES', 2000))
+
+class AnswerCache:
+    """
+    Semantic cache of LLM answers, shared by all sessions
+    An answer is reused when a new question retrieves the same nodes from the same index versions, in a conversation
+    with the same history, and its embedding is within the cosine similarity threshold of the cached question
+    """
+    def __init__(self, threshold=ANSWER_CACHE_THRESHOLD, ttl=ANSWER_CACHE_TTL, max_entries=ANSWER_CACHE_MAX_ENTRIES):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # Entry id -> entry, in least recently used order
+        self._by_context = defaultdict(set)  # (index versions, node ids) -> entry ids
+        self._latest_versions = {}  # Store uid -> latest version seen, for stores referenced by cached entries
+        self._uid_entries = Counter()  # Store uid -> number of cached entries referencing it
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    @staticmethod
+    def make_key(indexes, node_ids):
+        """
+        Cache key of a retrieval: versions of the indexes that supplied the retrieved nodes, and the node ids
+        Indexes with no retrieved node are left out, so sessions whose answers come only from the shared base index
+        share them whatever their own session index holds (a session node that outranks them changes the node ids)
+        """
+        node_ids = tuple(node_ids)
+        versions = tuple(
+            index.vector_store.version for index in indexes
+            if any(index.docstore.document_exists(node_id) for node_id in node_ids)
+        )
+        return versions, node_ids
+
+    @staticmethod
+    def with_history(key, chat_memory):
+        """
+        Extend a cache key with the conversation so far: a follow-up question depends on the earlier turns,
+        a first question (no earlier user turn) does not
+        """
+        if not any(message.role == MessageRole.USER for message in chat_memory):
+            return key + (None,)
+        return key + (content_hash('\n'.join(f"{message.role}: {message.content}" for message in chat_memory)),)
+
+    def _remove(self, entry_id, forget=True):
+        entry = self._entries.pop(entry_id)
+        self._by_context[entry['key']].discard(entry_id)
+        if not self._by_context[entry['key']]:
+            del self._by_context[entry['key']]
+        # Stop tracking stores (e.g. indexes of finished sessions) no entry refers to anymore
+        # Invalidated stores are still tracked, so answers generated from their older version are not stored
+        for uid, _ in entry['key'][0]:
+            self._uid_entries[uid] -= 1
+            if not self._uid_entries[uid]:
+                del self._uid_entries[uid]
+                if forget:
+                    del self._latest_versions[uid]
+
+    def _invalidate_stale(self, versions):
+        """
+        Drop entries built on an older version of a store as soon as a newer version is seen
+        """
+        changed = set()
+        for uid, version in versions:
+            if uid in self._latest_versions and self._latest_versions[uid] < version:
+                self._latest_versions[uid] = version
+                changed.add(uid)
+        if changed:
+            stale = [
+                entry_id for entry_id, entry in self._entries.items()
+                if any(uid in changed and version < self._latest_versions[uid] for uid, version in entry['key'][0])
+            ]
+            for entry_id in stale:
+                self._remove(entry_id, forget=False)
+
+    def lookup(self, key, question_embedding):
+        """
+        Return the cached answer for a question, or None on a miss
+        """
+        question = np.asarray(question_embedding, dtype=np.float32)
+        question = question / max(float(np.linalg.norm(question)), 1e-12)
+        now = time.time()
+        with self._lock:
+            self._invalidate_stale(key[0])
+            best_id, best_score = None, self.threshold
+            for entry_id in list(self._by_context.get(key, ())):
+                entry = self._entries[entry_id]
+                if now - entry['created'] > self.ttl:
+                    self._remove(entry_id)
+                    continue
+                score = float(entry['question'] @ question)
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+            if best_id is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_id)
+            entry = self._entries[best_id]
+            self.hits += 1
+            self.saved_seconds += entry['latency']
+            return entry['answer']
+
+    def store(self, key, question_embedding, answer, latency):
+        """
+        Cache an answer together with the time it took to generate
+        """
+        question = np.asarray(question_embedding, dtype=np.float32)
+        question = question / max(float(np.linalg.norm(question)), 1e-12)
+        with self._lock:
+            self._invalidate_stale(key[0])
+            # The index changed while the answer was generated
+            if any(version < self._latest_versions.get(uid, version) for uid, version in key[0]):
+                return
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = {'key': key, 'question': question, 'answer': answer, 'latency': latency, 'created': time.time()}
+            self._by_context[key].add(entry_id)
+            for uid, version in key[0]:
+                self._latest_versions[uid] = version
+                self._uid_entries[uid] += 1
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+            # Entries reference at most a few stores each, so this only prunes stores kept after an invalidation
+            if len(self._latest_versions) > 2 * self.max_entries:
+                self._latest_versions = {uid: version for uid, version in self._latest_versions.items() if uid in self._uid_entries}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_context.clear()
+            self._latest_versions.clear()
+            self._uid_entries.clear()
+
+    def stats(self):
+        """
+        Return hit/miss counters, hit rate and total LLM latency saved by cache hits
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'saved_seconds': self.saved_seconds,
+            'entries': len(self._entries)
+        }
+
+# Shared answer cache (process-wide, see AnswerCache)
+answer_cache = AnswerCache()
+tracer.register_cache('answer', answer_cache.stats)
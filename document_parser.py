@@ -0,0 +1,23 @@
+import io
+import os
+
+# Text extraction run in the document parser worker processes (see vector_search.iter_document_data)
+# Kept out of vector_search so spawned workers only import pypdf or docx2txt, not llama_index
+
+def parse_document_bytes(file_name, data):
+    """
+    Extract text from one in-memory PDF/DOCX file (runs in a worker process)
+    Returns a list of (text, metadata) tuples: one per page for PDF files, one per file for DOCX files
+    """
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension == '.pdf':
+        import pypdf
+        pdf = pypdf.PdfReader(io.BytesIO(data))
+        return [
+            (page.extract_text(), {'page_label': pdf.page_labels[number], 'file_name': file_name})
+            for number, page in enumerate(pdf.pages)
+        ]
+    if extension == '.docx':
+        import docx2txt
+        return [(docx2txt.process(io.BytesIO(data)), {'file_name': file_name})]
+    raise ValueError(f"Unsupported file type: {extension}")
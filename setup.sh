@@ -10,4 +10,8 @@ echo "\
 headless = true\n\
 enableCORS=false\n\
 port = $PORT\n\
-" > ~/.streamlit/config.toml
\ No newline at end of file
+" > ~/.streamlit/config.toml
+
+# Build the default index before the app starts, so the first session does not fetch and embed DEFAULT_URLS
+# (on failure, e.g. no network, the app builds it on first use instead)
+python vector_search.py --build-index || echo "Default index not built, it will be built on first use"
@@ -0,0 +1,38 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+# Tests run offline against the repository modules, with the benchmark's local fake models
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark
+import vector_search
+from llama_index.core.llms import MockLLM
+
+TEST_DIMENSION = 64
+
+@pytest.fixture(autouse=True)
+def fake_models(monkeypatch):
+    """
+    Deterministic local embedding model and an echoing LLM (the answer is the prompt), with an empty answer cache
+    """
+    monkeypatch.setattr(vector_search, 'embed_model', benchmark.FakeEmbedding(dimension=TEST_DIMENSION))
+    monkeypatch.setattr(vector_search, 'llm', MockLLM())
+    monkeypatch.setattr(vector_search, 'SIMILARITY_CUTOFF', 0.0)
+    vector_search.answer_cache.clear()
+    yield
+    vector_search.answer_cache.clear()
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    """
+    Skip retry backoff and rate-limit cooldown delays (asyncio.sleep returns immediately)
+    """
+    sleep = asyncio.sleep
+
+    async def no_sleep(delay, *args, **kwargs):
+        await sleep(0)
+
+    monkeypatch.setattr(asyncio, 'sleep', no_sleep)
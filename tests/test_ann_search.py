@@ -0,0 +1,36 @@
+from llama_index.core import StorageContext, VectorStoreIndex
+
+import benchmark
+import vector_store
+from vector_search import MatrixVectorStore, get_embed_model, measure_ann_recall
+
+NUM_CHUNKS = 10000
+DIMENSION = 128
+
+def make_index(vectors, **kwargs):
+    node_ids = [f'node-{position}' for position in range(len(vectors))]
+    store = MatrixVectorStore.from_arrays(node_ids, node_ids, vectors, **kwargs)
+    return VectorStoreIndex(nodes=[], storage_context=StorageContext.from_defaults(vector_store=store), embed_model=get_embed_model())
+
+def corpus_and_queries():
+    # Queries are held-out points of the same clustered distribution as the corpus
+    vectors = benchmark.make_embedding_matrix(NUM_CHUNKS + 100, dimension=DIMENSION)
+    return vectors[:NUM_CHUNKS], vectors[NUM_CHUNKS:]
+
+def test_ivf_search_recall():
+    vectors, queries = corpus_and_queries()
+    index = make_index(vectors)
+
+    result = measure_ann_recall(index, queries)
+
+    assert result['recall'] >= 0.9
+    assert result['nprobe'] < result['nlist']
+
+def test_small_stores_search_exactly_in_ivf_mode(monkeypatch):
+    monkeypatch.setattr(vector_store, 'IVF_MIN_NODES', NUM_CHUNKS + 1)
+    vectors, queries = corpus_and_queries()
+    store = make_index(vectors).vector_store
+    store.search_mode = 'ivf'
+
+    assert store.search(queries, 5) == store.search(queries, 5, exact=True)
+    assert store.ivf is None
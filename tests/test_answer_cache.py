@@ -0,0 +1,100 @@
+import types
+
+import numpy as np
+import pytest
+from llama_index.core import Document
+
+import caches
+from caches import AnswerCache
+from vector_search import add_documents, create_vector_store, retrieve_with_cache_key
+
+KEY = ((('store', 1),), ('node-1', 'node-2'), None)
+
+def question(angle):
+    """
+    Unit question embedding at an angle (radians) from the first axis: cosine similarity with question(0) is cos(angle)
+    """
+    return [np.cos(angle), np.sin(angle), 0.0]
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(caches, 'time', types.SimpleNamespace(time=lambda: now[0]))
+    return now
+
+def test_similar_questions_hit_within_the_threshold(clock):
+    cache = AnswerCache(threshold=0.95, ttl=60, max_entries=10)
+    cache.store(KEY, question(0), "Cached answer", latency=2.0)
+
+    assert cache.lookup(KEY, [10.0, 0.0, 0.0]) == "Cached answer"  # Embeddings are normalized
+    assert cache.lookup(KEY, question(np.arccos(0.951))) == "Cached answer"
+    assert cache.lookup(KEY, question(np.arccos(0.949))) is None
+    assert cache.lookup(KEY[:2] + ('other history',), question(0)) is None
+    assert cache.stats() == {'hits': 2, 'misses': 2, 'hit_rate': 0.5, 'saved_seconds': 4.0, 'entries': 1}
+
+def test_entries_expire_after_the_ttl(clock):
+    cache = AnswerCache(threshold=0.95, ttl=60, max_entries=10)
+    cache.store(KEY, question(0), "Cached answer", latency=1.0)
+
+    clock[0] += 60
+    assert cache.lookup(KEY, question(0)) == "Cached answer"
+    clock[0] += 1
+    assert cache.lookup(KEY, question(0)) is None
+    assert cache.stats()['entries'] == 0
+
+def test_least_recently_used_entry_is_evicted_at_capacity(clock):
+    cache = AnswerCache(threshold=0.95, ttl=60, max_entries=2)
+    keys = [((('store', 1),), (f'node-{number}',), None) for number in range(3)]
+    cache.store(keys[0], question(0), "First", latency=1.0)
+    cache.store(keys[1], question(0), "Second", latency=1.0)
+
+    assert cache.lookup(keys[0], question(0)) == "First"  # Now more recently used than the second entry
+    cache.store(keys[2], question(0), "Third", latency=1.0)
+
+    assert cache.lookup(keys[1], question(0)) is None
+    assert cache.lookup(keys[0], question(0)) == "First"
+    assert cache.lookup(keys[2], question(0)) == "Third"
+
+def test_entries_are_invalidated_when_the_index_changes():
+    cache = AnswerCache(threshold=0.95, ttl=60, max_entries=10)
+    index = create_vector_store([Document(text="Apple reported quarterly revenue of 90 billion dollars.", id_='https://example.com/apple')])
+    node_ids = index.vector_store.node_ids
+    old_key = AnswerCache.make_key([index], node_ids)
+    cache.store(old_key, question(0), "Old answer", latency=1.0)
+
+    add_documents(index, [Document(text="The orchard harvest of pears was delayed.", id_='https://example.com/pears')])
+    new_key = AnswerCache.make_key([index], node_ids)
+
+    # The same nodes from a newer version of the index miss, and the older entry is dropped
+    assert new_key != old_key
+    assert cache.lookup(new_key, question(0)) is None
+    assert cache.stats()['entries'] == 0
+    # An answer generated from the older version is not cached anymore
+    cache.store(old_key, question(0), "Old answer", latency=1.0)
+    assert cache.stats()['entries'] == 0
+    # Other retrieved nodes make another key
+    assert cache.lookup(AnswerCache.make_key([index], node_ids[:1] + ['other-node']), question(0)) is None
+
+def test_sessions_share_answers_from_the_base_index():
+    base_index = create_vector_store([Document(text="Apple reported quarterly revenue of 90 billion dollars.", id_='https://example.com/apple')])
+    first_session = create_vector_store([Document(text="The orchard harvest of pears was delayed by a cold spring.", id_='https://example.com/pears')])
+    second_session = create_vector_store([])
+    node_ids = base_index.vector_store.node_ids
+
+    first_key = AnswerCache.make_key([base_index, first_session], node_ids)
+
+    # Only the base index supplied the nodes, the session indexes do not split the key
+    assert first_key == AnswerCache.make_key([base_index, second_session], node_ids)
+    assert first_key[0] == (base_index.vector_store.version,)
+    assert AnswerCache.make_key([base_index, first_session], node_ids + first_session.vector_store.node_ids)[0] == (
+        base_index.vector_store.version, first_session.vector_store.version)
+
+def test_retrieval_key_depends_on_the_indexes_that_supplied_results(monkeypatch):
+    base_index = create_vector_store([Document(text="Apple reported quarterly revenue of 90 billion dollars.", id_='https://example.com/apple')])
+    sessions = [create_vector_store([]), create_vector_store([Document(text="Unrelated text.", id_='https://example.com/other')])]
+    monkeypatch.setattr('vector_search.SIMILARITY_CUTOFF', 0.5)
+
+    retrievals = [retrieve_with_cache_key([base_index, session], "Apple quarterly revenue") for session in sessions]
+
+    assert [result['source'] for result in retrievals[1][0]] == ['https://example.com/apple']
+    assert retrievals[0][1] == retrievals[1][1]
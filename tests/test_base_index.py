@@ -0,0 +1,63 @@
+import asyncio
+import threading
+
+import pytest
+from llama_index.core import Document
+
+import vector_search
+from vector_search import aadd_documents, add_documents, create_vector_store, get_base_index, query_vector_store, remove_source
+
+BASE_DOCUMENTS = [
+    Document(text="Apple reported quarterly revenue of 90 billion dollars.", id_='https://example.com/apple'),
+    Document(text="The orchard harvest of pears was delayed by a cold spring.", id_='https://example.com/pears')
+]
+
+@pytest.fixture
+def base_index(monkeypatch):
+    index = create_vector_store(BASE_DOCUMENTS)
+    monkeypatch.setattr(vector_search, '_base_index', index)
+    return index
+
+def test_base_index_is_loaded_once(monkeypatch):
+    loads = []
+    monkeypatch.setattr(vector_search, '_base_index', None)
+    monkeypatch.setattr(vector_search, 'load_default_index', lambda: loads.append(1) or create_vector_store(BASE_DOCUMENTS))
+
+    threads = [threading.Thread(target=get_base_index) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert loads == [1]
+    assert get_base_index() is vector_search._base_index
+
+def test_base_and_session_results_are_merged(base_index):
+    session_index = create_vector_store([Document(text="Apple quarterly revenue grew again in the holiday quarter.", id_='https://example.com/session')])
+
+    results = query_vector_store([base_index, session_index], "Apple quarterly revenue")
+
+    sources = [result['source'] for result in results]
+    assert {'https://example.com/apple', 'https://example.com/session'} <= set(sources)
+    assert [result['score'] for result in results] == sorted((result['score'] for result in results), reverse=True)
+    assert len(results) <= vector_search.SIMILARITY_TOP_K
+
+def test_base_index_is_read_only(base_index):
+    document = Document(text="New text.", id_='https://example.com/new')
+
+    with pytest.raises(ValueError):
+        add_documents(base_index, [document])
+    with pytest.raises(ValueError):
+        asyncio.run(aadd_documents(base_index, [document]))
+    with pytest.raises(ValueError):
+        remove_source(base_index, 'https://example.com/apple')
+    assert base_index.vector_store.count == 2
+
+def test_session_skips_documents_already_in_the_base_index(base_index):
+    dedup_stats = {}
+    session_index = create_vector_store([])
+
+    add_documents(session_index, [Document(text=BASE_DOCUMENTS[0].text, id_=BASE_DOCUMENTS[0].id_)], dedup_stats)
+
+    assert session_index.vector_store.count == 0
+    assert dedup_stats['sources'] == ['https://example.com/apple']
@@ -0,0 +1,63 @@
+import json
+
+from llama_index.core import Document
+
+import vector_search
+from vector_search import CachedEmbedding, answer_questions, create_vector_store, embed_queries
+
+from conftest import TEST_DIMENSION
+
+QUESTIONS = [
+    {'id': 1, 'question': "What was Apple's quarterly revenue?"},
+    {'id': 2, 'question': "Why was the pear harvest delayed?"},
+    {'id': 3, 'question': "Which product drove sales?"}
+]
+
+def make_index():
+    return create_vector_store([
+        Document(text="Apple reported quarterly revenue of 90 billion dollars, driven by iPhone sales.", id_='https://example.com/q1'),
+        Document(text="The orchard harvest of pears was delayed by an unusually cold spring.", id_='https://example.com/pears')
+    ])
+
+def read_records(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+def test_every_question_is_answered(tmp_path):
+    output_path = tmp_path / 'answers.jsonl'
+
+    counts = answer_questions(make_index(), QUESTIONS, str(output_path), concurrency=2, batch_size=2)
+
+    assert counts == {'answered': 3, 'failed': 0, 'skipped': 0}
+    records = {record['id']: record for record in read_records(output_path)}
+    assert set(records) == {1, 2, 3}
+    assert records[2]['sources'][0]['source'] == 'https://example.com/pears'
+    assert "pears was delayed" in records[2]['answer']
+
+def test_resumed_run_skips_answered_questions(tmp_path):
+    output_path = tmp_path / 'answers.jsonl'
+    # An interrupted run: question 1 answered, question 2 failed, then a partial line
+    output_path.write_text(
+        json.dumps({'id': 1, 'answer': "Earlier answer"}) + '\n'
+        + json.dumps({'id': 2, 'error': "TimeoutError: "}) + '\n'
+        + '{"id": 3, "answ',
+        encoding='utf-8'
+    )
+
+    counts = answer_questions(make_index(), QUESTIONS, str(output_path))
+
+    assert counts == {'answered': 2, 'failed': 0, 'skipped': 1}
+    lines = output_path.read_text(encoding='utf-8').splitlines()
+    assert sorted(json.loads(line)['id'] for line in lines[3:]) == [2, 3]
+    # A further resume finds every question answered
+    assert answer_questions(make_index(), QUESTIONS, str(output_path)) == {'answered': 0, 'failed': 0, 'skipped': 3}
+
+def test_query_batches_bypass_the_embedding_cache(tmp_path, monkeypatch):
+    cache = CachedEmbedding(vector_search.get_embed_model(), cache_path=str(tmp_path / 'embeddings.db'))
+    monkeypatch.setattr(vector_search, 'embed_model', cache)
+
+    embeddings = embed_queries(["first question", "second question"])
+
+    assert embeddings.shape == (2, TEST_DIMENSION)
+    assert cache.cache_stats()['entries'] == 0
+    assert (cache.hits, cache.misses) == (0, 0)
@@ -0,0 +1,89 @@
+from llama_index.core import Document
+from llama_index.core.schema import MetadataMode, NodeRelationship
+
+from vector_search import DocumentChunker, count_tokens
+
+def paragraph(topic, sentences=3):
+    return ' '.join(f"The {topic} report covers item number {number} in some detail." for number in range(sentences))
+
+def test_strategy_follows_the_source_type():
+    chunker = DocumentChunker()
+
+    assert chunker.strategy_for(Document(text="", id_='https://example.com')) == 'markdown'
+    assert chunker.strategy_for(Document(text="", metadata={'file_name': 'report.pdf', 'page_label': '1'})) == 'page'
+    assert chunker.strategy_for(Document(text="", metadata={'file_name': 'notes.docx'})) == 'section'
+    assert chunker.strategy_for(Document(text="", metadata={'file_name': 'notes.txt'})) == 'sentence'
+    assert DocumentChunker(strategy='sentence').strategy_for(Document(text="", id_='https://example.com')) == 'sentence'
+
+def test_markdown_headings_start_chunks_with_their_section_path():
+    text = '\n\n'.join([
+        "# Results", paragraph("revenue"),
+        "## Services", paragraph("services"),
+        "# Outlook", paragraph("outlook")
+    ])
+    chunker = DocumentChunker(chunk_size=60, min_tokens=20)
+
+    nodes = chunker.chunk([Document(text=text, id_='https://example.com/q1')])
+
+    assert [node.metadata['section'] for node in nodes] == ['Results', 'Results > Services', 'Outlook']
+    assert nodes[1].text.startswith("## Services")
+    for node in nodes:
+        assert node.metadata['chunk_tokens'] == count_tokens(node.text) <= 60
+
+def test_chunks_are_linked_to_their_document_and_neighbors():
+    text = '\n\n'.join(paragraph(topic) for topic in ("revenue", "services", "outlook"))
+    nodes = DocumentChunker(chunk_size=60, min_tokens=20).chunk([Document(text=text, id_='https://example.com/q1')])
+
+    assert len(nodes) == 3
+    assert all(node.ref_doc_id == 'https://example.com/q1' for node in nodes)
+    assert nodes[0].prev_node is None and nodes[0].next_node.node_id == nodes[1].node_id
+    assert nodes[2].prev_node.node_id == nodes[1].node_id and nodes[2].next_node is None
+    # The links are stored as node relationships, which chunk expansion and persistence follow
+    assert NodeRelationship.PREVIOUS not in nodes[0].relationships
+    assert nodes[1].relationships[NodeRelationship.PREVIOUS].node_id == nodes[0].node_id
+    assert nodes[1].relationships[NodeRelationship.NEXT].node_id == nodes[2].node_id
+    assert nodes[1].relationships[NodeRelationship.SOURCE].node_id == 'https://example.com/q1'
+
+def test_chunk_tokens_are_not_embedded_or_sent_to_the_llm():
+    node = DocumentChunker().chunk([Document(text="Short text.", id_='https://example.com')])[0]
+
+    assert 'chunk_tokens' not in node.get_metadata_str(mode=MetadataMode.EMBED)
+    assert 'chunk_tokens' not in node.get_metadata_str(mode=MetadataMode.LLM)
+
+def test_large_tables_are_split_by_rows_with_the_header_repeated():
+    rows = [f"| Product {number} | {number * 10} units | {number * 3} dollars |" for number in range(30)]
+    table = '\n'.join(["| Product | Volume | Revenue |", "| --- | --- | --- |"] + rows)
+
+    nodes = DocumentChunker(chunk_size=80, min_tokens=20).chunk([Document(text=table, id_='https://example.com/table')])
+
+    assert len(nodes) > 1
+    for node in nodes:
+        assert node.text.startswith("| Product | Volume | Revenue |\n| --- | --- | --- |")
+        assert count_tokens(node.text) <= 80
+    assert sum(node.text.count('| Product ') for node in nodes) == 30 + len(nodes)
+
+def test_docx_sections_start_at_standalone_title_lines():
+    text = '\n\n'.join(["Quarterly Results", paragraph("revenue"), "Risk Factors", paragraph("risk")])
+
+    nodes = DocumentChunker(chunk_size=60, min_tokens=20).chunk([Document(text=text, metadata={'file_name': 'report.docx'})])
+
+    assert [node.metadata['section'] for node in nodes] == ['Quarterly Results', 'Risk Factors']
+
+def test_pdf_pages_ignore_markdown_headings():
+    text = "# Not a heading on a PDF page\n\n" + paragraph("revenue", sentences=1)
+
+    nodes = DocumentChunker(chunk_size=60, min_tokens=20).chunk([Document(text=text, metadata={'file_name': 'report.pdf', 'page_label': '3'})])
+
+    assert len(nodes) == 1
+    assert 'section' not in nodes[0].metadata
+    assert nodes[0].metadata['page_label'] == '3'
+
+def test_report_counts_chunks_per_strategy():
+    chunker = DocumentChunker(chunk_size=60, min_tokens=20)
+    chunker.chunk([Document(text=paragraph("revenue"), id_='https://example.com'), Document(text="Page text.", metadata={'file_name': 'a.pdf'})])
+
+    report = chunker.report()
+
+    assert set(report) == {'markdown', 'page'}
+    assert report['page']['documents'] == report['page']['chunks'] == 1
+    assert report['markdown']['tokens'] == count_tokens(paragraph("revenue"))
@@ -0,0 +1,65 @@
+from llama_index.core import Document
+
+import vector_search
+from vector_search import DocumentChunker, add_documents, create_vector_store, get_source_registry
+
+PARAGRAPH = "The orchard harvest of pears was delayed by an unusually cold spring."
+
+def page(url, text=PARAGRAPH):
+    return Document(text=text, id_=url)
+
+def pdf_page(file_name, page_label, text):
+    return Document(text=text, metadata={'file_name': file_name, 'page_label': page_label})
+
+def test_source_added_again_is_skipped():
+    index = create_vector_store([page('https://example.com/pears')])
+    dedup_stats = {}
+
+    add_documents(index, [page('https://example.com/pears')], dedup_stats)
+
+    assert dedup_stats == {'sources': ['https://example.com/pears'], 'documents': 0, 'chunks': 0}
+    assert index.vector_store.count == 1
+
+def test_repeated_documents_of_a_new_source_are_counted():
+    index = create_vector_store([])
+    dedup_stats = {}
+    pages = [pdf_page('report.pdf', '1', "Revenue grew."), pdf_page('report.pdf', '2', "Revenue grew."), pdf_page('report.pdf', '3', "Costs fell.")]
+
+    add_documents(index, pages, dedup_stats)
+
+    # Pages 1 and 2 of report.pdf have the same text, only one of them is added
+    assert dedup_stats == {'sources': [], 'documents': 1, 'chunks': 0}
+    assert get_source_registry(index).get('report.pdf')['chunk_count'] == 2
+
+def test_same_text_under_another_source_shares_the_embedding():
+    index = create_vector_store([page('https://example.com/pears')])
+    dedup_stats = {}
+
+    add_documents(index, [page('https://mirror.example.com/pears')], dedup_stats)
+
+    # Both sources are listed, the second one reuses the first one's vector
+    assert dedup_stats == {'sources': [], 'documents': 0, 'chunks': 1}
+    assert len(get_source_registry(index)) == 2
+    vectors = index.vector_store.vectors
+    assert (vectors[0] == vectors[1]).all()
+
+def test_repeated_footer_on_pdf_pages_is_embedded_once(monkeypatch):
+    monkeypatch.setattr(vector_search, 'document_chunker', DocumentChunker(chunk_size=40, min_tokens=5))
+    embedded = []
+    embed_nodes = vector_search.embedding_scheduler.embed_nodes
+    monkeypatch.setattr(vector_search.embedding_scheduler, 'embed_nodes', lambda nodes: embedded.extend(node.text for node in nodes) or embed_nodes(nodes))
+    footer = "This press release contains forward-looking statements that involve risks and uncertainties."
+    index = create_vector_store([])
+    dedup_stats = {}
+
+    add_documents(index, [
+        pdf_page('release.pdf', '1', "Revenue grew by ten percent in the first quarter, driven by strong demand in every region. " * 2 + f"\n\n{footer}"),
+        pdf_page('release.pdf', '2', "Costs fell by five percent in the second quarter, as the company closed two older plants. " * 2 + f"\n\n{footer}")
+    ], dedup_stats)
+
+    # The footer chunks differ only by page label, the second one reuses the first one's vector
+    assert embedded.count(footer) == 1
+    assert dedup_stats['chunks'] == 1
+    rows = [row for row, node in enumerate(index.docstore.get_nodes(index.vector_store.node_ids)) if node.text == footer]
+    assert len(rows) == 2
+    assert (index.vector_store.vectors[rows[0]] == index.vector_store.vectors[rows[1]]).all()
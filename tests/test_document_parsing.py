@@ -0,0 +1,214 @@
+import asyncio
+import io
+import time
+import zipfile
+
+import pytest
+
+import vector_search
+from document_parser import parse_document_bytes
+from vector_search import (
+    IngestJob, KnowledgeBaseManager, aadd_uploaded_files, add_uploaded_files, aiter_document_data, create_vector_store,
+    file_hash, get_source_registry, iter_document_data, remove_source
+)
+
+def pdf_bytes(pages):
+    """
+    A minimal PDF with one line of text per page
+    """
+    page_ids = [4 + 2 * number for number in range(len(pages))]
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [" + b" ".join(b"%d 0 R" % page_id for page_id in page_ids) + b"] /Count %d >>" % len(pages),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"
+    ]
+    for page_id, text in zip(page_ids, pages):
+        stream = b"BT /F1 12 Tf 72 720 Td (" + text.encode() + b") Tj ET"
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % (page_id + 1))
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+    pdf, offsets = b"%PDF-1.4\n", []
+    for number, content in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n" % number + content + b"\nendobj\n"
+    xref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1) + b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    return pdf + b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+
+def docx_bytes(text):
+    """
+    A minimal DOCX with one paragraph
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as docx:
+        docx.writestr('[Content_Types].xml', '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types"/>')
+        docx.writestr('word/document.xml', (
+            '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+            f'<w:body><w:p><w:r><w:t>{text}</w:t></w:r></w:p></w:body></w:document>'
+        ))
+    return buffer.getvalue()
+
+@pytest.fixture
+def parse_pool():
+    """
+    Shut down the parser pool started by a test
+    """
+    yield
+    with vector_search._parse_executor_lock:
+        if vector_search._parse_idle_timer is not None:
+            vector_search._parse_idle_timer.cancel()
+        executor, vector_search._parse_executor = vector_search._parse_executor, None
+    if executor is not None:
+        executor.shutdown(wait=True)
+
+def test_parse_document_bytes_extracts_pages_and_paragraphs():
+    pages = parse_document_bytes('report.pdf', pdf_bytes(['First page text', 'Second page text']))
+    assert [text.strip() for text, _ in pages] == ['First page text', 'Second page text']
+    assert [metadata['page_label'] for _, metadata in pages] == ['1', '2']
+
+    assert parse_document_bytes('notes.docx', docx_bytes('Meeting notes'))[0][0].strip() == 'Meeting notes'
+    with pytest.raises(ValueError):
+        parse_document_bytes('notes.txt', b'plain text')
+
+def test_files_are_parsed_through_the_process_pool(parse_pool):
+    results = {result['file_name']: result for result in iter_document_data([
+        ('report.pdf', pdf_bytes(['First page text', 'Second page text'])),
+        ('notes.docx', docx_bytes('Meeting notes')),
+        ('notes.txt', b'plain text')
+    ])}
+
+    assert [document.metadata['page_label'] for document in results['report.pdf']['documents']] == ['1', '2']
+    assert results['report.pdf']['documents'][0].metadata['file_type'] == 'application/pdf'
+    assert results['notes.docx']['documents'][0].text.strip() == 'Meeting notes'
+    assert results['notes.txt']['documents'] == []
+    assert results['notes.txt']['error'].startswith('ValueError')
+
+def test_async_parsing_yields_every_file(parse_pool):
+    async def parse():
+        return [result async for result in aiter_document_data([('a.docx', docx_bytes('A')), ('b.docx', docx_bytes('B'))])]
+
+    results = asyncio.run(parse())
+
+    assert sorted(result['file_name'] for result in results) == ['a.docx', 'b.docx']
+    assert all(result['error'] is None for result in results)
+
+def test_uploads_are_inserted_in_batches_of_files(parse_pool, monkeypatch):
+    index = create_vector_store([])
+    batches = []
+    add_documents = vector_search.add_documents
+    monkeypatch.setattr(vector_search, 'add_documents', lambda index, documents, *args: batches.append(len(documents)) or add_documents(index, documents, *args))
+
+    results = list(add_uploaded_files(index, [
+        ('report.pdf', pdf_bytes(['Page one', 'Page two', 'Page three'])),
+        ('notes.docx', docx_bytes('Meeting notes'))
+    ], batch_size=2))
+
+    # Both files in one batch, not a batch per two pages
+    assert [result['error'] for result in results] == [None, None]
+    assert batches == [4]
+    assert {entry['source'] for entry in get_source_registry(index).sources()} == {'report.pdf', 'notes.docx'}
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+def test_idle_pool_is_shut_down_and_restarted(parse_pool, monkeypatch):
+    monkeypatch.setattr(vector_search, 'DOCUMENT_PARSE_IDLE_TIMEOUT', 0.1)
+    list(iter_document_data([('a.docx', docx_bytes('A'))]))
+    executor = vector_search._parse_executor
+
+    wait_for(lambda: vector_search._parse_executor is None)
+    result, = iter_document_data([('b.docx', docx_bytes('B'))])
+
+    assert result['error'] is None
+    assert vector_search._parse_executor not in (None, executor)
+
+def test_pool_is_replaced_after_a_worker_is_killed(parse_pool):
+    list(iter_document_data([('a.docx', docx_bytes('A'))]))
+    executor = vector_search._parse_executor
+    for process in list(executor._processes.values()):
+        process.kill()
+        process.join()
+
+    # The file submitted when the pool breaks may fail, later files are parsed by a new pool
+    results = list(iter_document_data([('b.docx', docx_bytes('B'))]))
+    if results[0]['error'] is not None:
+        assert results[0]['error'].startswith('BrokenProcessPool')
+        results = list(iter_document_data([('b.docx', docx_bytes('B'))]))
+
+    assert results[0]['error'] is None
+    assert vector_search._parse_executor is not executor
+
+def test_async_uploads_are_indexed(parse_pool):
+    index = create_vector_store([])
+
+    async def ingest():
+        return [result async for result in aadd_uploaded_files(index, [('a.docx', docx_bytes('Alpha')), ('b.docx', docx_bytes('Beta'))], batch_size=1)]
+
+    results = asyncio.run(ingest())
+
+    assert [result['error'] for result in results] == [None, None]
+    assert {entry['source'] for entry in get_source_registry(index).sources()} == {'a.docx', 'b.docx'}
+
+def test_ingest_job_parses_uploaded_files(parse_pool):
+    index = create_vector_store([])
+    job = IngestJob(index, files=[('report.pdf', pdf_bytes(['Quarterly revenue'])), ('notes.txt', b'plain text')]).start()
+
+    assert job.wait(timeout=60)
+    assert (job.status, job.completed, job.failed) == ('done', 2, ['notes.txt'])
+    assert job.source_type == 'Document'
+    assert [entry['source'] for entry in get_source_registry(index).sources()] == ['report.pdf']
+
+@pytest.fixture
+def parsed_files(monkeypatch):
+    """
+    Names of the files sent to the parser pool
+    """
+    names = []
+    submit_parse = vector_search._submit_parse
+    monkeypatch.setattr(vector_search, '_submit_parse', lambda file_name, *args: names.append(file_name) or submit_parse(file_name, *args))
+    return names
+
+def test_known_files_are_skipped_before_parsing(parse_pool, parsed_files):
+    index = create_vector_store([])
+    report = pdf_bytes(['Quarterly revenue', 'Regional sales'])
+    list(add_uploaded_files(index, [('report.pdf', report)]))
+    dedup_stats = {}
+
+    results = list(add_uploaded_files(index, [
+        ('report-copy.pdf', report), ('notes.docx', docx_bytes('Meeting notes')), ('notes-copy.docx', docx_bytes('Meeting notes'))
+    ], dedup_stats=dedup_stats))
+
+    # The same bytes under another name, or twice in one upload, are not parsed again
+    assert parsed_files == ['report.pdf', 'notes.docx']
+    assert dedup_stats['sources'] == ['report-copy.pdf', 'notes-copy.docx']
+    assert all(result['error'] is None for result in results)
+    assert sorted(entry['source'] for entry in get_source_registry(index).sources()) == ['notes.docx', 'report.pdf']
+
+def test_removed_file_is_parsed_again(parse_pool, parsed_files):
+    index = create_vector_store([])
+    list(add_uploaded_files(index, [('notes.docx', docx_bytes('Meeting notes'))]))
+
+    remove_source(index, 'notes.docx')
+    list(add_uploaded_files(index, [('notes.docx', docx_bytes('Meeting notes'))]))
+
+    assert parsed_files == ['notes.docx', 'notes.docx']
+    assert [entry['source'] for entry in get_source_registry(index).sources()] == ['notes.docx']
+
+def test_known_files_are_remembered_by_saved_knowledge_bases(parse_pool, tmp_path):
+    manager = KnowledgeBaseManager(root=str(tmp_path))
+    index = manager.create('team-docs')
+    first, second = docx_bytes('Meeting notes'), docx_bytes('Board minutes')
+
+    list(add_uploaded_files(index, [('first.docx', first)]))
+    manager.save_index(index)  # Appended to the change journal
+
+    async def ingest():
+        return [result async for result in aadd_uploaded_files(index, [('second.docx', second)])]
+
+    asyncio.run(ingest())
+    manager.save_index(index)
+
+    reopened = KnowledgeBaseManager(root=str(tmp_path)).open('team-docs').vector_store
+    assert reopened.has_document(file_hash(first)) and reopened.has_document(file_hash(second))
@@ -0,0 +1,72 @@
+import asyncio
+
+from pydantic import Field
+
+import benchmark
+from vector_search import CachedEmbedding
+
+from conftest import TEST_DIMENSION
+
+class CountingEmbedding(benchmark.FakeEmbedding):
+    """
+    Fake embedding model recording every text it embeds
+    """
+    embedded: list = Field(default_factory=list)
+
+    def _get_text_embedding(self, text):
+        self.embedded.append(text)
+        return super()._get_text_embedding(text)
+
+def make_cache(tmp_path, max_entries=100):
+    model = CountingEmbedding(dimension=TEST_DIMENSION)
+    return model, CachedEmbedding(model, cache_path=str(tmp_path / 'embeddings.db'), max_entries=max_entries)
+
+def test_repeated_texts_are_embedded_once(tmp_path):
+    model, cache = make_cache(tmp_path)
+    first = cache.get_text_embedding_batch(['apples', 'pears', 'apples'])
+    second = cache.get_text_embedding_batch(['pears', 'apples'])
+
+    assert model.embedded == ['apples', 'pears']
+    assert first[0] == first[2] == second[1]
+    assert first[1] == second[0]
+    # Repeats within one batch are looked up before the batch is embedded
+    assert (cache.hits, cache.misses) == (2, 3)
+
+def test_cached_embeddings_match_the_model(tmp_path):
+    model, cache = make_cache(tmp_path)
+    cache.get_text_embedding_batch(['quarterly revenue'])
+    cached = cache.get_text_embedding('quarterly revenue')
+
+    assert cached == model._get_text_embedding('quarterly revenue')
+
+def test_cache_persists_across_instances(tmp_path):
+    _, cache = make_cache(tmp_path)
+    cache.get_text_embedding_batch(['apples', 'pears'])
+
+    model, reopened = make_cache(tmp_path)
+    reopened.get_text_embedding_batch(['apples', 'pears'])
+
+    assert model.embedded == []
+    assert reopened.cache_stats() == {'hits': 2, 'misses': 0, 'hit_rate': 1.0, 'entries': 2}
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    model, cache = make_cache(tmp_path, max_entries=2)
+    cache.get_text_embedding_batch(['a'])
+    cache.get_text_embedding_batch(['b'])
+    cache.get_text_embedding_batch(['a'])  # 'b' is now the least recently used
+    cache.get_text_embedding_batch(['c'])
+    model.embedded.clear()
+
+    cache.get_text_embedding_batch(['a', 'b', 'c'])
+
+    assert model.embedded == ['b']
+    assert cache.cache_stats()['entries'] == 2
+
+def test_async_embeddings_use_the_cache(tmp_path):
+    model, cache = make_cache(tmp_path)
+    cache.get_text_embedding_batch(['apples'])
+
+    embeddings = asyncio.run(cache.aget_text_embedding_batch(['apples', 'pears']))
+
+    assert model.embedded == ['apples', 'pears']
+    assert len(embeddings) == 2
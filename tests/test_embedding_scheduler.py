@@ -0,0 +1,161 @@
+import json
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pytest
+from pydantic import Field
+
+import benchmark
+import vector_search
+from vector_search import EmbeddingScheduler
+
+from conftest import TEST_DIMENSION
+
+class EmbeddingHandler(BaseHTTPRequestHandler):
+    """
+    Local OpenAI-compatible embedding API: POST /embeddings answers with the queued error statuses first,
+    then with fake embeddings of the input texts
+    """
+    errors = deque()
+    requests = []
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        EmbeddingHandler.requests.append(body['input'])
+        if EmbeddingHandler.errors:
+            self.send_response(EmbeddingHandler.errors.popleft())
+            response = {'error': {'message': 'Try again later', 'type': 'requests', 'code': None}}
+        else:
+            self.send_response(200)
+            model = benchmark.FakeEmbedding(dimension=TEST_DIMENSION)
+            response = {
+                'object': 'list',
+                'data': [{'object': 'embedding', 'index': number, 'embedding': model._embed(text)} for number, text in enumerate(body['input'])],
+                'model': body['model'],
+                'usage': {'prompt_tokens': 1, 'total_tokens': 1}
+            }
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(response).encode())
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def openai_embedding(monkeypatch, no_backoff):
+    """
+    The production OpenAI embedding client pointed at the local embedding API
+    """
+    EmbeddingHandler.errors.clear()
+    EmbeddingHandler.requests.clear()
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), EmbeddingHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    monkeypatch.setattr(vector_search, 'OPENAI_API_KEY', 'test')
+    monkeypatch.setattr(vector_search, 'OPENAI_API_BASE', f'http://127.0.0.1:{httpd.server_port}')
+    yield vector_search._create_openai_embedding()
+    httpd.shutdown()
+    httpd.server_close()
+
+class RateLimitError(Exception):
+    status_code = 429
+
+class RecordingEmbedding(benchmark.FakeEmbedding):
+    """
+    Fake embedding model recording the size of every request, failing the first rate_limited requests with HTTP 429
+    """
+    requests: list = Field(default_factory=list)
+    rate_limited: int = 0
+    error: Exception = None
+
+    async def _aget_text_embeddings(self, texts):
+        self.requests.append(len(texts))
+        if self.error is not None:
+            raise self.error
+        if self.rate_limited:
+            self.rate_limited -= 1
+            raise RateLimitError("HTTP 429 Too Many Requests")
+        return [self._embed(text) for text in texts]
+
+def texts(count):
+    return [f"chunk number {number} with a few words" for number in range(count)]
+
+def test_texts_are_packed_into_token_budgeted_batches():
+    model = RecordingEmbedding(dimension=TEST_DIMENSION)
+    scheduler = EmbeddingScheduler(model, batch_tokens=40, max_batch_size=100)
+
+    embeddings = scheduler.embed(texts(20))
+
+    assert embeddings == [model._embed(text) for text in texts(20)]
+    assert len(model.requests) == scheduler.last_run['batches'] == scheduler.last_run['requests'] > 1
+    assert sum(model.requests) == 20
+
+def test_batches_respect_the_input_limit():
+    model = RecordingEmbedding(dimension=TEST_DIMENSION)
+    scheduler = EmbeddingScheduler(model, batch_tokens=10 ** 6, max_batch_size=8)
+
+    scheduler.embed(texts(20))
+
+    assert sorted(model.requests) == [4, 8, 8]
+
+def test_rate_limited_requests_are_retried_by_the_scheduler(openai_embedding):
+    EmbeddingHandler.errors.extend([429, 429])
+    scheduler = EmbeddingScheduler(openai_embedding, batch_tokens=10 ** 6, concurrency=1)
+
+    embeddings = scheduler.embed(texts(3))
+
+    model = benchmark.FakeEmbedding(dimension=TEST_DIMENSION)
+    assert np.allclose(embeddings, [model._embed(text) for text in texts(3)])
+    # Every 429 reaches the scheduler: the client does not retry on its own
+    assert len(EmbeddingHandler.requests) == 3
+    assert scheduler.last_run['rate_limited'] == 2
+    assert scheduler.last_run['requests'] == 3
+
+def test_server_errors_are_retried_by_the_scheduler(openai_embedding):
+    EmbeddingHandler.errors.append(503)
+    scheduler = EmbeddingScheduler(openai_embedding, batch_tokens=10 ** 6, concurrency=1)
+
+    scheduler.embed(texts(3))
+
+    assert len(EmbeddingHandler.requests) == 2
+    assert scheduler.last_run['retried'] == 1
+    assert scheduler.last_run['rate_limited'] == 0
+
+def test_rate_limit_errors_are_raised_after_the_last_retry(openai_embedding):
+    EmbeddingHandler.errors.extend([429] * 3)
+    scheduler = EmbeddingScheduler(openai_embedding, batch_tokens=10 ** 6, max_retries=2)
+
+    with pytest.raises(Exception) as error:
+        scheduler.embed(texts(3))
+
+    assert EmbeddingScheduler._is_rate_limit(error.value)
+    assert len(EmbeddingHandler.requests) == 3
+
+def test_other_errors_are_raised_without_retrying():
+    model = RecordingEmbedding(dimension=TEST_DIMENSION, error=ValueError("bad input"))
+    scheduler = EmbeddingScheduler(model)
+
+    with pytest.raises(ValueError):
+        scheduler.embed(texts(3))
+    assert model.requests == [3]
+
+def test_synchronous_calls_share_one_event_loop():
+    scheduler = EmbeddingScheduler(RecordingEmbedding(dimension=TEST_DIMENSION))
+
+    scheduler.embed(texts(2))
+    loop = scheduler._loop
+    scheduler.embed(texts(2))
+
+    assert scheduler._loop is loop and loop.is_running()
+
+def test_nodes_without_embedding_are_embedded():
+    from llama_index.core.schema import TextNode
+    model = RecordingEmbedding(dimension=TEST_DIMENSION)
+    nodes = [TextNode(text="first"), TextNode(text="second", embedding=[0.0] * TEST_DIMENSION)]
+
+    EmbeddingScheduler(model).embed_nodes(nodes)
+
+    assert model.requests == [1]
+    assert nodes[0].embedding == model._embed(nodes[0].get_content(metadata_mode='embed'))
+    assert nodes[1].embedding == [0.0] * TEST_DIMENSION
@@ -0,0 +1,56 @@
+from llama_index.core import Document
+from pydantic import Field
+
+import benchmark
+import vector_search
+from vector_search import add_documents, create_vector_store, get_source_registry, remove_source, search_vector_stores
+
+from conftest import TEST_DIMENSION
+
+class CountingEmbedding(benchmark.FakeEmbedding):
+    """
+    Fake embedding model counting the texts it embeds
+    """
+    embedded: list = Field(default_factory=list)
+
+    def _get_text_embeddings(self, texts):
+        self.embedded.extend(texts)
+        return [self._embed(text) for text in texts]
+
+    async def _aget_text_embeddings(self, texts):
+        return self._get_text_embeddings(texts)
+
+def page(url, text):
+    return Document(text=text, id_=url)
+
+def test_adding_a_source_embeds_only_its_chunks(monkeypatch):
+    model = CountingEmbedding(dimension=TEST_DIMENSION)
+    monkeypatch.setattr(vector_search, 'embed_model', model)
+    index = create_vector_store([page('https://example.com/a', "Apples grow in orchards."), page('https://example.com/b', "Bananas grow in plantations.")])
+    model.embedded.clear()
+    store = index.vector_store
+    version = store.version
+
+    add_documents(index, [page('https://example.com/c', "Cherries ripen in early summer.")])
+
+    assert len(model.embedded) == 1 and "Cherries" in model.embedded[0]
+    assert store.count == 3
+    assert store.version > version
+
+def test_removed_source_is_no_longer_retrieved():
+    index = create_vector_store([page('https://example.com/a', "Apples grow in orchards."), page('https://example.com/b', "Bananas grow in plantations.")])
+    query = vector_search.get_embed_model().get_query_embedding("Apples grow in orchards.")
+
+    remove_source(index, 'https://example.com/a')
+
+    assert 'https://example.com/a' not in get_source_registry(index)
+    assert index.vector_store.count == 1
+    assert index.docstore.get_ref_doc_info('https://example.com/a') is None
+    assert [result['source'] for result in search_vector_stores([index], [query])[0]] == ['https://example.com/b']
+
+def test_removing_an_unknown_source_changes_nothing():
+    index = create_vector_store([page('https://example.com/a', "Apples grow in orchards.")])
+    version = index.vector_store.version
+
+    assert remove_source(index, 'https://example.com/missing') is index
+    assert index.vector_store.version == version
@@ -0,0 +1,141 @@
+import gc
+import json
+import threading
+
+import pytest
+from llama_index.core import Document
+
+import vector_search
+from vector_search import KnowledgeBaseManager, add_documents, get_source_registry, remove_source
+
+def add_page(manager, index, url):
+    add_documents(index, [Document(text=f"Text of the page at {url}.", id_=url)])
+    manager.save_index(index)
+
+def sources(index):
+    return [entry['source'] for entry in get_source_registry(index).sources()]
+
+def test_knowledge_bases_are_persisted_and_reopened(tmp_path):
+    manager = KnowledgeBaseManager(root=str(tmp_path))
+    add_page(manager, manager.create('team-docs'), 'https://example.com/a')
+
+    reopened = KnowledgeBaseManager(root=str(tmp_path))
+
+    assert reopened.names() == ['default', 'team-docs']
+    assert sources(reopened.open('team-docs')) == ['https://example.com/a']
+    assert reopened.loads == 1
+
+def test_least_recently_used_knowledge_base_is_evicted_and_reloaded(tmp_path):
+    # Every knowledge base is above the limit, so only the most recently used one stays loaded
+    manager = KnowledgeBaseManager(root=str(tmp_path), memory_limit_mb=0.0001)
+    add_page(manager, manager.create('first'), 'https://example.com/a')
+    add_page(manager, manager.create('second'), 'https://example.com/b')
+
+    assert list(manager.memory_usage()) == ['second']
+    assert manager.evictions == 1
+
+    gc.collect()  # No session holds the evicted index anymore
+    first = manager.open('first')
+
+    assert manager.loads == 1
+    assert sources(first) == ['https://example.com/a']
+    assert list(manager.memory_usage()) == ['first']
+
+def test_evicted_index_still_in_use_is_taken_back(tmp_path):
+    manager = KnowledgeBaseManager(root=str(tmp_path), memory_limit_mb=0.0001)
+    first = manager.create('first')
+    manager.create('second')
+
+    # A session still using the evicted index keeps saving its changes under its name
+    add_page(manager, first, 'https://example.com/a')
+
+    assert manager.open('first') is first
+    assert manager.loads == 0
+    assert sources(KnowledgeBaseManager(root=str(tmp_path)).open('first')) == ['https://example.com/a']
+
+def test_invalid_and_unknown_names_are_rejected(tmp_path):
+    manager = KnowledgeBaseManager(root=str(tmp_path))
+    manager.create('team-docs')
+
+    for name in ('default', '../escape', ''):
+        with pytest.raises(ValueError):
+            manager.create(name)
+    with pytest.raises(ValueError):
+        manager.create('team-docs')
+    with pytest.raises(KeyError):
+        manager.open('missing')
+
+def saved_files(path):
+    return json.loads((path / 'nodes.json').read_text())['files']
+
+def test_changes_are_appended_without_rewriting_the_knowledge_base(tmp_path):
+    manager = KnowledgeBaseManager(root=str(tmp_path))
+    index = manager.create('team-docs')
+    add_page(manager, index, 'https://example.com/a')
+    files = saved_files(tmp_path / 'team-docs')
+    nodes_json = (tmp_path / 'team-docs' / 'nodes.json').read_bytes()
+
+    add_page(manager, index, 'https://example.com/b')
+    remove_source(index, 'https://example.com/a')
+    manager.save_index(index)  # remove_source saves through the shared manager
+
+    assert (tmp_path / 'team-docs' / 'nodes.json').read_bytes() == nodes_json
+    assert len((tmp_path / 'team-docs' / files['journal_entries']).read_text().splitlines()) == 3
+    reopened = KnowledgeBaseManager(root=str(tmp_path)).open('team-docs')
+    assert sources(reopened) == ['https://example.com/b']
+    assert reopened.vector_store.count == index.vector_store.count
+    assert reopened.vector_store.search(index.vector_store.vectors[:1], 1)[0][0][0] == index.vector_store.node_ids[0]
+
+def test_large_journal_is_compacted_into_a_full_save(tmp_path, monkeypatch):
+    monkeypatch.setattr(vector_search, 'KNOWLEDGE_BASE_JOURNAL_MAX_ENTRIES', 2)
+    manager = KnowledgeBaseManager(root=str(tmp_path))
+    index = manager.create('team-docs')
+    first_files = saved_files(tmp_path / 'team-docs')
+
+    for page in 'abc':
+        add_page(manager, index, f'https://example.com/{page}')
+
+    # Two appended changes, then the third rewrites the knowledge base with an empty journal
+    files = saved_files(tmp_path / 'team-docs')
+    assert files != first_files
+    assert not (tmp_path / 'team-docs' / files['journal_entries']).exists()
+    reopened = KnowledgeBaseManager(root=str(tmp_path)).open('team-docs')
+    assert sources(reopened) == [f'https://example.com/{page}' for page in 'abc']
+
+def test_interrupted_journal_entry_is_ignored(tmp_path):
+    manager = KnowledgeBaseManager(root=str(tmp_path))
+    index = manager.create('team-docs')
+    add_page(manager, index, 'https://example.com/a')
+    files = saved_files(tmp_path / 'team-docs')
+    with open(tmp_path / 'team-docs' / files['journal_entries'], 'a') as f:
+        f.write('{"deleted": [')
+
+    assert sources(KnowledgeBaseManager(root=str(tmp_path)).open('team-docs')) == ['https://example.com/a']
+
+def test_store_lock_is_not_held_while_writing(tmp_path, monkeypatch):
+    manager = KnowledgeBaseManager(root=str(tmp_path))
+    index = manager.create('team-docs')
+    lock_free = []
+
+    def take_lock():
+        acquired = index.vector_store.lock.acquire(timeout=1)
+        if acquired:
+            index.vector_store.lock.release()
+        lock_free.append(acquired)
+
+    def check_lock(write):
+        def wrapper(*args):
+            # Another thread (a search or an ingest) can take the store lock during the write
+            thread = threading.Thread(target=take_lock)
+            thread.start()
+            thread.join()
+            return write(*args)
+        return wrapper
+
+    monkeypatch.setattr(vector_search, '_write_vector_store', check_lock(vector_search._write_vector_store))
+    monkeypatch.setattr(vector_search, '_append_vector_store_changes', check_lock(vector_search._append_vector_store_changes))
+    add_page(manager, index, 'https://example.com/a')
+    monkeypatch.setattr(vector_search, 'KNOWLEDGE_BASE_JOURNAL_MAX_ENTRIES', 0)
+    add_page(manager, index, 'https://example.com/b')
+
+    assert lock_free == [True, True]
@@ -0,0 +1,63 @@
+import os
+
+import numpy as np
+from llama_index.core import Document
+
+import vector_search
+from vector_search import add_documents, create_vector_store, get_source_registry, load_vector_store, remove_source, save_vector_store, search_vector_stores
+
+DOCUMENTS = [
+    Document(text="Apple reported quarterly revenue of 90 billion dollars, driven by iPhone sales.", id_='https://example.com/q1'),
+    Document(text="The orchard harvest of pears was delayed by an unusually cold spring.", id_='https://example.com/pears'),
+    Document(text="Services revenue reached a new all-time high.", metadata={'file_name': 'report.pdf', 'page_label': '1'})
+]
+
+def make_index():
+    return create_vector_store([Document(text=document.text, id_=document.id_, metadata=dict(document.metadata)) for document in DOCUMENTS])
+
+def sources(results):
+    return [result['source'] for result in results]
+
+def test_saved_index_loads_with_the_same_vectors_and_nodes(tmp_path):
+    index = make_index()
+    save_vector_store(index, str(tmp_path))
+
+    loaded = load_vector_store(str(tmp_path))
+
+    assert isinstance(loaded.vector_store.vectors, np.memmap)
+    assert loaded.vector_store.node_ids == index.vector_store.node_ids
+    assert np.array_equal(loaded.vector_store.vectors, index.vector_store.vectors)
+    assert [entry['source'] for entry in get_source_registry(loaded).sources()] == [entry['source'] for entry in get_source_registry(index).sources()]
+    for node in index.docstore.get_nodes(index.vector_store.node_ids):
+        assert loaded.docstore.get_node(node.node_id).text == node.text
+    query = vector_search.get_embed_model().get_query_embedding("pear harvest")
+    assert sources(search_vector_stores([loaded], [query])[0]) == sources(search_vector_stores([index], [query])[0])
+
+def test_memory_mapped_index_accepts_adds_and_deletes(tmp_path):
+    save_vector_store(make_index(), str(tmp_path))
+    index = load_vector_store(str(tmp_path))
+
+    add_documents(index, [Document(text="Cherries ripen in early summer.", id_='https://example.com/cherries')])
+    remove_source(index, 'https://example.com/pears')
+
+    assert index.vector_store.count == 3
+    assert 'https://example.com/pears' not in get_source_registry(index)
+    query = vector_search.get_embed_model().get_query_embedding("Cherries ripen in early summer.")
+    assert sources(search_vector_stores([index], [query])[0])[0] == 'https://example.com/cherries'
+
+    # The changed index saves and loads like a new one
+    save_vector_store(index, str(tmp_path))
+    reloaded = load_vector_store(str(tmp_path))
+    assert reloaded.vector_store.node_ids == index.vector_store.node_ids
+    assert np.array_equal(reloaded.vector_store.vectors, index.vector_store.vectors)
+    assert reloaded.vector_store.has_document(next(iter(index.vector_store.document_hashes)))
+
+def test_each_save_keeps_only_the_previous_generation(tmp_path):
+    index = make_index()
+    for _ in range(3):
+        save_vector_store(index, str(tmp_path))
+
+    vector_files = [file_name for file_name in os.listdir(tmp_path) if file_name.endswith('.f32')]
+
+    assert len(vector_files) == 2
+    assert load_vector_store(str(tmp_path)).vector_store.count == index.vector_store.count
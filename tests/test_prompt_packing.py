@@ -0,0 +1,96 @@
+import json
+
+from llama_index.core.llms import ChatMessage
+
+from vector_search import _trim_overlap, compact_chat_history, count_tokens, pack_context
+
+def result(text, source='report.pdf', score=0.9, **extra):
+    return {'score': score, 'source': source, 'text': text, **extra}
+
+def item_tokens(item):
+    return count_tokens(json.dumps(item, separators=(',', ':'), ensure_ascii=False))
+
+def test_trim_overlap_removes_the_repeated_prefix():
+    previous = "Revenue grew in every region. Services reached a new all-time high this quarter, led by subscriptions."
+    text = "Services reached a new all-time high this quarter, led by subscriptions. Margins improved as well."
+
+    assert _trim_overlap(previous, text) == " Margins improved as well."
+    assert _trim_overlap(previous, "Margins improved as well.") == "Margins improved as well."
+    # The longest overlap wins when the start of the text appears more than once
+    assert _trim_overlap("ab ab ab", "ab ab cd", probe_length=2) == " cd"
+
+def test_pack_context_keeps_the_best_results_within_the_budget():
+    results = [result(f"Chunk {number} about quarterly revenue " * 5, source=f'{number}.pdf', score=1 - number / 10) for number in range(6)]
+    budget = 3 * item_tokens({'score': 1.0, 'source': '0.pdf', 'text': results[0]['text']}) + 5
+
+    packed, tokens = pack_context(results, token_budget=budget)
+
+    assert [item['source'] for item in packed] == ['0.pdf', '1.pdf', '2.pdf']
+    assert tokens == sum(item_tokens(item) for item in packed) <= budget
+
+def test_pack_context_drops_duplicates_and_trims_overlapping_neighbors():
+    first = "Revenue grew in every region. Services reached a new all-time high this quarter, led by subscriptions."
+    second = "Services reached a new all-time high this quarter, led by subscriptions. Margins improved as well."
+    third = "Services reached a new all-time high this quarter, led by subscriptions. Costs were flat."
+
+    packed, _ = pack_context([
+        result(first), result(first, score=0.8), result(second, score=0.7),
+        result(second, source='copy.pdf', score=0.6), result(third, source='other.pdf', score=0.5)
+    ])
+
+    # Repeated chunks are dropped (also from another source), overlaps are trimmed within a source only
+    assert [(item['source'], item['text']) for item in packed] == [
+        ('report.pdf', first), ('report.pdf', " Margins improved as well."), ('other.pdf', third)
+    ]
+
+def test_pack_context_expands_chunks_with_the_budget_left():
+    chunk = "Services reached a new all-time high."
+    expanded = "Revenue grew in every region. Services reached a new all-time high. Margins improved as well."
+    results = [result(chunk, expanded_text=expanded)]
+
+    packed, _ = pack_context(results)
+    assert packed[0]['text'] == expanded
+
+    # Without room for the neighbors the chunk itself is kept
+    packed, _ = pack_context(results, token_budget=item_tokens({'score': 0.9, 'source': 'report.pdf', 'text': chunk}))
+    assert packed[0]['text'] == chunk
+
+def test_short_history_is_kept_as_is():
+    history = [ChatMessage(role='user', content="What was revenue?"), ChatMessage(role='assistant', content="90 billion dollars.")]
+
+    messages, tokens, compacted = compact_chat_history(history)
+
+    assert messages == history
+    assert tokens == sum(count_tokens(message.content) for message in history)
+    assert compacted == 0
+
+def test_history_over_budget_is_compacted_into_the_earlier_questions():
+    history = []
+    for number in range(6):
+        history.append(ChatMessage(role='user', content=f"Question {number} about revenue?"))
+        history.append(ChatMessage(role='assistant', content=f"Answer {number} " + "with details " * 20))
+    budget = sum(count_tokens(message.content) for message in history[-4:])
+
+    messages, tokens, compacted = compact_chat_history(history, token_budget=budget)
+
+    # The last two turns are kept, the earlier questions are listed in the order they were asked, without the answers
+    assert messages[1:] == history[-4:]
+    assert messages[0].role == 'system'
+    assert messages[0].content == (
+        'Earlier in this conversation the user asked: '
+        '"Question 0 about revenue?"; "Question 1 about revenue?"; "Question 2 about revenue?"; "Question 3 about revenue?"'
+    )
+    assert compacted == 8
+    assert tokens == sum(count_tokens(message.content) for message in messages)
+
+def test_oldest_earlier_questions_are_dropped_beyond_their_budget():
+    history = [ChatMessage(role='user', content=f"Question {number} about revenue?") for number in range(6)]
+    listed = 'Earlier in this conversation the user asked: "Question 3 about revenue?"; "Question 4 about revenue?"'
+
+    messages, _, _ = compact_chat_history(history, token_budget=count_tokens(history[-1].content), summary_token_budget=count_tokens(listed))
+
+    # The most recent questions that fit are kept, still oldest first
+    assert [message.content for message in messages] == [listed, "Question 5 about revenue?"]
+    # No message at all when not even the latest earlier question fits
+    messages, _, _ = compact_chat_history(history, token_budget=count_tokens(history[-1].content), summary_token_budget=5)
+    assert [message.content for message in messages] == ["Question 5 about revenue?"]
@@ -0,0 +1,56 @@
+import os
+
+import numpy as np
+import pytest
+from llama_index.core import StorageContext, VectorStoreIndex
+
+import benchmark
+import vector_store
+from vector_search import MatrixVectorStore, get_embed_model, measure_quantization_recall
+
+NUM_CHUNKS = 10000
+DIMENSION = 128
+
+@pytest.fixture(autouse=True)
+def spill_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(vector_store, 'QUANTIZATION_SPILL_DIR', str(tmp_path))
+    return tmp_path
+
+def make_index(vectors, quantization):
+    node_ids = [f'node-{position}' for position in range(len(vectors))]
+    store = MatrixVectorStore.from_arrays(node_ids, node_ids, vectors, quantization=quantization)
+    return VectorStoreIndex(nodes=[], storage_context=StorageContext.from_defaults(vector_store=store), embed_model=get_embed_model())
+
+def corpus_and_queries():
+    # Queries are held-out points of the same clustered distribution as the corpus
+    vectors = benchmark.make_embedding_matrix(NUM_CHUNKS + 100, dimension=DIMENSION)
+    return vectors[:NUM_CHUNKS], vectors[NUM_CHUNKS:]
+
+@pytest.mark.parametrize('quantization, min_recall, max_bytes_per_chunk', [('int8', 0.95, DIMENSION + 8), ('binary', 0.9, DIMENSION // 8 + 8)])
+def test_quantized_search_recall_and_memory(quantization, min_recall, max_bytes_per_chunk):
+    vectors, queries = corpus_and_queries()
+    index = make_index(vectors, quantization)
+
+    result = measure_quantization_recall(index, queries)
+
+    assert result['recall'] >= min_recall
+    assert result['float_bytes'] == 0  # Float vectors stay in the memory-mapped spill file
+    assert result['bytes_per_chunk'] <= max_bytes_per_chunk < result['float_bytes_per_chunk']
+
+def test_quantized_scores_are_float_cosine_similarities():
+    vectors, queries = corpus_and_queries()
+    quantized = make_index(vectors, 'int8').vector_store
+    exact = make_index(vectors, 'none').vector_store
+
+    for quantized_hits, exact_hits in zip(quantized.search(queries[:10], 5), exact.search(queries[:10], 5)):
+        assert [node_id for node_id, _ in quantized_hits] == [node_id for node_id, _ in exact_hits]
+        assert np.allclose([score for _, score in quantized_hits], [score for _, score in exact_hits], atol=1e-5)
+
+def test_spill_file_is_removed_with_the_store(spill_dir):
+    vectors, _ = corpus_and_queries()
+    store = make_index(vectors[:100], 'binary').vector_store
+    assert len(os.listdir(spill_dir)) == 1
+
+    store.clear()
+
+    assert os.listdir(spill_dir) == []
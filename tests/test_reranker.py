@@ -0,0 +1,98 @@
+import sys
+import time
+import types
+
+import pytest
+
+import vector_search
+from vector_search import Reranker
+
+class FakeCrossEncoder:
+    """
+    Local stand-in for sentence_transformers.CrossEncoder: scores a pair by the query words found in the text
+    """
+    seconds_per_pair = 0.0
+    predicted = []
+
+    def __init__(self, model_name, device=None):
+        self.model_name = model_name
+
+    def predict(self, pairs, batch_size=32):
+        FakeCrossEncoder.predicted.extend(pairs)
+        time.sleep(self.seconds_per_pair * len(pairs))
+        return [sum(word in text.lower().split() for word in query.lower().split()) for query, text in pairs]
+
+@pytest.fixture
+def cross_encoder(monkeypatch):
+    monkeypatch.setitem(sys.modules, 'sentence_transformers', types.SimpleNamespace(CrossEncoder=FakeCrossEncoder))
+    monkeypatch.setattr(FakeCrossEncoder, 'seconds_per_pair', 0.0)
+    monkeypatch.setattr(FakeCrossEncoder, 'predicted', [])
+    return FakeCrossEncoder
+
+def hits(*texts):
+    return [(f'node-{number}', {'text': text}) for number, text in enumerate(texts)]
+
+CANDIDATES = hits("pears in spring", "apple revenue", "apple quarterly revenue report", "cold weather")
+
+def node_ids(results):
+    return [node_id for node_id, _ in results]
+
+@pytest.fixture
+def top_k(monkeypatch):
+    # Fallbacks keep as many chunks as retrieval without a re-ranker, more than top_n
+    monkeypatch.setattr(vector_search, 'SIMILARITY_TOP_K', 3)
+    return 3
+
+def test_candidates_are_reordered_by_the_cross_encoder(cross_encoder):
+    reranker = Reranker('fake-model', top_n=2)
+    reranker.warm_up()
+
+    results = reranker.rerank("apple quarterly revenue", CANDIDATES)
+
+    assert node_ids(results) == ['node-2', 'node-1']
+    assert reranker.stats()['scored'] == len(CANDIDATES)
+
+def test_repeated_queries_use_cached_scores(cross_encoder):
+    reranker = Reranker('fake-model', top_n=2)
+    reranker.warm_up()
+    reranker.rerank("apple quarterly revenue", CANDIDATES)
+    cross_encoder.predicted.clear()
+
+    results = reranker.rerank("apple quarterly revenue", CANDIDATES)
+
+    assert node_ids(results) == ['node-2', 'node-1']
+    assert cross_encoder.predicted == []
+    assert reranker.stats()['cache_hits'] == len(CANDIDATES)
+
+def test_vector_order_is_kept_when_a_batch_would_exceed_the_budget(cross_encoder, top_k):
+    cross_encoder.seconds_per_pair = 0.01
+    reranker = Reranker('fake-model', top_n=2, time_budget=0.02, batch_size=4)
+    reranker.warm_up()  # Measures about 10 ms per pair, a batch of 4 pairs cannot finish within 20 ms
+    cross_encoder.predicted.clear()
+
+    results = reranker.rerank("apple quarterly revenue", CANDIDATES)
+
+    assert node_ids(results) == ['node-0', 'node-1', 'node-2']
+    assert cross_encoder.predicted == []  # No inference started past the budget
+    assert reranker.stats()['fallbacks'] == 1
+
+def test_queries_are_not_blocked_while_the_model_loads(cross_encoder, top_k):
+    reranker = Reranker('fake-model', top_n=2)
+
+    results = reranker.rerank("apple quarterly revenue", CANDIDATES)
+    reranker._warm_up_thread.join()
+
+    assert node_ids(results) == ['node-0', 'node-1', 'node-2']
+    assert reranker.stats()['fallbacks'] == 1
+    assert reranker.stats()['ready']
+
+def test_missing_package_disables_reranking(monkeypatch, top_k):
+    monkeypatch.setitem(sys.modules, 'sentence_transformers', None)
+    reranker = Reranker('fake-model', top_n=2)
+
+    with pytest.warns(UserWarning, match="Re-ranking disabled"):
+        reranker.warm_up()
+
+    assert not reranker.enabled
+    assert node_ids(reranker.rerank("apple quarterly revenue", CANDIDATES)) == ['node-0', 'node-1', 'node-2']
+    assert 'sentence_transformers' in reranker.stats()['error']
@@ -0,0 +1,46 @@
+import json
+import os
+import subprocess
+import sys
+
+from tracing import StartupTimer
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def run_python(code, cwd, **environment):
+    result = subprocess.run(
+        [sys.executable, '-c', code], cwd=cwd, capture_output=True, text=True, timeout=120,
+        env={**os.environ, 'PYTHONPATH': REPOSITORY, **environment}
+    )
+    assert result.returncode == 0, result.stderr
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def test_import_defers_the_embedding_cache_and_clients(tmp_path):
+    cache_path = tmp_path / 'cache' / 'embeddings.db'
+    # A fresh interpreter, so nothing was loaded by other tests
+    report = run_python(
+        "import json, os, sys, vector_search\n"
+        "before = {'cache_file': os.path.exists(os.environ['EMBEDDING_CACHE_PATH']), 'phases': list(vector_search.startup_timer.report()),\n"
+        "          'openai_imported': 'llama_index.embeddings.openai' in sys.modules, 'llm': vector_search.llm is not None}\n"
+        "vector_search.get_embed_model()\n"
+        "print(json.dumps({'before': before, 'cache_file': os.path.exists(os.environ['EMBEDDING_CACHE_PATH']),\n"
+        "                  'phases': list(vector_search.startup_timer.report())}))",
+        cwd=tmp_path, EMBEDDING_CACHE_PATH=str(cache_path)
+    )
+
+    assert report['before'] == {'cache_file': False, 'phases': ['import libraries', 'module setup'], 'openai_imported': False, 'llm': False}
+    assert report['cache_file']
+    assert report['phases'] == ['import libraries', 'module setup', 'embedding cache']
+
+def test_startup_timer_keeps_the_first_measurement():
+    timer = StartupTimer()
+
+    with timer.measure('base index'):
+        pass
+    timer.record('base index', 10.0)  # A later rerun is not startup
+    timer.record('first render', 0.25)
+
+    assert 'base index' in timer and 'llm client' not in timer
+    assert list(timer.report()) == ['base index', 'first render']
+    assert timer.report()['base index'] < 10000.0
+    assert timer.report()['first render'] == 250.0
@@ -0,0 +1,157 @@
+import asyncio
+import time
+
+import pytest
+from llama_index.core import Document
+from llama_index.core.llms import ChatMessage, ChatResponse, MockLLM
+
+import vector_search
+from tracing import Tracer
+from vector_search import achat_response, answer_cache, chat_response, create_vector_store, stream_chat_response
+
+DOCUMENTS = [
+    Document(text="Apple reported quarterly revenue of 90 billion dollars, driven by iPhone sales.", id_='https://example.com/q1'),
+    Document(text="The orchard harvest of pears was delayed by an unusually cold spring.", id_='https://example.com/pears')
+]
+
+def make_index():
+    return create_vector_store([Document(text=document.text, id_=document.id_) for document in DOCUMENTS])
+
+def test_stream_matches_non_streaming_answer():
+    index = make_index()
+    question = "What was Apple's quarterly revenue?"
+
+    stream, results = stream_chat_response(question, [], index)
+    deltas = list(stream)
+    answer_cache.clear()
+    answer, chat_results = chat_response(question, [], index)
+
+    # The echoing LLM answers with its prompt, which contains the retrieved chunks
+    assert len(deltas) > 1
+    assert ''.join(deltas) == answer
+    assert DOCUMENTS[0].text in answer
+    assert [result['source'] for result in results] == [result['source'] for result in chat_results]
+    assert results[0]['source'] == 'https://example.com/q1'
+
+def test_repeated_question_streams_the_cached_answer():
+    index = make_index()
+    question = "What was Apple's quarterly revenue?"
+    first = ''.join(stream_chat_response(question, [], index)[0])
+    hits = answer_cache.hits
+
+    stream, _ = stream_chat_response(question, [], index)
+    deltas = list(stream)
+
+    assert deltas == [first]
+    assert answer_cache.hits == hits + 1
+
+def test_cached_answer_depends_on_chat_history():
+    index = make_index()
+    question = "How much was it?"
+    history = [ChatMessage(role='user', content="Tell me about pears"), ChatMessage(role='assistant', content="Pears.")]
+    ''.join(stream_chat_response(question, [], index)[0])
+    hits = answer_cache.hits
+
+    ''.join(stream_chat_response(question, history, index)[0])
+
+    assert answer_cache.hits == hits
+
+def test_abandoned_stream_is_not_cached():
+    index = make_index()
+    question = "What was Apple's quarterly revenue?"
+    stream, _ = stream_chat_response(question, [], index)
+    next(stream)
+    stream.close()
+    hits = answer_cache.hits
+
+    ''.join(stream_chat_response(question, [], index)[0])
+
+    assert answer_cache.hits == hits
+
+def test_prompt_stats_are_reported():
+    index = make_index()
+    prompt_stats = {}
+
+    ''.join(stream_chat_response("What was Apple's quarterly revenue?", [], index, prompt_stats)[0])
+
+    assert prompt_stats['context_chunks'] == len(DOCUMENTS)
+    assert prompt_stats['context_tokens'] > vector_search.count_tokens(DOCUMENTS[0].text)
+
+class FailingLLM(MockLLM):
+    """
+    LLM whose stream breaks after the first delta
+    """
+    def stream_chat(self, messages, **kwargs):
+        def stream():
+            yield ChatResponse(message=ChatMessage(role='assistant', content="Partial"), delta="Partial")
+            raise RuntimeError("connection reset")
+        return stream()
+
+def llm_span(tracer):
+    trace = tracer.traces[-1]
+    assert trace['name'] == 'chat_turn'
+    return next(span for span in trace['spans'] if span['name'] == 'llm')
+
+def test_llm_span_ends_when_the_stream_fails(monkeypatch):
+    tracer = Tracer(enabled=True, log_path=None)
+    monkeypatch.setattr(vector_search, 'tracer', tracer)
+    monkeypatch.setattr(vector_search, 'llm', FailingLLM())
+    stream, _ = stream_chat_response("What was Apple's quarterly revenue?", [], make_index())
+
+    assert next(stream) == "Partial"
+    with pytest.raises(RuntimeError):
+        next(stream)
+
+    assert llm_span(tracer)['error'] == 'RuntimeError'
+    assert 'deepknowledge_span_duration_seconds_count{span="llm"} 1' in tracer.prometheus_metrics()
+
+def test_llm_span_ends_when_the_stream_is_abandoned(monkeypatch):
+    tracer = Tracer(enabled=True, log_path=None)
+    monkeypatch.setattr(vector_search, 'tracer', tracer)
+    stream, _ = stream_chat_response("What was Apple's quarterly revenue?", [], make_index())
+
+    next(stream)
+    stream.close()
+
+    assert llm_span(tracer)['error'] == 'GeneratorExit'
+    assert 'time_to_first_token_ms' in llm_span(tracer)
+
+class SlowLLM(MockLLM):
+    """
+    Echoing LLM that takes 0.2 seconds to answer, blocking the thread in chat and awaiting in achat
+    """
+    def chat(self, messages, **kwargs):
+        time.sleep(0.2)
+        return super().chat(messages, **kwargs)
+
+    async def achat(self, messages, **kwargs):
+        await asyncio.sleep(0.2)
+        return super().chat(messages, **kwargs)
+
+def test_async_answer_does_not_block_the_event_loop(monkeypatch):
+    monkeypatch.setattr(vector_search, 'llm', SlowLLM())
+    index = make_index()
+    ticks = []
+
+    async def ticker(stop):
+        while not stop.is_set():
+            ticks.append(time.perf_counter())
+            await asyncio.sleep(0.01)
+
+    async def answer_questions():
+        stop = asyncio.Event()
+        task = asyncio.create_task(ticker(stop))
+        start = time.perf_counter()
+        answers = await asyncio.gather(*(achat_response(f"{question} revenue?", [], index) for question in ('Apple', 'Pear')))
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await task
+        return answers, elapsed
+
+    answers, elapsed = asyncio.run(answer_questions())
+
+    # Both LLM calls were awaited concurrently while the loop kept running other tasks
+    assert elapsed < 0.35
+    assert len(ticks) >= 10
+    assert DOCUMENTS[0].text in answers[0][0]
+    assert answers[0][1][0]['source'] == 'https://example.com/q1'
@@ -0,0 +1,96 @@
+import asyncio
+import json
+
+from tracing import Tracer, _NOOP_SPAN
+
+def test_disabled_tracer_returns_the_noop_span(tmp_path):
+    tracer = Tracer(enabled=False, log_path=str(tmp_path / 'traces.jsonl'))
+
+    with tracer.span('chat_turn') as span:
+        span.set(tokens=10)
+        tracer.start_span('parse_document').end()
+        with tracer.use_span(span):
+            pass
+
+    assert span is _NOOP_SPAN
+    assert not tracer.traces
+    assert not (tmp_path / 'traces.jsonl').exists()
+
+def test_spans_nest_into_one_trace():
+    tracer = Tracer(enabled=True, log_path=None)
+
+    with tracer.span('chat_turn', streaming=False):
+        with tracer.span('retrieve') as span:
+            span.set(chunks=3)
+        # A span started without activating it (e.g. ended inside a generator) still parents nested spans
+        llm = tracer.start_span('llm')
+        with tracer.use_span(llm):
+            tracer.span('tokenize').end()
+        llm.end()
+
+    trace, = tracer.traces
+    assert trace['name'] == 'chat_turn'
+    spans = {span['name']: span for span in trace['spans']}
+    assert spans['chat_turn']['parent_id'] is None and spans['chat_turn']['streaming'] is False
+    assert spans['retrieve']['parent_id'] == spans['chat_turn']['id'] and spans['retrieve']['chunks'] == 3
+    assert spans['llm']['parent_id'] == spans['chat_turn']['id']
+    assert spans['tokenize']['parent_id'] == spans['llm']['id']
+    assert [span['id'] for span in trace['spans']] == [0, 1, 2, 3]
+    assert trace['duration_ms'] >= spans['retrieve']['duration_ms'] + spans['llm']['duration_ms']
+
+def test_spans_nest_across_tasks_and_record_errors():
+    tracer = Tracer(enabled=True, log_path=None)
+
+    async def step(name):
+        with tracer.span(name):
+            await asyncio.sleep(0)
+
+    async def run():
+        with tracer.span('ingest_job'):
+            await asyncio.gather(step('fetch'), step('fetch'))
+            try:
+                with tracer.span('save'):
+                    raise OSError("disk full")
+            except OSError:
+                pass
+
+    asyncio.run(run())
+
+    trace, = tracer.traces
+    names = [(span['name'], span['parent_id']) for span in trace['spans']]
+    assert names == [('ingest_job', None), ('fetch', 0), ('fetch', 0), ('save', 0)]
+    assert trace['spans'][3]['error'] == 'OSError'
+
+def test_finished_traces_are_appended_as_json_lines(tmp_path):
+    log_path = tmp_path / 'traces.jsonl'
+    tracer = Tracer(enabled=True, log_path=str(log_path))
+
+    for question in range(2):
+        with tracer.span('chat_turn', question=question):
+            with tracer.span('llm'):
+                pass
+
+    traces = [json.loads(line) for line in log_path.read_text().splitlines()]
+    assert [trace['spans'][0]['question'] for trace in traces] == [0, 1]
+    assert all([span['name'] for span in trace['spans']] == ['chat_turn', 'llm'] for trace in traces)
+    assert all(trace['duration_ms'] >= trace['spans'][1]['duration_ms'] for trace in traces)
+    assert traces[0]['trace_id'] != traces[1]['trace_id']
+
+def test_metrics_are_written_to_a_file_for_scrapers(tmp_path):
+    metrics_path = tmp_path / 'metrics' / 'deepknowledge.prom'
+    tracer = Tracer(enabled=True, log_path=None, metrics_path=str(metrics_path), metrics_interval=3600)
+    tracer.register_cache('answer', lambda: {'hits': 2, 'misses': 5})
+
+    with tracer.span('chat_turn'):
+        pass
+    first = metrics_path.read_text()
+    with tracer.span('chat_turn'):
+        pass
+
+    assert 'deepknowledge_span_duration_seconds_count{span="chat_turn"} 1' in first
+    assert 'deepknowledge_answer_cache_hits_total 2' in first
+    # Rewritten at most once per interval, or on demand
+    assert metrics_path.read_text() == first
+    tracer.write_metrics()
+    assert 'deepknowledge_span_duration_seconds_count{span="chat_turn"} 2' in metrics_path.read_text()
+    assert [path.name for path in metrics_path.parent.iterdir()] == ['deepknowledge.prom']
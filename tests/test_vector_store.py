@@ -0,0 +1,122 @@
+import threading
+
+import numpy as np
+from llama_index.core import Document
+
+from vector_search import add_documents, create_vector_store, get_source_registry
+from vector_store import BM25Index, MatrixVectorStore
+
+def test_source_registry_can_be_listed_while_sources_are_added():
+    index = create_vector_store([])
+    registry = get_source_registry(index)
+    errors = []
+
+    def add_sources():
+        try:
+            for number in range(40):
+                add_documents(index, [Document(text=f"Page {number} text.", id_=f'https://example.com/{number}')])
+        except Exception as error:
+            errors.append(error)
+
+    writer = threading.Thread(target=add_sources)
+    writer.start()
+    while writer.is_alive():
+        for entry in registry.sources():
+            entry['source'] in registry
+    writer.join()
+
+    assert errors == []
+    assert len(registry) == 40
+
+def test_source_registry_returns_copies():
+    index = create_vector_store([Document(text="Some text.", id_='https://example.com/a')])
+    registry = get_source_registry(index)
+
+    registry.sources()[0]['chunk_count'] = 0
+    registry.get('https://example.com/a')['node_ids'].clear()
+
+    assert registry.sources()[0]['chunk_count'] == 1
+    assert len(registry.get('https://example.com/a')['node_ids']) == 1
+
+def test_source_listing_leaves_out_node_ids():
+    index = create_vector_store([Document(text="Some text.", id_='https://example.com/a')])
+
+    (entry,) = get_source_registry(index).sources()
+
+    assert 'node_ids' not in entry
+    assert entry['source'] == 'https://example.com/a' and entry['chunk_count'] == 1 and entry['ingested_at'] > 0
+
+def test_bm25_rows_follow_the_vectors_after_delete():
+    texts = ["apples and pears", "quarterly revenue report", "nvidia gpu shipments", "pears in a cold spring"]
+    node_ids = [f'node-{number}' for number in range(4)]
+    vectors = np.eye(4, 8, dtype=np.float32)
+    store = MatrixVectorStore.from_arrays(node_ids, ['doc-a', 'doc-b', 'doc-a', 'doc-c'], vectors, texts=texts)
+
+    store.delete('doc-a')
+
+    assert store.node_ids == ['node-1', 'node-3']
+    assert len(store.bm25) == 2
+    assert store.bm25.scores("nvidia shipments").tolist() == [0.0, 0.0]
+    scores = store.bm25.scores("pears")
+    assert scores[1] > 0 and scores[0] == 0
+    # Lexical hits map to the remaining nodes, with the query embedding matching none of them
+    hits = store.hybrid_search(np.eye(1, 8, 7), ["cold pears"], top_k=1, similarity_cutoff=0.5, lexical_similarity_cutoff=-1.0)
+    assert [node_id for node_id, _, _ in hits[0]] == ['node-3']
+
+def test_bm25_index_compaction_renumbers_rows():
+    bm25 = BM25Index()
+    bm25.add(["alpha beta", "beta gamma", "gamma delta"])
+
+    bm25.compact(np.array([True, False, True]))
+
+    assert len(bm25) == 2
+    assert bm25.terms == 4  # 'alpha', 'beta', 'gamma' and 'delta' still occur in a kept row
+    assert (bm25.scores("gamma") > 0).tolist() == [False, True]
+    assert (bm25.scores("beta") > 0).tolist() == [True, False]
+
+def make_store(count=50, dimension=16, seed=0):
+    vectors = np.random.default_rng(seed).standard_normal((count, dimension), dtype=np.float32)
+    node_ids = [f'node-{number}' for number in range(count)]
+    return MatrixVectorStore.from_arrays(node_ids, node_ids, vectors), vectors
+
+def exact_top_k(vectors, query, top_k):
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    scores = normalized @ (query / np.linalg.norm(query))
+    return [(f'node-{row}', float(scores[row])) for row in np.argsort(-scores)[:top_k]]
+
+def test_search_returns_the_top_k_by_descending_cosine_similarity():
+    store, vectors = make_store()
+    query = vectors[7] + 0.1
+
+    hits = store.search([query], top_k=5)[0]
+
+    assert [node_id for node_id, _ in hits] == [node_id for node_id, _ in exact_top_k(vectors, query, 5)]
+    assert np.allclose([score for _, score in hits], [score for _, score in exact_top_k(vectors, query, 5)], atol=1e-5)
+    assert hits[0][0] == 'node-7'
+
+def test_similarity_cutoff_drops_lower_scores():
+    store, vectors = make_store()
+    expected = exact_top_k(vectors, vectors[3], 10)
+    cutoff = (expected[2][1] + expected[3][1]) / 2
+
+    hits = store.search([vectors[3]], top_k=10, similarity_cutoff=cutoff)[0]
+
+    assert [node_id for node_id, _ in hits] == [node_id for node_id, _ in expected[:3]]
+
+def test_batch_search_matches_single_queries():
+    store, vectors = make_store()
+    queries = vectors[:6] * 2 + 0.05
+
+    batch = store.search(queries, top_k=4)
+
+    assert len(batch) == 6
+    for query, hits in zip(queries, batch):
+        assert [node_id for node_id, _ in hits] == [node_id for node_id, _ in store.search([query], top_k=4)[0]]
+
+def test_top_k_larger_than_the_store_returns_every_node():
+    store, vectors = make_store(count=3)
+
+    hits = store.search([vectors[0]], top_k=10)[0]
+
+    assert sorted(node_id for node_id, _ in hits) == ['node-0', 'node-1', 'node-2']
+    assert [score for _, score in hits] == sorted((score for _, score in hits), reverse=True)
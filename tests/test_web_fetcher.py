@@ -0,0 +1,162 @@
+import asyncio
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import vector_search
+from vector_search import IngestJob, aadd_web_pages, add_web_pages, aload_web_data, create_vector_store, get_source_registry, iter_web_pages
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Local web server: /page-* returns HTML, /slow-* returns it after 0.3 seconds, /flaky fails once with 503,
+    /limited is rate limited once with 429 and a Retry-After header, /missing returns 404
+    """
+    requests = Counter()
+
+    def do_GET(self):
+        StubHandler.requests[self.path] += 1
+        if self.path == '/missing' or (self.path == '/flaky' and StubHandler.requests[self.path] == 1):
+            self.send_response(404 if self.path == '/missing' else 503)
+            self.end_headers()
+            return
+        if self.path == '/limited' and StubHandler.requests[self.path] == 1:
+            self.send_response(429)
+            self.send_header('Retry-After', '7')
+            self.end_headers()
+            return
+        if self.path.startswith('/slow-'):
+            time.sleep(0.3)
+        body = f"<html><body><h1>Title of {self.path}</h1><p>Text about {self.path.strip('/')}.</p></body></html>"
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server(no_backoff):
+    StubHandler.requests.clear()
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{httpd.server_port}'
+    httpd.shutdown()
+    httpd.server_close()
+
+def test_pages_are_fetched_and_converted_to_text(server):
+    urls = [f'{server}/page-{number}' for number in range(5)]
+
+    results = {result['url']: result for result in iter_web_pages(urls)}
+
+    assert set(results) == set(urls)
+    for url, result in results.items():
+        assert result['error'] is None
+        assert result['document'].id_ == url
+        assert f"Title of /{url.rsplit('/', 1)[1]}" in result['document'].text
+        assert '<h1>' not in result['document'].text
+
+def test_failures_are_reported_per_url(server):
+    results = {result['url']: result for result in iter_web_pages([f'{server}/page-0', f'{server}/missing'])}
+
+    assert results[f'{server}/missing'] == {'url': f'{server}/missing', 'document': None, 'error': 'HTTP 404'}
+    assert results[f'{server}/page-0']['error'] is None
+    assert StubHandler.requests['/missing'] == 1  # Client errors are not retried
+
+def test_server_errors_are_retried(server):
+    results = list(iter_web_pages([f'{server}/flaky']))
+
+    assert results[0]['error'] is None
+    assert StubHandler.requests['/flaky'] == 2
+
+def test_rate_limited_requests_wait_for_retry_after(server, monkeypatch):
+    delays = []
+    sleep = asyncio.sleep
+
+    async def record_sleep(delay, *args, **kwargs):
+        delays.append(delay)
+        await sleep(0)
+
+    monkeypatch.setattr(asyncio, 'sleep', record_sleep)
+    results = list(iter_web_pages([f'{server}/limited']))
+
+    assert results[0]['error'] is None
+    assert StubHandler.requests['/limited'] == 2
+    assert delays == [7.0]
+
+def test_busy_host_does_not_block_other_hosts(server, monkeypatch):
+    # 127.0.0.1 and localhost are different hosts to the fetcher, served by the same stub server
+    other_server = server.replace('127.0.0.1', 'localhost')
+    monkeypatch.setattr(vector_search, 'WEB_FETCH_CONCURRENCY', 2)
+    monkeypatch.setattr(vector_search, 'WEB_FETCH_PER_HOST', 1)
+    urls = [f'{server}/slow-{number}' for number in range(3)] + [f'{other_server}/page-0']
+
+    results = [result['url'] for result in iter_web_pages(urls)]
+
+    # Queued requests to the busy host don't hold global slots, so the other host is fetched right away
+    assert results[0] == f'{other_server}/page-0'
+    assert sorted(results[1:]) == urls[:3]
+
+def test_duplicate_urls_are_fetched_once(server):
+    results = list(iter_web_pages([f'{server}/page-0', f'{server}/page-0']))
+
+    assert len(results) == 1
+    assert StubHandler.requests['/page-0'] == 1
+
+def test_fetched_pages_are_indexed(server):
+    index = create_vector_store([])
+    urls = [f'{server}/page-0', f'{server}/page-1', f'{server}/missing']
+
+    results = list(add_web_pages(index, urls))
+
+    assert sorted(result['url'] for result in results if result['error']) == [f'{server}/missing']
+    assert sorted(entry['source'] for entry in get_source_registry(index).sources()) == urls[:2]
+
+def test_async_pages_are_indexed(server):
+    index = create_vector_store([])
+    urls = [f'{server}/page-0', f'{server}/page-1']
+
+    async def ingest():
+        return [result async for result in aadd_web_pages(index, urls, batch_size=1)]
+
+    results = asyncio.run(ingest())
+
+    assert [result['error'] for result in results] == [None, None]
+    assert sorted(entry['source'] for entry in get_source_registry(index).sources()) == urls
+
+def test_async_load_returns_documents_in_url_order_or_raises(server):
+    urls = [f'{server}/page-1', f'{server}/page-0']
+
+    documents = asyncio.run(aload_web_data(urls))
+
+    assert [document.id_ for document in documents] == urls
+    with pytest.raises(RuntimeError, match='missing'):
+        asyncio.run(aload_web_data([f'{server}/page-0', f'{server}/missing']))
+
+def test_ingest_job_reports_progress_and_failures(server):
+    index = create_vector_store([])
+    urls = [f'{server}/page-0', f'{server}/page-1', f'{server}/missing', f'{server}/page-0']
+    job = IngestJob(index, urls=urls)
+
+    assert (job.status, job.total, job.progress) == ('pending', 3, 0.0)  # Duplicate URLs are counted once
+    assert job.start().wait(timeout=30)
+
+    assert (job.status, job.error, job.completed, job.progress) == ('done', None, 3, 1.0)
+    assert job.failed == [f'{server}/missing']
+    assert job.finished_at >= job.started_at
+    assert sorted(entry['source'] for entry in get_source_registry(index).sources()) == urls[:2]
+
+def test_ingest_job_error_is_reported(server, monkeypatch):
+    def save_index(index):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(vector_search.knowledge_bases, 'save_index', save_index)
+    job = IngestJob(create_vector_store([]), urls=[f'{server}/page-0']).start()
+
+    assert job.wait(timeout=30)
+    assert (job.status, job.error, job.completed) == ('error', 'OSError: disk full', 1)
+    with pytest.raises(ValueError):
+        IngestJob(create_vector_store([]))
@@ -0,0 +1,254 @@
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+from dotenv import load_dotenv
+
+# Request tracing (spans, traces, latency histograms) and startup timing, shared by all modules
+
+load_dotenv()
+
+# Tracing Parameters
+TRACING_ENABLED = os.getenv('TRACING_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+TRACE_LOG_PATH = os.getenv('TRACE_LOG_PATH')  # Optional JSON-lines file receiving every finished trace
+TRACE_METRICS_PATH = os.getenv('TRACE_METRICS_PATH')  # Optional Prometheus text file (e.g. read by the node_exporter textfile collector)
+TRACE_METRICS_INTERVAL = float(os.getenv('TRACE_METRICS_INTERVAL', 15))  # Minimum seconds between rewrites of the metrics file
+TRACE_HISTORY_SIZE = 50  # Finished traces kept in memory for the debug panel
+TRACE_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)  # Seconds
+
+class _NoopSpan:
+    """
+    Span returned while tracing is disabled: every operation is a no-op
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+    def end(self):
+        pass
+
+_NOOP_SPAN = _NoopSpan()
+
+class Span:
+    """
+    Timed step of a trace with attributes (token counts, chunk counts, cache hits, ...)
+    A span without parent is the root of a new trace, the trace is finished when its root span ends
+    """
+    def __init__(self, tracer, name, parent, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.parent = parent
+        self.attributes = attributes
+        if parent is None:
+            self.trace = {'trace_id': uuid.uuid4().hex, 'name': name, 'start_time': time.time(), 'spans': [], '_next_id': 0}
+        else:
+            self.trace = parent.trace
+        self.span_id = self.trace['_next_id']
+        self.trace['_next_id'] += 1
+        self._token = None
+        self._ended = False
+        self._start = time.perf_counter()
+        self._trace_start = self._start if parent is None else parent._trace_start
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def end(self):
+        if self._ended:
+            return
+        self._ended = True
+        duration = time.perf_counter() - self._start
+        self.trace['spans'].append({
+            'id': self.span_id,
+            'parent_id': self.parent.span_id if self.parent is not None else None,
+            'name': self.name,
+            'offset_ms': round(1000 * (self._start - self._trace_start), 3),
+            'duration_ms': round(1000 * duration, 3),
+            **self.attributes
+        })
+        self.tracer._record(self, duration)
+
+    def __enter__(self):
+        self._token = self.tracer._current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer._current.reset(self._token)
+        if exc_type is not None:
+            self.attributes['error'] = exc_type.__name__
+        self.end()
+        return False
+
+class Tracer:
+    """
+    Lightweight tracer for the RAG pipeline: span timings and attributes, grouped into traces
+    Finished traces are kept in memory, optionally appended to a JSON-lines file,
+    and aggregated into per-span latency histograms for Prometheus-style export
+    (shown in the debug panel and, with a metrics path, written to a file a scraper can read)
+    """
+    def __init__(self, enabled=TRACING_ENABLED, log_path=TRACE_LOG_PATH, history_size=TRACE_HISTORY_SIZE,
+                 metrics_path=TRACE_METRICS_PATH, metrics_interval=TRACE_METRICS_INTERVAL):
+        self.enabled = enabled
+        self.log_path = log_path
+        self.metrics_path = metrics_path
+        self.metrics_interval = metrics_interval
+        self.traces = deque(maxlen=history_size)
+        self._current = contextvars.ContextVar('current_span', default=None)
+        self._histograms = {}
+        self._caches = {}
+        self._metrics_written_at = None
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def use_span(self, span):
+        """
+        Make a span started with start_span the parent of nested spans, without ending it
+        """
+        if span is _NOOP_SPAN:
+            yield span
+            return
+        token = self._current.set(span)
+        try:
+            yield span
+        finally:
+            self._current.reset(token)
+
+    def span(self, name, **attributes):
+        """
+        Context manager timing a step, nested under the currently active span
+        """
+        if not self.enabled:
+            return _NOOP_SPAN
+        return Span(self, name, self._current.get(), attributes)
+
+    def start_span(self, name, parent=None, **attributes):
+        """
+        Start a span without activating it (e.g. for steps that end inside a generator), finish it with end()
+        """
+        if not self.enabled:
+            return _NOOP_SPAN
+        return Span(self, name, parent if parent is not None else self._current.get(), attributes)
+
+    def _record(self, span, duration):
+        write_metrics = False
+        with self._lock:
+            histogram = self._histograms.setdefault(span.name, {'buckets': [0] * len(TRACE_LATENCY_BUCKETS), 'count': 0, 'sum': 0.0})
+            for position, bound in enumerate(TRACE_LATENCY_BUCKETS):
+                if duration <= bound:
+                    histogram['buckets'][position] += 1
+            histogram['count'] += 1
+            histogram['sum'] += duration
+
+            if span.parent is None:
+                trace = {key: value for key, value in span.trace.items() if not key.startswith('_')}
+                trace['duration_ms'] = round(1000 * duration, 3)
+                trace['spans'] = sorted(trace['spans'], key=lambda item: item['id'])
+                self.traces.append(trace)
+                if self.log_path:
+                    with open(self.log_path, 'a', encoding='utf-8') as f:
+                        f.write(json.dumps(trace, default=str) + '\n')
+
+                # Rewrite the metrics file as traces finish, at most once per interval
+                now = time.monotonic()
+                if self.metrics_path and (self._metrics_written_at is None or now - self._metrics_written_at >= self.metrics_interval):
+                    self._metrics_written_at = now
+                    write_metrics = True
+        if write_metrics:
+            self.write_metrics()
+
+    def register_cache(self, name, stats):
+        """
+        Export the hits and misses of a cache with the metrics, stats returns a dict with both counters (or None to skip)
+        """
+        self._caches[name] = stats
+
+    def prometheus_metrics(self):
+        """
+        Export span latency histograms and cache counters in the Prometheus text format
+        """
+        lines = [
+            '# HELP deepknowledge_span_duration_seconds Duration of traced pipeline steps.',
+            '# TYPE deepknowledge_span_duration_seconds histogram'
+        ]
+        with self._lock:
+            for name, histogram in sorted(self._histograms.items()):
+                for bound, count in zip(TRACE_LATENCY_BUCKETS, histogram['buckets']):
+                    lines.append(f'deepknowledge_span_duration_seconds_bucket{{span="{name}",le="{bound}"}} {count}')
+                lines.append(f'deepknowledge_span_duration_seconds_bucket{{span="{name}",le="+Inf"}} {histogram["count"]}')
+                lines.append(f'deepknowledge_span_duration_seconds_sum{{span="{name}"}} {histogram["sum"]}')
+                lines.append(f'deepknowledge_span_duration_seconds_count{{span="{name}"}} {histogram["count"]}')
+
+        for cache, stats in self._caches.items():
+            stats = stats()
+            if stats is None:
+                continue
+            for counter in ('hits', 'misses'):
+                lines.append(f'# TYPE deepknowledge_{cache}_cache_{counter}_total counter')
+                lines.append(f'deepknowledge_{cache}_cache_{counter}_total {stats[counter]}')
+        return '\n'.join(lines) + '\n'
+
+    def write_metrics(self, path=None):
+        """
+        Write the Prometheus metrics to a file (the metrics path by default), replacing it atomically
+        so a scraper never reads a partial file
+        """
+        path = path or self.metrics_path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, 'w', encoding='utf-8') as f:
+            f.write(self.prometheus_metrics())
+        os.replace(temporary_path, path)
+        return path
+
+# Shared tracer (process-wide, see Tracer)
+tracer = Tracer()
+
+# Startup Parameters
+STARTUP_REPORT = os.getenv('STARTUP_REPORT', 'false').lower() in ('1', 'true', 'yes')  # Print the startup report once the app has rendered
+
+class StartupTimer:
+    """
+    Records how long each import and initialization step takes the first time it runs in this process
+    Clients and the base index are created on first use, so their cost shows up when they are first needed
+    """
+    def __init__(self):
+        self._phases = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        """
+        Record the duration of a startup phase, keeping the first measurement (later reruns are not startup)
+        """
+        with self._lock:
+            self._phases.setdefault(name, seconds)
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def __contains__(self, name):
+        return name in self._phases
+
+    def report(self):
+        """
+        Return the duration of every recorded phase in milliseconds, in the order they finished
+        """
+        with self._lock:
+            return {name: round(1000 * seconds, 1) for name, seconds in self._phases.items()}
+
+# Shared startup timer (process-wide, see StartupTimer)
+startup_timer = StartupTimer()
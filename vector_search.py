@@ -1,18 +1,45 @@
-from llama_index.core import VectorStoreIndex, SimpleDirectoryReader, get_response_synthesizer
-from llama_index.core.retrievers import VectorIndexRetriever
-from llama_index.core.query_engine import RetrieverQueryEngine
-from llama_index.core.postprocessor import SimilarityPostprocessor
+import time
+_import_started = time.perf_counter()  # Startup report: import cost of this module
+
+from llama_index.core import VectorStoreIndex, SimpleDirectoryReader, StorageContext, get_response_synthesizer
 from llama_index.core.llms import ChatMessage, MessageRole
 from llama_index.core.memory import ChatMemoryBuffer
-from llama_index.embeddings.openai import OpenAIEmbedding
-from llama_index.llms.openai import OpenAI
-from llama_index.llms.deepseek import DeepSeek
-from llama_index.core import Settings
-from llama_index.readers.web import SimpleWebPageReader
-from llama_index.core.schema import NodeRelationship
+from llama_index.core.schema import Document, NodeRelationship, RelatedNodeInfo, TextNode
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.schema import MetadataMode
+from llama_index.core.utils import get_tokenizer
+from llama_index.core.embeddings import BaseEmbedding
+from llama_index.core.bridge.pydantic import PrivateAttr
 from dotenv import load_dotenv
+from document_parser import parse_document_bytes
+from tracing import tracer, startup_timer
+from vector_store import MatrixVectorStore, IVFIndex, LEXICAL_SIMILARITY_CUTOFF, content_hash, get_node_source, node_chunk_hash, remove_file
+from caches import CachedEmbedding, AnswerCache, answer_cache
+import numpy as np
+import httpx
+import html2text
+import asyncio
+import contextlib
+import hashlib
+import queue
+import mimetypes
+import multiprocessing
 import os
 import json
+import threading
+import uuid
+import warnings
+import argparse
+import weakref
+import re
+import email.utils
+from collections import Counter, OrderedDict, defaultdict
+from urllib.parse import urlsplit
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+_libraries_imported = time.perf_counter()
+startup_timer.record('import libraries', _libraries_imported - _import_started)
 
 # Load .env
 load_dotenv()
@@ -21,96 +48,2128 @@ OPENAI_API_BASE = os.getenv('OPENAI_API_HOST')
 DEEPSEEK_API_KEY = os.getenv('DEEPSEEK_API_KEY')
 DEEPSEEK_API_BASE = os.getenv('DEEPSEEK_API_HOST')
 
-# Vector Embedding Parameters
-SIMILARITY_TOP_K = 5
-SIMILARITY_CUTOFF = 0.75
-Settings.embed_model = OpenAIEmbedding(
-    model="text-embedding-ada-002",
-    api_key=OPENAI_API_KEY,
-    api_base=OPENAI_API_BASE
-)
+class LazyEmbedding(BaseEmbedding):
+    """
+    Embedding model created by a factory on first use, so the client library is not imported at startup
+    Async requests use one model per event loop: an async HTTP client only works on the loop it was first used on
+    """
+    _factory: object = PrivateAttr()
+    _model: BaseEmbedding = PrivateAttr(default=None)
+    _async_models: weakref.WeakKeyDictionary = PrivateAttr()
+    _lock: threading.Lock = PrivateAttr()
 
-# Chat Response Parameters
-llm = DeepSeek(
-    model="deepseek-chat",
-    temperature=0.5,
-    api_key=DEEPSEEK_API_KEY,
-    api_base=DEEPSEEK_API_BASE
-)
+    def __init__(self, factory, model_name, **kwargs):
+        super().__init__(model_name=model_name, **kwargs)
+        self._factory = factory
+        self._async_models = weakref.WeakKeyDictionary()  # Event loop -> model, dropped with the loop
+        self._lock = threading.Lock()
+
+    @classmethod
+    def class_name(cls):
+        return "LazyEmbedding"
+
+    @property
+    def model(self):
+        with self._lock:
+            if self._model is None:
+                with startup_timer.measure('embedding client'):
+                    self._model = self._factory()
+        return self._model
+
+    @property
+    def async_model(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if loop not in self._async_models:
+                with startup_timer.measure('embedding client'):
+                    self._async_models[loop] = self._factory()
+            return self._async_models[loop]
+
+    def _get_text_embedding(self, text):
+        return self.model._get_text_embedding(text)
+
+    def _get_text_embeddings(self, texts):
+        return self.model._get_text_embeddings(texts)
+
+    async def _aget_text_embeddings(self, texts):
+        return await self.async_model._aget_text_embeddings(texts)
+
+    def _get_query_embedding(self, query):
+        return self.model._get_query_embedding(query)
+
+    async def _aget_query_embedding(self, query):
+        return await self.async_model._aget_query_embedding(query)
+
+def _create_openai_embedding():
+    from llama_index.embeddings.openai import OpenAIEmbedding
+    return OpenAIEmbedding(
+        model="text-embedding-ada-002",
+        api_key=OPENAI_API_KEY,
+        api_base=OPENAI_API_BASE,
+        max_retries=0  # The embedding scheduler retries, so a 429 pauses every concurrent request (see EmbeddingScheduler)
+    )
+
+# Shared embedding model, created by get_embed_model on first use (may be replaced, e.g. by a fake model in the benchmark)
+embed_model = None
+_embed_model_lock = threading.Lock()
+
+def get_embed_model():
+    """
+    Get the embedding model, opening the on-disk embedding cache on first use (the OpenAI client is created
+    even later, on the first embedding request), so importing this module creates no files
+    """
+    global embed_model
+    with _embed_model_lock:
+        if embed_model is None:
+            with startup_timer.measure('embedding cache'):
+                embed_model = CachedEmbedding(
+                    LazyEmbedding(_create_openai_embedding, model_name="text-embedding-ada-002", embed_batch_size=100)
+                )
+    return embed_model
+
+tracer.register_cache('embedding', lambda: (
+    {'hits': embed_model.hits, 'misses': embed_model.misses}
+    if isinstance(embed_model, CachedEmbedding) else None
+))
+
+# Embedding Scheduler Parameters
+EMBEDDING_BATCH_TOKENS = int(os.getenv('EMBEDDING_BATCH_TOKENS', 100000))  # Token budget per embedding request
+EMBEDDING_BATCH_MAX_INPUTS = int(os.getenv('EMBEDDING_BATCH_MAX_INPUTS', 2048))  # Input limit per embedding request
+EMBEDDING_CONCURRENCY = int(os.getenv('EMBEDDING_CONCURRENCY', 4))  # Parallel embedding requests
+EMBEDDING_MAX_RETRIES = int(os.getenv('EMBEDDING_MAX_RETRIES', 6))  # Retries per request on rate limits (HTTP 429), server and connection errors
+
+class EmbeddingScheduler:
+    """
+    Embeds texts in token-budgeted batches, issuing several requests concurrently
+    On a rate limit (HTTP 429) all requests pause with exponential backoff before retrying,
+    server errors (HTTP 5xx) and connection failures retry only the failed request
+    """
+    def __init__(self, embed_model=None, batch_tokens=EMBEDDING_BATCH_TOKENS, max_batch_size=EMBEDDING_BATCH_MAX_INPUTS,
+                 concurrency=EMBEDDING_CONCURRENCY, max_retries=EMBEDDING_MAX_RETRIES):
+        self.embed_model = embed_model
+        self.batch_tokens = batch_tokens
+        self.max_batch_size = max_batch_size
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.last_run = None
+        self._cooldown_until = 0.0
+        self._loop = None
+        self._loop_lock = threading.Lock()
+
+    @staticmethod
+    def _status_code(error):
+        return getattr(error, 'status_code', None) or getattr(getattr(error, 'response', None), 'status_code', None)
+
+    @classmethod
+    def _is_rate_limit(cls, error):
+        return cls._status_code(error) == 429
+
+    @classmethod
+    def _is_transient(cls, error):
+        """
+        Server errors and connection failures, which may succeed when retried
+        """
+        status_code = cls._status_code(error)
+        if status_code is not None:
+            return status_code >= 500
+        # openai.APIConnectionError/APITimeoutError, matched by name so the client library is not imported here
+        return isinstance(error, (httpx.TransportError, ConnectionError, TimeoutError)) or \
+            type(error).__name__ in ('APIConnectionError', 'APITimeoutError')
+
+    def _make_batches(self, token_counts):
+        """
+        Pack consecutive texts into batches that stay within the token budget and input limit
+        """
+        batches, batch, batch_tokens = [], [], 0
+        for position, tokens in enumerate(token_counts):
+            if batch and (batch_tokens + tokens > self.batch_tokens or len(batch) >= self.max_batch_size):
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(position)
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    async def _aembed_batch(self, embed_model, texts, limit, stats):
+        for attempt in range(self.max_retries + 1):
+            backoff = min(60.0, 2 ** attempt)
+            async with limit:
+                # Wait out a rate-limit cooldown triggered by any concurrent request
+                delay = self._cooldown_until - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                try:
+                    stats['requests'] += 1
+                    # One embedding request per batch
+                    return await embed_model._aget_text_embeddings(texts)
+                except Exception as e:
+                    rate_limited = self._is_rate_limit(e)
+                    if not (rate_limited or self._is_transient(e)) or attempt == self.max_retries:
+                        raise
+                    if rate_limited:
+                        stats['rate_limited'] += 1
+                        self._cooldown_until = max(self._cooldown_until, time.monotonic() + backoff)
+                    else:
+                        stats['retried'] += 1
+            if not rate_limited:
+                # Back off without holding a request slot
+                await asyncio.sleep(backoff)
+
+    async def aembed(self, texts):
+        """
+        Embed texts concurrently in token-budgeted batches, returning embeddings in input order
+        """
+        embed_model = self.embed_model or get_embed_model()
+        tokenizer = get_tokenizer()
+        token_counts = [len(tokenizer(text)) for text in texts]
+        stats = {'chunks': len(texts), 'tokens': sum(token_counts), 'requests': 0, 'rate_limited': 0, 'retried': 0}
+
+        start = time.perf_counter()
+        limit = asyncio.Semaphore(self.concurrency)
+        batches = self._make_batches(token_counts)
+        batch_embeddings = await asyncio.gather(*[
+            self._aembed_batch(embed_model, [texts[position] for position in batch], limit, stats)
+            for batch in batches
+        ])
+        seconds = time.perf_counter() - start
+
+        embeddings = [None] * len(texts)
+        for batch, batch_embedding in zip(batches, batch_embeddings):
+            for position, embedding in zip(batch, batch_embedding):
+                embeddings[position] = embedding
+
+        stats.update({
+            'batches': len(batches),
+            'seconds': seconds,
+            'chunks_per_second': len(texts) / seconds if seconds else 0.0,
+            'tokens_per_second': stats['tokens'] / seconds if seconds else 0.0
+        })
+        self.last_run = stats
+        return embeddings
+
+    def _get_loop(self):
+        """
+        Long-lived event loop on a daemon thread for synchronous callers, so HTTP connections are reused across calls
+        """
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name='embedding-scheduler', daemon=True).start()
+        return self._loop
+
+    def embed(self, texts):
+        """
+        Synchronous wrapper around aembed, runs on the scheduler's own event loop
+        """
+        if not texts:
+            return []
+        return asyncio.run_coroutine_threadsafe(self.aembed(texts), self._get_loop()).result()
+
+    def embed_nodes(self, nodes):
+        """
+        Set the embedding of every node that does not have one yet
+        """
+        pending = [node for node in nodes if node.embedding is None]
+        texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in pending]
+        for node, embedding in zip(pending, self.embed(texts)):
+            node.embedding = embedding
+        return nodes
+
+    async def aembed_nodes(self, nodes):
+        """
+        Asynchronous variant of embed_nodes
+        """
+        pending = [node for node in nodes if node.embedding is None]
+        texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in pending]
+        for node, embedding in zip(pending, await self.aembed(texts) if texts else []):
+            node.embedding = embedding
+        return nodes
+
+# Shared embedding scheduler used by all ingestion paths
+embedding_scheduler = EmbeddingScheduler()
+
+# Re-ranking Parameters
+RERANK_MODEL = os.getenv('RERANK_MODEL', '')  # Local cross-encoder (e.g. cross-encoder/ms-marco-MiniLM-L-6-v2), empty = disabled
+RERANK_CANDIDATES = int(os.getenv('RERANK_CANDIDATES', 20))  # Vector/hybrid candidates over-fetched for re-ranking
+RERANK_TOP_N = int(os.getenv('RERANK_TOP_N', 3))  # Re-ranked chunks sent to the LLM
+RERANK_TIME_BUDGET = float(os.getenv('RERANK_TIME_BUDGET', 0.15))  # Seconds of inference per query before falling back to vector order
+RERANK_BATCH_SIZE = 16  # (query, chunk) pairs scored per inference call
+RERANK_CACHE_MAX_ENTRIES = 20000
+
+class Reranker:
+    """
+    Optional second retrieval stage: re-ranks over-fetched candidates with a small local cross-encoder on CPU
+    Scores are cached per (query, node) pair; if inference would exceed the time budget the vector order is kept
+    The model (sentence-transformers) is loaded by warm_up (in the background with start_warm_up), never inside a query
+    """
+    def __init__(self, model_name=RERANK_MODEL, top_n=RERANK_TOP_N, time_budget=RERANK_TIME_BUDGET,
+                 batch_size=RERANK_BATCH_SIZE, max_entries=RERANK_CACHE_MAX_ENTRIES):
+        self.model_name = model_name
+        self.top_n = top_n
+        self.time_budget = time_budget
+        self.batch_size = batch_size
+        self.max_entries = max_entries
+        self.calls = 0
+        self.cache_hits = 0
+        self.scored = 0
+        self.fallbacks = 0
+        self._model = None
+        self._error = None
+        self._pair_seconds = None  # Running estimate of the inference time per (query, chunk) pair
+        self._warm_up_thread = None
+        self._scores = OrderedDict()
+        self._lock = threading.Lock()
+        self._model_lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.model_name) and self._error is None
+
+    def _get_model(self):
+        with self._model_lock:
+            if self._model is None and self._error is None:
+                try:
+                    from sentence_transformers import CrossEncoder
+                    self._model = CrossEncoder(self.model_name, device='cpu')
+                except Exception as e:
+                    # Missing package or model: keep serving results in vector order
+                    self._error = f"{type(e).__name__}: {e}"
+                    warnings.warn(f"Re-ranking disabled, could not load {self.model_name}: {self._error}")
+            return self._model
+
+    def _record_batch(self, pairs, seconds):
+        per_pair = seconds / pairs
+        self._pair_seconds = per_pair if self._pair_seconds is None else 0.8 * self._pair_seconds + 0.2 * per_pair
+
+    def warm_up(self):
+        """
+        Load the model and time one batch, so queries neither pay for loading nor start a batch they cannot finish
+        """
+        model = self._get_model()
+        if model is not None and self._pair_seconds is None:
+            started = time.perf_counter()
+            model.predict([('warm up', 'warm up')] * self.batch_size, batch_size=self.batch_size)
+            self._record_batch(self.batch_size, time.perf_counter() - started)
+        return model
+
+    def start_warm_up(self):
+        """
+        Run warm_up in a background thread, once per process (no-op when re-ranking is disabled)
+        """
+        with self._lock:
+            if not self.enabled or self._warm_up_thread is not None:
+                return
+            self._warm_up_thread = threading.Thread(target=self.warm_up, name='reranker-warm-up', daemon=True)
+            self._warm_up_thread.start()
+
+    def rerank(self, query, hits):
+        """
+        Re-rank (node_id, result dict) candidates for a query and keep the best top_n
+        Falls back to the first SIMILARITY_TOP_K candidates in their original order when the model is unavailable,
+        still loading or too slow, so the context is the same as without a re-ranker
+        """
+        if len(hits) <= 1 or not self.enabled:
+            return hits[:SIMILARITY_TOP_K]
+        model = self._model
+        if model is None:
+            # Loading takes seconds, serve this query in vector order meanwhile
+            self.start_warm_up()
+            self.fallbacks += 1
+            return hits[:SIMILARITY_TOP_K]
+        self.calls += 1
+
+        query_key = content_hash(query)
+        with self._lock:
+            scores = {node_id: self._scores.get((query_key, node_id)) for node_id, _ in hits}
+        self.cache_hits += sum(score is not None for score in scores.values())
+        missing = [(node_id, result) for node_id, result in hits if scores[node_id] is None]
+
+        started = time.perf_counter()
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            # Stop before a batch that would end past the budget rather than after it
+            batch_started = time.perf_counter()
+            if batch_started - started + len(batch) * (self._pair_seconds or 0.0) > self.time_budget:
+                self.fallbacks += 1
+                return hits[:SIMILARITY_TOP_K]
+            batch_scores = model.predict([(query, result['text']) for _, result in batch], batch_size=self.batch_size)
+            self._record_batch(len(batch), time.perf_counter() - batch_started)
+            self.scored += len(batch)
+            with self._lock:
+                for (node_id, _), score in zip(batch, batch_scores):
+                    scores[node_id] = float(score)
+                    self._scores[(query_key, node_id)] = float(score)
+                while len(self._scores) > self.max_entries:
+                    self._scores.popitem(last=False)
+
+        return sorted(hits, key=lambda hit: scores[hit[0]], reverse=True)[:self.top_n]
+
+    def stats(self):
+        """
+        Return call, cache and fallback counters (error is set when the model could not be loaded)
+        """
+        return {
+            'model': self.model_name or None,
+            'calls': self.calls,
+            'cache_hits': self.cache_hits,
+            'scored': self.scored,
+            'fallbacks': self.fallbacks,
+            'ready': self._model is not None,
+            'ms_per_pair': 1000 * self._pair_seconds if self._pair_seconds is not None else None,
+            'error': self._error
+        }
+
+# Shared re-ranker (process-wide, see Reranker)
+reranker = Reranker()
+
+# Chunking Parameters
+CHUNK_STRATEGY = os.getenv('CHUNK_STRATEGY', 'auto')  # 'auto' (by source type) or 'markdown', 'section', 'page', 'sentence' for all documents
+CHUNK_SIZE = int(os.getenv('CHUNK_SIZE', 512))  # Maximum tokens per chunk
+CHUNK_OVERLAP = int(os.getenv('CHUNK_OVERLAP', 0))  # Overlap when a long paragraph is split by sentences (neighbors are expanded at retrieval instead)
+CHUNK_MIN_TOKENS = int(os.getenv('CHUNK_MIN_TOKENS', 128))  # A heading only starts a new chunk once the current one has this many tokens
+CHUNK_EXPANSION_WINDOW = int(os.getenv('CHUNK_EXPANSION_WINDOW', 0))  # Neighboring chunks added on each side of a retrieved chunk (within the context budget), 0 = disabled
+CHUNK_EXPANSION_MAX_TOKENS = int(os.getenv('CHUNK_EXPANSION_MAX_TOKENS', 1024))  # Token limit of an expanded chunk
+EMBEDDING_COST_PER_1K_TOKENS = float(os.getenv('EMBEDDING_COST_PER_1K_TOKENS', 0.0001))  # USD, text-embedding-ada-002 pricing
+CHUNK_METADATA_KEYS = ["chunk_tokens"]  # Excluded from embeddings and LLM prompts
+
+class DocumentChunker:
+    """
+    Splits documents into chunks along their structure, with a strategy per source type:
+    'markdown' (web pages) and 'section' (DOCX) start chunks at headings, 'page' (PDF) keeps chunks within a page,
+    'sentence' splits plain text by sentences. Paragraphs and tables are packed whole up to the chunk size
+    Every chunk gets its token count, its section heading, a link to its document and previous/next chunk links
+    """
+    MARKDOWN_HEADING = re.compile(r'^(#{1,6})\s+(.+?)\s*#*\s*$')
+    TABLE_SEPARATOR = re.compile(r'^\s*\|?\s*:?-{3,}')
+
+    def __init__(self, strategy=CHUNK_STRATEGY, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, min_tokens=CHUNK_MIN_TOKENS):
+        self.strategy = strategy
+        self.chunk_size = chunk_size
+        self.min_tokens = min(min_tokens, chunk_size)
+        self.chunk_overlap = chunk_overlap
+        self._splitter = None
+        self._stats = defaultdict(lambda: {'documents': 0, 'chunks': 0, 'tokens': 0, 'embed_tokens': 0})
+        self._lock = threading.Lock()
+
+    @property
+    def splitter(self):
+        # Created on first use: loading the tokenizer is slow and not needed at startup
+        if self._splitter is None:
+            self._splitter = SentenceSplitter(chunk_size=self.chunk_size, chunk_overlap=self.chunk_overlap)
+        return self._splitter
+
+    def strategy_for(self, document):
+        """
+        Pick the chunking strategy of a document from its source type
+        """
+        if self.strategy != 'auto':
+            return self.strategy
+        file_name = document.metadata.get('file_name')
+        if file_name is None:
+            return 'markdown'  # Web pages are converted to markdown by html2text
+        extension = os.path.splitext(file_name)[1].lower()
+        if extension == '.pdf' or 'page_label' in document.metadata:
+            return 'page'
+        if extension == '.docx':
+            return 'section'
+        return 'sentence'
+
+    def _heading(self, lines, position, strategy):
+        """
+        Return (level, title) if the line at position is a heading for this strategy, else None
+        """
+        line = lines[position].strip()
+        if strategy == 'markdown':
+            match = self.MARKDOWN_HEADING.match(line)
+            return (len(match.group(1)), match.group(2)) if match else None
+        if strategy == 'section':
+            # DOCX text has no heading markup: a short standalone line without closing punctuation
+            standalone = (position == 0 or not lines[position - 1].strip()) and \
+                (position + 1 == len(lines) or not lines[position + 1].strip())
+            if standalone and 0 < len(line) <= 80 and len(line.split()) <= 12 and line[0].isupper() \
+                    and line[-1] not in '.,;:!?)' and '|' not in line:
+                return 1, line
+        return None
+
+    def _sections(self, text, strategy):
+        """
+        Split text into (heading path, blocks) sections, blocks being paragraphs or whole tables
+        """
+        lines = text.splitlines()
+        sections, headings, blocks, block = [], [], [], []
+        for position, line in enumerate(lines):
+            heading = self._heading(lines, position, strategy) if strategy in ('markdown', 'section') else None
+            if heading is not None or not line.strip():
+                if block:
+                    blocks.append('\n'.join(block))
+                    block = []
+            if heading is not None:
+                if blocks:
+                    sections.append((' > '.join(title for _, title in headings), blocks))
+                    blocks = []
+                level, title = heading
+                headings = [item for item in headings if item[0] < level] + [(level, title)]
+                blocks.append(line.strip())
+            elif line.strip():
+                block.append(line)
+        if block:
+            blocks.append('\n'.join(block))
+        if blocks:
+            sections.append((' > '.join(title for _, title in headings), blocks))
+        return sections
+
+    def _split_block(self, block, chunk_size):
+        """
+        Split a block larger than chunk_size: tables by rows (repeating the header), other text by sentences
+        """
+        splitter = self.splitter
+        if chunk_size != self.chunk_size:
+            splitter = SentenceSplitter(chunk_size=chunk_size, chunk_overlap=min(self.chunk_overlap, chunk_size // 2))
+        lines = block.splitlines()
+        if len(lines) < 3 or not all('|' in line for line in lines):
+            return splitter.split_text(block)
+        header = lines[:2] if self.TABLE_SEPARATOR.match(lines[1]) else lines[:1]
+        budget = chunk_size - count_tokens('\n'.join(header))
+        pieces, rows, rows_tokens = [], [], 0
+        for row in lines[len(header):]:
+            row_tokens = count_tokens(row) + 1
+            if rows and rows_tokens + row_tokens > budget:
+                pieces.append('\n'.join(header + rows))
+                rows, rows_tokens = [], 0
+            rows.append(row)
+            rows_tokens += row_tokens
+        if rows:
+            pieces.append('\n'.join(header + rows))
+        # Rows that are too long on their own are split by sentences
+        return [part for piece in pieces for part in (splitter.split_text(piece) if count_tokens(piece) > chunk_size else [piece])]
+
+    def _pack(self, document, strategy):
+        """
+        Pack the blocks of a document into (section, text) chunks of at most chunk_size tokens
+        A new section starts a new chunk once the current chunk has min_tokens
+        """
+        if strategy == 'sentence':
+            return [('', text) for text in self.splitter.split_text(document.text)]
+        chunks, current, current_tokens, current_section = [], [], 0, ''
+
+        def flush():
+            if current:
+                chunks.append((current_section, '\n\n'.join(current)))
+
+        for section, blocks in self._sections(document.text, strategy):
+            if current_tokens >= self.min_tokens:
+                flush()
+                current, current_tokens = [], 0
+            if not current:
+                current_section = section
+            for block in blocks:
+                tokens = count_tokens(block) + 1
+                if tokens > self.chunk_size:
+                    # A short lead-in (e.g. the section heading) stays with the first piece of the block
+                    lead = current if current_tokens < self.min_tokens else []
+                    if not lead:
+                        flush()
+                    pieces = self._split_block(block, self.chunk_size - (current_tokens if lead else 0))
+                    if lead:
+                        chunks.append((current_section, '\n\n'.join(lead + pieces[:1])))
+                        pieces = pieces[1:]
+                    chunks.extend((section, piece) for piece in pieces)
+                    current, current_tokens, current_section = [], 0, section
+                    continue
+                if current_tokens + tokens > self.chunk_size:
+                    flush()
+                    current, current_tokens, current_section = [], 0, section
+                current.append(block)
+                current_tokens += tokens
+        flush()
+        return chunks
+
+    def chunk(self, documents):
+        """
+        Split documents into linked text nodes, adding per-strategy counts to the chunking report
+        """
+        nodes, stats = [], defaultdict(lambda: {'documents': 0, 'chunks': 0, 'tokens': 0, 'embed_tokens': 0})
+        for document in documents:
+            strategy = self.strategy_for(document)
+            document_nodes = []
+            for section, text in self._pack(document, strategy):
+                if not text.strip():
+                    continue
+                metadata = dict(document.metadata)
+                if section:
+                    metadata['section'] = section
+                node = TextNode(
+                    text=text,
+                    metadata=metadata,
+                    excluded_embed_metadata_keys=document.excluded_embed_metadata_keys + CHUNK_METADATA_KEYS,
+                    excluded_llm_metadata_keys=document.excluded_llm_metadata_keys + CHUNK_METADATA_KEYS,
+                    relationships={NodeRelationship.SOURCE: document.as_related_node_info()}
+                )
+                node.metadata['chunk_tokens'] = count_tokens(text)
+                document_nodes.append(node)
+            for previous, node in zip(document_nodes, document_nodes[1:]):
+                node.relationships[NodeRelationship.PREVIOUS] = RelatedNodeInfo(node_id=previous.node_id)
+                previous.relationships[NodeRelationship.NEXT] = RelatedNodeInfo(node_id=node.node_id)
+
+            entry = stats[strategy]
+            entry['documents'] += 1
+            entry['chunks'] += len(document_nodes)
+            for node in document_nodes:
+                entry['tokens'] += node.metadata['chunk_tokens']
+                metadata_str = node.get_metadata_str(mode=MetadataMode.EMBED)
+                entry['embed_tokens'] += node.metadata['chunk_tokens'] + (count_tokens(metadata_str) + 2 if metadata_str else 0)
+            nodes.extend(document_nodes)
+
+        with self._lock:
+            for strategy, entry in stats.items():
+                for key, value in entry.items():
+                    self._stats[strategy][key] += value
+        return nodes
+
+    def report(self):
+        """
+        Return chunk counts, token counts and estimated embedding cost per strategy (since process start)
+        """
+        with self._lock:
+            return {
+                strategy: {
+                    **entry,
+                    'mean_chunk_tokens': entry['tokens'] / entry['chunks'] if entry['chunks'] else 0.0,
+                    'embedding_cost_usd': entry['embed_tokens'] / 1000 * EMBEDDING_COST_PER_1K_TOKENS
+                }
+                for strategy, entry in self._stats.items()
+            }
+
+# Shared chunker (process-wide, see DocumentChunker)
+document_chunker = DocumentChunker()
+
+# Document Ingestion Parameters
+DOCUMENT_PARSE_WORKERS = int(os.getenv('DOCUMENT_PARSE_WORKERS', min(2, os.cpu_count() or 1)))  # Parser processes
+DOCUMENT_PARSE_IDLE_TIMEOUT = float(os.getenv('DOCUMENT_PARSE_IDLE_TIMEOUT', 60))  # Seconds without work before the parser processes exit
+DOCUMENT_INGEST_BATCH_SIZE = 4  # Parsed files embedded and inserted per batch
+FILE_METADATA_KEYS = ["file_name", "file_type", "file_size"]  # Excluded from embeddings and LLM prompts
 
 def load_document_data(documents_directory):
     """
     Read documents from the ./data subdirectory
     """
-    documents = SimpleDirectoryReader(documents_directory).load_data()
+    with tracer.span('load_document_data') as span:
+        documents = SimpleDirectoryReader(documents_directory).load_data()
+        span.set(documents=len(documents))
     return documents
 
+# Process pool for document parsing (created on first use, shared by all sessions, shut down when idle)
+_parse_executor = None
+_parse_executor_lock = threading.RLock()
+_parse_tasks = 0  # Files submitted and not parsed yet
+_parse_idle_timer = None
+
+def _get_parse_executor():
+    global _parse_executor
+    with _parse_executor_lock:
+        if _parse_executor is None:
+            # Spawn fresh workers instead of forking the multi-threaded Streamlit server
+            _parse_executor = ProcessPoolExecutor(
+                max_workers=DOCUMENT_PARSE_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _parse_executor
+
+def _submit_parse(file_name, data, parent_span=None):
+    """
+    Submit one file to the parser pool, returns the pool and the future of its parse result
+    A 'parse_document' span covers the file from submission (including the wait for a free worker) to its result
+    """
+    global _parse_tasks, _parse_idle_timer
+    span = tracer.start_span('parse_document', parent=parent_span, file_name=file_name, bytes=len(data))
+    with _parse_executor_lock:
+        if _parse_idle_timer is not None:
+            _parse_idle_timer.cancel()
+            _parse_idle_timer = None
+        executor = _get_parse_executor()
+        try:
+            future = executor.submit(parse_document_bytes, file_name, data)
+        except BrokenProcessPool:
+            # A worker died while the pool was idle, start a fresh pool
+            _reset_parse_executor(executor)
+            executor = _get_parse_executor()
+            future = executor.submit(parse_document_bytes, file_name, data)
+        _parse_tasks += 1
+    future.add_done_callback(_parse_task_done)
+    future.add_done_callback(lambda future: _end_parse_span(span, future))
+    return executor, future
+
+def _end_parse_span(span, future):
+    if future.cancelled():
+        span.set(error='cancelled')
+    elif future.exception() is not None:
+        span.set(error=type(future.exception()).__name__)
+    else:
+        span.set(pages=len(future.result()))
+    span.end()
+
+def _parse_task_done(future):
+    """
+    Start the idle countdown of the parser pool once its last file has been parsed
+    """
+    global _parse_tasks, _parse_idle_timer
+    with _parse_executor_lock:
+        _parse_tasks -= 1
+        if _parse_tasks == 0 and _parse_executor is not None:
+            _parse_idle_timer = threading.Timer(DOCUMENT_PARSE_IDLE_TIMEOUT, _shutdown_idle_parse_executor, args=(_parse_executor,))
+            _parse_idle_timer.daemon = True
+            _parse_idle_timer.start()
+
+def _shutdown_idle_parse_executor(executor):
+    """
+    Stop the parser processes if no file was submitted since the pool became idle (the next upload starts a new pool)
+    """
+    global _parse_executor, _parse_idle_timer
+    with _parse_executor_lock:
+        if _parse_executor is not executor or _parse_tasks:
+            return
+        _parse_executor = None
+        _parse_idle_timer = None
+    executor.shutdown(wait=False)
+
+def _reset_parse_executor(executor):
+    """
+    Drop a broken parser pool so the next file starts a fresh one
+    """
+    global _parse_executor
+    with _parse_executor_lock:
+        if _parse_executor is executor:
+            _parse_executor = None
+    executor.shutdown(wait=False)
+
+def _parsed_file_result(executor, future, file_name, file_size):
+    """
+    Turn a finished parse future into a result dict ({'file_name', 'documents', 'error'})
+    """
+    try:
+        parsed = future.result()
+    except Exception as e:
+        if isinstance(e, BrokenProcessPool):
+            # A worker died (e.g. out of memory), start a fresh pool for the next upload
+            _reset_parse_executor(executor)
+        return {'file_name': file_name, 'documents': [], 'error': f"{type(e).__name__}: {e}"}
+
+    # Same metadata layout as SimpleDirectoryReader
+    documents = [
+        Document(
+            text=text,
+            metadata={**metadata, 'file_type': mimetypes.guess_type(file_name)[0], 'file_size': file_size},
+            excluded_embed_metadata_keys=list(FILE_METADATA_KEYS),
+            excluded_llm_metadata_keys=list(FILE_METADATA_KEYS)
+        )
+        for text, metadata in parsed
+    ]
+    return {'file_name': file_name, 'documents': documents, 'error': None}
+
+def iter_document_data(files):
+    """
+    Parse in-memory files, given as (file_name, bytes) tuples, in parallel across a process pool (one file per worker)
+    Yields one result dict per file ({'file_name', 'documents', 'error'}) in completion order
+    """
+    parse_span = tracer.start_span('parse_documents')
+    futures = {}
+    for file_name, data in files:
+        executor, future = _submit_parse(file_name, data, parse_span)
+        futures[future] = (executor, file_name, len(data))
+    parse_span.set(files=len(futures))
+    try:
+        for future in as_completed(futures):
+            executor, file_name, file_size = futures[future]
+            yield _parsed_file_result(executor, future, file_name, file_size)
+    finally:
+        parse_span.end()
+
+async def aiter_document_data(files):
+    """
+    Async variant of iter_document_data: awaits the process pool instead of blocking the event loop
+    """
+    parse_span = tracer.start_span('parse_documents')
+    futures = {}
+    for file_name, data in files:
+        executor, future = _submit_parse(file_name, data, parse_span)
+        futures[asyncio.wrap_future(future)] = (executor, file_name, len(data))
+    parse_span.set(files=len(futures))
+    pending = set(futures)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                executor, file_name, file_size = futures[future]
+                yield _parsed_file_result(executor, future, file_name, file_size)
+    finally:
+        parse_span.end()
+
+def file_hash(data):
+    """
+    Dedup key of an uploaded file: a hash of its bytes, whatever its name (checked before the file is parsed)
+    """
+    return 'file:' + hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def _skip_known_files(index, files, dedup_stats=None):
+    """
+    Drop uploaded files whose bytes are already in the index or the base index, or repeated within the upload
+    Returns the new files, a file name -> file hash mapping for them and the names of the skipped files
+    (also added to dedup_stats['sources'])
+    """
+    stores = _known_stores(index)
+    new_files, file_hashes, skipped = [], {}, []
+    for file_name, data in files:
+        key = file_hash(data)
+        if key in file_hashes.values() or any(store.has_document(key) for store in stores):
+            skipped.append(file_name)
+        else:
+            new_files.append((file_name, data))
+            file_hashes[file_name] = key
+    if dedup_stats is not None:
+        dedup_stats['sources'] = dedup_stats.get('sources', []) + skipped
+    return new_files, file_hashes, skipped
+
+def add_uploaded_files(index, files, batch_size=DOCUMENT_INGEST_BATCH_SIZE, dedup_stats=None):
+    """
+    Parse in-memory files in parallel and insert them into the vector store in batches as they are parsed
+    (batch_size files per batch, whatever their number of pages)
+    Files already uploaded, under any name, are skipped without being parsed
+    Yields one result dict per file ({'file_name', 'documents', 'error'}); failed files do not affect the others
+    """
+    files, file_hashes, skipped = _skip_known_files(index, files, dedup_stats)
+    for file_name in skipped:
+        yield {'file_name': file_name, 'documents': [], 'error': None}
+    batch, batch_hashes = [], {}
+    for result in iter_document_data(files):
+        if result['documents']:
+            batch.extend(result['documents'])
+            batch_hashes[file_hashes[result['file_name']]] = [document.id_ for document in result['documents']]
+        if len(batch_hashes) >= batch_size:
+            add_documents(index, batch, dedup_stats, batch_hashes)
+            batch, batch_hashes = [], {}
+        yield result
+    if batch:
+        add_documents(index, batch, dedup_stats, batch_hashes)
+
+async def aadd_uploaded_files(index, files, batch_size=DOCUMENT_INGEST_BATCH_SIZE, dedup_stats=None):
+    """
+    Async variant of add_uploaded_files
+    """
+    files, file_hashes, skipped = _skip_known_files(index, files, dedup_stats)
+    for file_name in skipped:
+        yield {'file_name': file_name, 'documents': [], 'error': None}
+    batch, batch_hashes = [], {}
+    async for result in aiter_document_data(files):
+        if result['documents']:
+            batch.extend(result['documents'])
+            batch_hashes[file_hashes[result['file_name']]] = [document.id_ for document in result['documents']]
+        if len(batch_hashes) >= batch_size:
+            await aadd_documents(index, batch, dedup_stats, batch_hashes)
+            batch, batch_hashes = [], {}
+        yield result
+    if batch:
+        await aadd_documents(index, batch, dedup_stats, batch_hashes)
+
+# Web Ingestion Parameters
+WEB_FETCH_CONCURRENCY = int(os.getenv('WEB_FETCH_CONCURRENCY', 16))  # Maximum parallel requests overall
+WEB_FETCH_PER_HOST = int(os.getenv('WEB_FETCH_PER_HOST', 4))  # Maximum parallel requests per host
+WEB_FETCH_TIMEOUT = float(os.getenv('WEB_FETCH_TIMEOUT', 20))  # Seconds
+WEB_FETCH_RETRIES = int(os.getenv('WEB_FETCH_RETRIES', 2))  # Retries on timeouts, connection errors, 429 and 5xx
+WEB_FETCH_MAX_RETRY_AFTER = float(os.getenv('WEB_FETCH_MAX_RETRY_AFTER', 60))  # Seconds, upper bound on a 429 Retry-After wait
+WEB_INGEST_BATCH_SIZE = 8  # Web pages embedded and inserted per batch
+
 def load_web_data(urls):
     """
     Read html texts from a list of web urls
     """
-    documents = SimpleWebPageReader(html_to_text=True).load_data(urls)
+    from llama_index.readers.web import SimpleWebPageReader
+    with tracer.span('load_web_data', urls=len(urls)) as span:
+        documents = SimpleWebPageReader(html_to_text=True).load_data(urls)
+        span.set(documents=len(documents))
     return documents
 
+async def aload_web_data(urls):
+    """
+    Async variant of load_web_data: fetches the pages concurrently without blocking the event loop
+    Raises if a page cannot be loaded
+    """
+    with tracer.span('load_web_data', urls=len(urls)) as span:
+        results = {result['url']: result async for result in aiter_web_pages(urls)}
+        failed = [f"{url} ({result['error']})" for url, result in results.items() if result['error']]
+        if failed:
+            raise RuntimeError(f"Error loading {', '.join(failed)}")
+        documents = [results[url]['document'] for url in dict.fromkeys(urls)]
+        span.set(documents=len(documents))
+    return documents
+
+async def _afetch_web_page(client, url, global_limit, host_limit):
+    """
+    Fetch one web page and convert its HTML to text, retrying transient failures with exponential backoff
+    (or after the server's Retry-After delay on HTTP 429)
+    Never raises: returns a result dict with either 'document' or 'error' set
+    """
+    with tracer.span('fetch_web_page', url=url) as span:
+        result = await _afetch_web_page_attempts(client, url, global_limit, host_limit, span)
+        span.set(error=result['error'])
+        return result
+
+def _retry_after(response):
+    """
+    Seconds to wait before retrying a rate-limited (HTTP 429) response, from its Retry-After header
+    The header is either a number of seconds or an HTTP date, None when missing or unparsable
+    """
+    value = response.headers.get('Retry-After', '').strip()
+    if not value:
+        return None
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            delay = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(delay, 0.0), WEB_FETCH_MAX_RETRY_AFTER)
+
+async def _afetch_web_page_attempts(client, url, global_limit, host_limit, span):
+    error = None
+    retry_after = None
+    for attempt in range(WEB_FETCH_RETRIES + 1):
+        if attempt:
+            await asyncio.sleep(0.5 * 2 ** (attempt - 1) if retry_after is None else retry_after)
+        span.set(attempts=attempt + 1)
+        retry_after = None
+        try:
+            # Wait for the host's slot before taking a global one, so requests queued behind
+            # a busy host don't hold global slots that requests to other hosts could use
+            async with host_limit:
+                async with global_limit:
+                    response = await client.get(url)
+            span.set(status=response.status_code)
+            if response.status_code == 429 or response.status_code >= 500:
+                error = f"HTTP {response.status_code}"
+                if response.status_code == 429:
+                    retry_after = _retry_after(response)
+                continue
+            response.raise_for_status()
+            span.set(bytes=len(response.content))
+            # HTML to text conversion is CPU-bound, keep it off the event loop
+            with tracer.span('html_to_text'):
+                text = await asyncio.to_thread(html2text.html2text, response.text)
+            return {'url': url, 'document': Document(text=text, id_=url), 'error': None}
+        except (httpx.TimeoutException, httpx.TransportError) as e:
+            error = f"{type(e).__name__}: {e}"
+        except httpx.HTTPStatusError as e:
+            return {'url': url, 'document': None, 'error': f"HTTP {e.response.status_code}"}
+        except Exception as e:
+            return {'url': url, 'document': None, 'error': f"{type(e).__name__}: {e}"}
+    return {'url': url, 'document': None, 'error': error}
+
+async def aiter_web_pages(urls):
+    """
+    Fetch web pages concurrently over a pooled HTTP client (bounded overall and per host)
+    Yields one result dict per URL ({'url', 'document', 'error'}) in completion order
+    """
+    global_limit = asyncio.Semaphore(WEB_FETCH_CONCURRENCY)
+    host_limits = defaultdict(lambda: asyncio.Semaphore(WEB_FETCH_PER_HOST))
+    limits = httpx.Limits(max_connections=WEB_FETCH_CONCURRENCY, max_keepalive_connections=WEB_FETCH_CONCURRENCY)
+    # Not activated around the yields, the consumer's spans (e.g. add_documents) are not part of the fetch
+    fetch_span = tracer.start_span('fetch_web_pages')
+    try:
+        async with httpx.AsyncClient(timeout=WEB_FETCH_TIMEOUT, limits=limits, follow_redirects=True) as client:
+            # Tasks copy the current context, so their fetch_web_page spans nest under fetch_span
+            with tracer.use_span(fetch_span):
+                tasks = [
+                    asyncio.create_task(_afetch_web_page(client, url, global_limit, host_limits[urlsplit(url).netloc]))
+                    for url in dict.fromkeys(urls)
+                ]
+            fetch_span.set(urls=len(tasks))
+            for task in asyncio.as_completed(tasks):
+                yield await task
+    finally:
+        fetch_span.end()
+
+def iter_web_pages(urls):
+    """
+    Synchronous wrapper around aiter_web_pages: runs the fetcher on a background event loop
+    and yields result dicts as soon as each page arrives
+    """
+    results = queue.Queue()
+    done = object()
+
+    async def produce():
+        try:
+            async for result in aiter_web_pages(urls):
+                results.put(result)
+        finally:
+            results.put(done)
+
+    threading.Thread(target=asyncio.run, args=(produce(),), daemon=True).start()
+    while (result := results.get()) is not done:
+        yield result
+
+def add_web_pages(index, urls, batch_size=WEB_INGEST_BATCH_SIZE, dedup_stats=None):
+    """
+    Concurrently fetch web pages and insert the successful ones into the vector store in batches as they arrive
+    Yields one result dict per URL ({'url', 'document', 'error'}); failed URLs do not affect the others
+    """
+    batch = []
+    for result in iter_web_pages(urls):
+        if result['document'] is not None:
+            batch.append(result['document'])
+            if len(batch) >= batch_size:
+                add_documents(index, batch, dedup_stats)
+                batch = []
+        yield result
+    if batch:
+        add_documents(index, batch, dedup_stats)
+
+async def aadd_web_pages(index, urls, batch_size=WEB_INGEST_BATCH_SIZE, dedup_stats=None):
+    """
+    Async variant of add_web_pages
+    """
+    batch = []
+    async for result in aiter_web_pages(urls):
+        if result['document'] is not None:
+            batch.append(result['document'])
+            if len(batch) >= batch_size:
+                await aadd_documents(index, batch, dedup_stats)
+                batch = []
+        yield result
+    if batch:
+        await aadd_documents(index, batch, dedup_stats)
+
+class IngestJob:
+    """
+    Background ingestion of web pages or in-memory files into an index, on its own thread and event loop
+    Progress (completed, failed, status) can be read at any time from other threads, e.g. the Streamlit script thread
+    """
+    def __init__(self, index, urls=None, files=None):
+        if (urls is None) == (files is None):
+            raise ValueError("Pass either urls or files")
+        self.index = index
+        self.source_type = 'Website' if urls is not None else 'Document'
+        self.sources = list(dict.fromkeys(urls)) if urls is not None else [file_name for file_name, _ in files]
+        self.total = len(self.sources)
+        self.completed = 0
+        self.failed = []
+        # Sources already in the index, other duplicate documents skipped, duplicate chunks sharing a vector
+        self.dedup_stats = {'sources': [], 'documents': 0, 'chunks': 0}
+        self.status = 'pending'  # 'pending', 'running', 'done' or 'error'
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+        self._urls = urls
+        self._files = files
+        self._thread = None
+
+    @property
+    def done(self):
+        return self.status in ('done', 'error')
+
+    @property
+    def progress(self):
+        return self.completed / self.total if self.total else 1.0
+
+    def start(self):
+        self.status = 'running'
+        self.started_at = time.time()
+        self._thread = threading.Thread(target=asyncio.run, args=(self._run(),), daemon=True)
+        self._thread.start()
+        return self
+
+    def wait(self, timeout=None):
+        """
+        Block until the job has finished (or the timeout has passed), returns whether it has finished
+        """
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return self.done
+
+    async def _run(self):
+        # One trace per job: fetch_web_pages/parse_documents, add_documents batches and the save nest under it
+        with tracer.span('ingest_job', source_type=self.source_type, sources=self.total) as span:
+            try:
+                if self._urls is not None:
+                    results, key = aadd_web_pages(self.index, self._urls, dedup_stats=self.dedup_stats), 'url'
+                else:
+                    results, key = aadd_uploaded_files(self.index, self._files, dedup_stats=self.dedup_stats), 'file_name'
+                async for result in results:
+                    if result['error']:
+                        self.failed.append(result[key])
+                    self.completed += 1
+            except Exception as e:
+                self.error = f"{type(e).__name__}: {e}"
+            finally:
+                # Release the uploaded file contents
+                self._files = None
+
+            try:
+                # Persist what was added (also after a failure) when the index is a named knowledge base
+                with tracer.span('save_knowledge_base'):
+                    await asyncio.to_thread(knowledge_bases.save_index, self.index)
+            except Exception as e:
+                self.error = self.error or f"{type(e).__name__}: {e}"
+            span.set(failed=len(self.failed), duplicate_sources=len(self.dedup_stats['sources']), error=self.error)
+        self.status = 'error' if self.error else 'done'
+        self.finished_at = time.time()
+
 def create_vector_store(documents):
     """
     Create in-memory vector store
     """
-    index = VectorStoreIndex.from_documents(documents)
+    with tracer.span('create_vector_store', documents=len(documents)):
+        storage_context = StorageContext.from_defaults(vector_store=MatrixVectorStore())
+        index = VectorStoreIndex(nodes=[], storage_context=storage_context, embed_model=get_embed_model())
+        return add_documents(index, documents)
+
+def _known_stores(index):
+    """
+    Vector stores checked for duplicate content: the index itself and, for session indexes searched together
+    with it, the shared base index (named knowledge bases are searched on their own)
+    """
+    stores = [index.vector_store]
+    if _base_index is not None and _base_index is not index and knowledge_bases.name_of(index) is None:
+        stores.append(_base_index.vector_store)
+    return stores
+
+def document_source(document):
+    """
+    Get the source of a document before chunking (filename for documents, URL for web pages)
+    """
+    return document.metadata.get('file_name') or document.id_
+
+def document_hash(source, text_hash):
+    """
+    Dedup key of a document: its content hash within its source
+    The same page under another file or URL is indexed again (its chunks share the existing vectors),
+    so removing one source never takes content of another with it
+    """
+    return content_hash(f"{source} {text_hash}")
+
+def _dedup_documents(index, documents, dedup_stats=None):
+    """
+    Drop documents already in the index or the base index under the same source, or repeated within the batch
+    Returns the new documents and a document hash -> document id mapping for them
+    Adds to dedup_stats the sources with no new document ('sources') and the other skipped documents ('documents')
+    """
+    stores = _known_stores(index)
+    document_hashes, source_added, skipped = {}, {}, Counter()
+    for document in documents:
+        source = document_source(document)
+        key = document_hash(source, content_hash(document.text))
+        new = key not in document_hashes and not any(store.has_document(key) for store in stores)
+        if new:
+            document_hashes[key] = document
+        else:
+            skipped[source] += 1
+        source_added[source] = source_added.get(source, False) or new
+    if dedup_stats is not None:
+        duplicate_sources = [source for source, added in source_added.items() if not added]
+        dedup_stats['sources'] = dedup_stats.get('sources', []) + duplicate_sources
+        dedup_stats['documents'] = dedup_stats.get('documents', 0) + sum(
+            count for source, count in skipped.items() if source_added[source])
+    return list(document_hashes.values()), {key: document.id_ for key, document in document_hashes.items()}
+
+def _share_chunk_embeddings(index, nodes):
+    """
+    Give chunks whose content is already embedded (in the index, the base index or earlier in the batch) the same vector
+    Returns the nodes that still need an embedding and the (duplicate, original) node pairs to copy once embedded
+    """
+    chunk_hashes = [node_chunk_hash(node) for node in nodes]
+    known = {}
+    for store in _known_stores(index):
+        for chunk_hash, vector in store.chunk_embeddings(set(chunk_hashes) - known.keys()).items():
+            known[chunk_hash] = vector.tolist()
+
+    pending, copies, originals = [], [], {}
+    for node, chunk_hash in zip(nodes, chunk_hashes):
+        if chunk_hash in known:
+            node.embedding = known[chunk_hash]
+        elif chunk_hash in originals:
+            copies.append((node, originals[chunk_hash]))
+        else:
+            originals[chunk_hash] = node
+            pending.append(node)
+    return pending, copies
+
+def _file_document_hashes(file_hashes, nodes):
+    """
+    Map each uploaded file hash (file hash -> ids of the documents parsed from the file) to one of its inserted
+    reference documents, so the file is known while its source is in the index and forgotten once it is removed
+    """
+    inserted = {node.ref_doc_id for node in nodes}
+    return {
+        key: next(ref_doc_id for ref_doc_id in ref_doc_ids if ref_doc_id in inserted)
+        for key, ref_doc_ids in (file_hashes or {}).items() if inserted.intersection(ref_doc_ids)
+    }
+
+def _check_writable(index):
+    if index is _base_index:
+        raise ValueError("The shared base index is read-only, add documents to a session index instead")
+
+def _prepare_embeddings(index, nodes, document_hashes, dedup_stats=None, file_hashes=None):
+    """
+    Step of add_documents between chunking and embedding: records the uploaded files of the new nodes
+    and gives repeated chunks an existing vector (shared chunks are counted in dedup_stats)
+    Returns the nodes that still need an embedding and the (duplicate, original) node pairs to copy once embedded
+    """
+    document_hashes.update(_file_document_hashes(file_hashes, nodes))
+    pending, copies = _share_chunk_embeddings(index, nodes)
+    if dedup_stats is not None:
+        dedup_stats['chunks'] = dedup_stats.get('chunks', 0) + len(nodes) - len(pending)
+    return pending, copies
+
+@contextlib.contextmanager
+def _embed_span(nodes, pending):
+    """
+    Span around embedding the pending nodes, with embedding cache hits and the scheduler's request stats
+    """
+    with tracer.span('embed', chunks=len(pending), shared_chunks=len(nodes) - len(pending)) as span:
+        cache_hits = getattr(embed_model, 'hits', 0)
+        yield span
+        span.set(cache_hits=getattr(embed_model, 'hits', 0) - cache_hits, **(embedding_scheduler.last_run or {}))
+
+def add_documents(index, documents, dedup_stats=None, file_hashes=None):
+    """
+    Chunk and embed only the new documents, then insert their nodes into an existing vector store
+    Duplicate documents are skipped and duplicate chunks reuse an existing vector, before any embedding call
+    Counts of skipped documents and shared chunks are added to dedup_stats when given
+    file_hashes (file hash -> document ids) records the uploaded files the documents were parsed from
+    """
+    _check_writable(index)
+    with tracer.span('add_documents', documents=len(documents)) as span:
+        documents, document_hashes = _dedup_documents(index, documents, dedup_stats)
+        span.set(new_documents=len(documents))
+
+        # Split new documents into linked chunks along their structure
+        with tracer.span('chunk') as span:
+            nodes = document_chunker.chunk(documents)
+            span.set(chunks=len(nodes))
+
+        # Embed the new nodes concurrently, then insert them (existing nodes are left untouched)
+        pending, copies = _prepare_embeddings(index, nodes, document_hashes, dedup_stats, file_hashes)
+        with _embed_span(nodes, pending):
+            embedding_scheduler.embed_nodes(pending)
+        _insert_nodes(index, nodes, copies, documents, document_hashes)
+    return index
+
+async def aadd_documents(index, documents, dedup_stats=None, file_hashes=None):
+    """
+    Async variant of add_documents: chunking runs in a worker thread and embedding requests are awaited
+    """
+    _check_writable(index)
+    with tracer.span('add_documents', documents=len(documents)) as span:
+        documents, document_hashes = _dedup_documents(index, documents, dedup_stats)
+        span.set(new_documents=len(documents))
+        with tracer.span('chunk') as span:
+            nodes = await asyncio.to_thread(document_chunker.chunk, documents)
+            span.set(chunks=len(nodes))
+        pending, copies = _prepare_embeddings(index, nodes, document_hashes, dedup_stats, file_hashes)
+        with _embed_span(nodes, pending):
+            await embedding_scheduler.aembed_nodes(pending)
+        _insert_nodes(index, nodes, copies, documents, document_hashes)
     return index
 
+def _insert_nodes(index, nodes, copies, documents, document_hashes):
+    """
+    Insert embedded nodes while holding the store lock, so concurrent searches never see half-inserted nodes
+    Duplicate chunks (copies) get the vector of their original first
+    """
+    for node, original in copies:
+        node.embedding = original.embedding
+    with tracer.span('insert', chunks=len(nodes)):
+        with index.vector_store.lock:
+            index.insert_nodes(nodes)
+            index.vector_store.add_document_hashes(document_hashes)
+            for document in documents:
+                index.docstore.set_document_hash(document.id_, document.hash)
+
+def remove_source(index, source):
+    """
+    Delete all nodes originating from a source (website URL or document filename) from the vector store
+    """
+    if index is _base_index:
+        raise ValueError("The shared base index is read-only, remove sources from a session index instead")
+
+    # A source may span several reference documents (e.g. one per PDF page)
+    entry = get_source_registry(index).get(source)
+    if entry is None:
+        return index
+    ref_doc_ids = {node.ref_doc_id for node in index.docstore.get_nodes(list(entry['node_ids'])) if node.ref_doc_id}
+
+    with index.vector_store.lock:
+        for ref_doc_id in ref_doc_ids:
+            index.delete_ref_doc(ref_doc_id, delete_from_docstore=True)
+    knowledge_bases.save_index(index)
+    return index
+
+def get_source_registry(index):
+    """
+    Get the source registry (source -> type, node ids, chunk count, byte size, ingest time) of a vector store
+    """
+    return index.vector_store.registry
+
+# Persistence Parameters
+DEFAULT_INDEX_DIR = os.getenv('DEFAULT_INDEX_DIR', './storage/default')
+DEFAULT_URLS = [
+    "https://www.apple.com/newsroom/2024/02/apple-reports-first-quarter-results/",
+    "https://www.apple.com/newsroom/2024/05/apple-reports-second-quarter-results/",
+    "https://www.apple.com/newsroom/2024/08/apple-reports-third-quarter-results/",
+    "https://www.apple.com/newsroom/2024/10/apple-reports-fourth-quarter-results/"
+]
+
+# Data files of a saved vector store before generation suffixes (still loaded)
+LEGACY_VECTOR_STORE_FILES = {'vectors': 'vectors.f32', 'ivf_centroids': 'ivf_centroids.f32', 'ivf_assignments': 'ivf_assignments.i32'}
+VECTOR_STORE_DATA_EXTENSIONS = ('.f32', '.i32', '.jsonl')  # Data files removed once no nodes.json names them
+
+def _saved_files(persist_dir):
+    """
+    Data file names referenced by the nodes.json of a saved vector store (empty if there is none)
+    """
+    try:
+        with open(os.path.join(persist_dir, 'nodes.json'), encoding='utf-8') as f:
+            return set(json.load(f).get('files', LEGACY_VECTOR_STORE_FILES).values())
+    except (OSError, ValueError):
+        return set()
+
+def _write_array(path, array, dtype):
+    with open(path, 'wb') as f:
+        np.ascontiguousarray(array, dtype=dtype).tofile(f)
+        f.flush()
+        os.fsync(f.fileno())
+
+def _check_file_size(path, expected_bytes):
+    size = os.path.getsize(path)
+    if size != expected_bytes:
+        raise ValueError(f"{path} has {size} bytes instead of {expected_bytes}, the saved index is incomplete")
+
+def _node_record(node):
+    return {
+        'id': node.node_id,
+        'ref_doc_id': node.ref_doc_id,
+        'prev_id': node.prev_node.node_id if node.prev_node else None,
+        'next_id': node.next_node.node_id if node.next_node else None,
+        'text': node.text,
+        'metadata': node.metadata,
+        'excluded_embed_metadata_keys': node.excluded_embed_metadata_keys,
+        'excluded_llm_metadata_keys': node.excluded_llm_metadata_keys
+    }
+
+def _node_from_record(item):
+    relationships = {}
+    if item['ref_doc_id']:
+        relationships[NodeRelationship.SOURCE] = RelatedNodeInfo(node_id=item['ref_doc_id'])
+    if item.get('prev_id'):
+        relationships[NodeRelationship.PREVIOUS] = RelatedNodeInfo(node_id=item['prev_id'])
+    if item.get('next_id'):
+        relationships[NodeRelationship.NEXT] = RelatedNodeInfo(node_id=item['next_id'])
+    return TextNode(
+        id_=item['id'],
+        text=item['text'],
+        metadata=item['metadata'],
+        excluded_embed_metadata_keys=item['excluded_embed_metadata_keys'],
+        excluded_llm_metadata_keys=item['excluded_llm_metadata_keys'],
+        relationships=relationships
+    )
+
+def _snapshot_vector_store(index):
+    """
+    Take what save_vector_store writes while holding the store lock, so the disk writes happen without it
+    The vectors are a view, not a copy: stored rows are never changed in place (deletes compact into a new buffer)
+    """
+    store = index.vector_store
+    with store.lock:
+        node_ids = store.node_ids
+        ivf = store.ivf
+        return {
+            'vectors': store.vectors,
+            'ivf': (ivf.centroids, np.array(ivf.assignments[:len(node_ids)]), ivf.trained_size) if ivf is not None else None,
+            'nodes': index.docstore.get_nodes(node_ids),
+            'ingested_at': {entry['source']: entry['ingested_at'] for entry in store.registry.sources()},
+            'source_document_hashes': store.document_hashes
+        }
+
+def _write_vector_store(snapshot, persist_dir):
+    """
+    Write a snapshot taken by _snapshot_vector_store (see save_vector_store)
+    Returns the state of its change journal for _append_vector_store_changes
+    """
+    os.makedirs(persist_dir, exist_ok=True)
+    vectors, ivf = snapshot['vectors'], snapshot['ivf']
+    sidecar = {
+        'embed_model': get_embed_model().model_name,
+        'count': len(snapshot['nodes']),
+        'dimension': int(vectors.shape[1]),
+        'normalized': True,
+        'ingested_at': snapshot['ingested_at'],
+        'source_document_hashes': snapshot['source_document_hashes'],
+        'nodes': [_node_record(node) for node in snapshot['nodes']]
+    }
+    generation = uuid.uuid4().hex[:12]
+    # The change journal files are created by the first incremental save after this one
+    sidecar['files'] = {
+        'vectors': f'vectors-{generation}.f32',
+        'journal_entries': f'changes-{generation}.jsonl',
+        'journal_vectors': f'changes-{generation}.f32'
+    }
+    if ivf is not None:
+        sidecar['ivf'] = {'nlist': len(ivf[0]), 'trained_size': ivf[2]}
+        sidecar['files'].update(ivf_centroids=f'ivf_centroids-{generation}.f32', ivf_assignments=f'ivf_assignments-{generation}.i32')
+
+    # New data files first (no reader knows their names yet), then switch nodes.json to them in one rename
+    previous_files = _saved_files(persist_dir)
+    _write_array(os.path.join(persist_dir, sidecar['files']['vectors']), vectors, np.float32)
+    if ivf is not None:
+        _write_array(os.path.join(persist_dir, sidecar['files']['ivf_centroids']), ivf[0], np.float32)
+        _write_array(os.path.join(persist_dir, sidecar['files']['ivf_assignments']), ivf[1], np.int32)
+    nodes_path = os.path.join(persist_dir, 'nodes.json')
+    with open(nodes_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(sidecar, f, separators=(',', ':'))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(nodes_path + '.tmp', nodes_path)
+
+    # Keep the previous files for readers that loaded its nodes.json just before the switch
+    keep = previous_files | set(sidecar['files'].values())
+    for file_name in os.listdir(persist_dir):
+        if file_name.endswith(VECTOR_STORE_DATA_EXTENSIONS) and file_name not in keep:
+            # A file still memory-mapped on Windows fails to delete, a later save removes it
+            remove_file(os.path.join(persist_dir, file_name))
+    return {'files': sidecar['files'], 'base_rows': sidecar['count'], 'rows': 0, 'entries': 0}
+
+def save_vector_store(index, persist_dir):
+    """
+    Save vector store to a directory: embeddings as one contiguous float32 matrix (vectors-<generation>.f32)
+    and nodes/metadata as a compact JSON sidecar (nodes.json)
+    A trained IVF index is saved too (ivf_centroids/ivf_assignments-<generation>), so loading does not re-cluster
+    Every save writes new data files and then replaces nodes.json, which names them: a reader sees the old or the
+    new index, never a mix. Files older than the previous save are removed
+    The store lock is only held while the nodes and vectors are collected, not during the writes
+    """
+    _write_vector_store(_snapshot_vector_store(index), persist_dir)
+
+def _snapshot_vector_store_changes(index, first_row, deleted):
+    """
+    Take the rows added from first_row and the deleted reference documents (see MatrixVectorStore.take_unsaved_changes)
+    while holding the store lock, for _append_vector_store_changes
+    """
+    store = index.vector_store
+    with store.lock:
+        nodes = index.docstore.get_nodes(store.node_ids[first_row:])
+        sources = {get_node_source(node) for node in nodes}
+        ref_doc_ids = {node.ref_doc_id for node in nodes}
+        return {
+            'deleted': list(deleted),
+            'vectors': store.vectors[first_row:],
+            'nodes': nodes,
+            'ingested_at': {entry['source']: entry['ingested_at'] for entry in store.registry.sources() if entry['source'] in sources},
+            'source_document_hashes': {key: ref for key, ref in store.document_hashes.items() if ref in ref_doc_ids}
+        }
+
+def _append_vector_store_changes(persist_dir, journal, changes):
+    """
+    Append the changes since the last save to the change journal of a saved vector store, instead of rewriting it:
+    the added vectors to changes-<generation>.f32, then one JSON line (deleted reference documents, added nodes)
+    to changes-<generation>.jsonl. A line is only written once its vectors are on disk, loading stops at a partial line
+    """
+    if not changes['nodes'] and not changes['deleted']:
+        return
+    vectors = np.ascontiguousarray(changes['vectors'], dtype=np.float32)
+    with open(os.path.join(persist_dir, journal['files']['journal_vectors']), 'ab') as f:
+        offset = f.tell()
+        vectors.tofile(f)
+        f.flush()
+        os.fsync(f.fileno())
+    entry = {
+        'deleted': changes['deleted'],
+        'vector_offset': offset,
+        'count': len(changes['nodes']),
+        'dimension': int(vectors.shape[1]),
+        'ingested_at': changes['ingested_at'],
+        'source_document_hashes': changes['source_document_hashes'],
+        'nodes': [_node_record(node) for node in changes['nodes']]
+    }
+    with open(os.path.join(persist_dir, journal['files']['journal_entries']), 'a', encoding='utf-8') as f:
+        f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    journal['rows'] += entry['count']
+    journal['entries'] += 1
+
+def _read_vector_store_changes(files):
+    """
+    Read the change journal of a saved vector store (empty if there is none), each entry with its vectors
+    Stops at an entry left incomplete by an interrupted save
+    """
+    entries_path, vectors_path = files.get('journal_entries'), files.get('journal_vectors')
+    if entries_path is None or not os.path.exists(entries_path):
+        return []
+    vectors_size = os.path.getsize(vectors_path) if os.path.exists(vectors_path) else 0
+    entries = []
+    with open(entries_path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line) if line.endswith('\n') else None
+            except json.JSONDecodeError:
+                entry = None
+            if entry is None or entry['vector_offset'] + 4 * entry['count'] * entry['dimension'] > vectors_size:
+                break
+            entry['vectors'] = np.fromfile(
+                vectors_path, dtype=np.float32, count=entry['count'] * entry['dimension'], offset=entry['vector_offset']
+            ).reshape(entry['count'], entry['dimension'])
+            entries.append(entry)
+    return entries
+
+def _load_vector_store(persist_dir):
+    """
+    Load a saved vector store and its change journal, returns the index and the journal state
+    (None for saves made before the journal existed, their next save is a full one)
+    """
+    with open(os.path.join(persist_dir, 'nodes.json'), encoding='utf-8') as f:
+        sidecar = json.load(f)
+
+    count, dimension = sidecar['count'], sidecar['dimension']
+    file_names = sidecar.get('files', LEGACY_VECTOR_STORE_FILES)
+    files = {name: os.path.join(persist_dir, file_name) for name, file_name in file_names.items()}
+    if count:
+        _check_file_size(files['vectors'], 4 * count * dimension)
+        vectors = np.memmap(files['vectors'], dtype=np.float32, mode='r', shape=(count, dimension))
+    else:
+        vectors = np.empty((0, dimension), dtype=np.float32)
+    ivf = None
+    if 'ivf' in sidecar:
+        nlist = sidecar['ivf']['nlist']
+        _check_file_size(files['ivf_centroids'], 4 * nlist * dimension)
+        _check_file_size(files['ivf_assignments'], 4 * count)
+        ivf = IVFIndex.from_arrays(
+            np.fromfile(files['ivf_centroids'], dtype=np.float32).reshape(nlist, dimension),
+            np.fromfile(files['ivf_assignments'], dtype=np.int32),
+            sidecar['ivf']['trained_size']
+        )
+
+    nodes = [_node_from_record(item) for item in sidecar['nodes']]
+    ingested_at = sidecar.get('ingested_at', {})
+    if 'source_document_hashes' in sidecar:
+        document_hashes = sidecar['source_document_hashes']
+    else:
+        # Older saves keyed documents by content alone, add the source of each reference document
+        ref_doc_sources = {node.ref_doc_id: get_node_source(node) for node in nodes}
+        document_hashes = {
+            document_hash(ref_doc_sources[ref_doc_id], text_hash): ref_doc_id
+            for text_hash, ref_doc_id in sidecar.get('document_hashes', {}).items() if ref_doc_id in ref_doc_sources
+        }
+
+    # Replay the changes saved since: deletes apply to the nodes before them, added nodes are appended
+    changes = _read_vector_store_changes(files)
+    if changes:
+        keep = [True] * count
+        for entry in changes:
+            deleted = set(entry['deleted'])
+            if deleted:
+                keep = [kept and node.ref_doc_id not in deleted for kept, node in zip(keep, nodes)]
+            nodes.extend(_node_from_record(item) for item in entry['nodes'])
+            keep.extend([True] * entry['count'])
+            ingested_at = {**ingested_at, **entry['ingested_at']}
+            document_hashes = {**document_hashes, **entry['source_document_hashes']}
+        keep = np.array(keep, dtype=bool)
+        added = [entry['vectors'] for entry in changes if entry['count']]
+        if added:
+            added = np.concatenate(added)
+            if ivf is not None:
+                ivf.compact(keep[:count])
+                ivf.add(added[keep[count:]])
+            # The replayed matrix is held in memory until the next full save memory-maps it again
+            vectors = np.concatenate([vectors[keep[:count]], added[keep[count:]]]) if count else added[keep[count:]]
+        elif not keep.all():
+            vectors = np.ascontiguousarray(vectors[keep])
+            if ivf is not None:
+                ivf.compact(keep)
+        nodes = [node for node, kept in zip(nodes, keep) if kept]
+        ref_doc_ids = {node.ref_doc_id for node in nodes}
+        document_hashes = {key: ref for key, ref in document_hashes.items() if ref in ref_doc_ids}
+
+    # The vector store uses the memory-mapped matrix directly (no embedding calls), BM25 postings are rebuilt from the texts
+    store = MatrixVectorStore.from_arrays(
+        [node.node_id for node in nodes],
+        [node.ref_doc_id for node in nodes],
+        vectors,
+        normalized=sidecar.get('normalized', False),
+        texts=[node.get_content(metadata_mode=MetadataMode.NONE) for node in nodes],
+        chunk_hashes=[node_chunk_hash(node) for node in nodes],
+        ivf=ivf
+    )
+    store.add_document_hashes(document_hashes)
+    # Rebuild the source registry, keeping the original ingest times
+    for node in nodes:
+        store.registry.add_nodes([node], ingested_at=ingested_at.get(get_node_source(node)))
+    storage_context = StorageContext.from_defaults(vector_store=store)
+    storage_context.docstore.add_documents(nodes)
+    index = VectorStoreIndex(nodes=[], storage_context=storage_context, embed_model=get_embed_model())
+    for node in nodes:
+        index.index_struct.add_node(node, text_id=node.node_id)
+    storage_context.index_store.add_index_struct(index.index_struct)
+
+    journal = None
+    if 'journal_entries' in file_names:
+        journal = {'files': file_names, 'base_rows': count, 'rows': sum(entry['count'] for entry in changes), 'entries': len(changes)}
+    return index, journal
+
+def load_vector_store(persist_dir):
+    """
+    Load a vector store saved with save_vector_store, memory-mapping the embedding matrix instead of re-embedding
+    Changes appended by incremental knowledge base saves are replayed (see KnowledgeBaseManager.save_index)
+    """
+    return _load_vector_store(persist_dir)[0]
+
+def load_default_index():
+    """
+    Load the prebuilt default index from DEFAULT_INDEX_DIR, building and saving it first if it does not exist yet
+    """
+    if os.path.exists(os.path.join(DEFAULT_INDEX_DIR, 'nodes.json')):
+        return load_vector_store(DEFAULT_INDEX_DIR)
+    index = create_vector_store(load_web_data(DEFAULT_URLS))
+    save_vector_store(index, DEFAULT_INDEX_DIR)
+    return index
+
+# Shared base index (one read-only copy per process, see get_base_index)
+_base_index = None
+_base_index_lock = threading.Lock()
+
+def get_base_index():
+    """
+    Get the process-wide read-only base index (default knowledge base), loading it once on first use
+    """
+    global _base_index
+    with _base_index_lock:
+        if _base_index is None:
+            with startup_timer.measure('base index'):
+                _base_index = load_default_index()
+    return _base_index
+
+# Knowledge Base Parameters
+KNOWLEDGE_BASE_DIR = os.getenv('KNOWLEDGE_BASE_DIR', './storage/knowledge_bases')  # One subdirectory per named knowledge base
+KNOWLEDGE_BASE_MEMORY_LIMIT_MB = float(os.getenv('KNOWLEDGE_BASE_MEMORY_LIMIT_MB', 1024))  # Least recently used knowledge bases are evicted above this
+DEFAULT_KNOWLEDGE_BASE = 'default'  # The shared read-only base index
+KNOWLEDGE_BASE_NAME_PATTERN = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_.-]{0,63}$')
+KNOWLEDGE_BASE_JOURNAL_FRACTION = float(os.getenv('KNOWLEDGE_BASE_JOURNAL_FRACTION', 0.25))  # Rewrite a knowledge base once its change journal holds this fraction of its rows
+KNOWLEDGE_BASE_JOURNAL_MIN_ROWS = int(os.getenv('KNOWLEDGE_BASE_JOURNAL_MIN_ROWS', 4096))  # Journals smaller than this are never rewritten for their size
+KNOWLEDGE_BASE_JOURNAL_MAX_ENTRIES = int(os.getenv('KNOWLEDGE_BASE_JOURNAL_MAX_ENTRIES', 1000))  # Rewrite after this many incremental saves
+
+def index_memory_bytes(index):
+    """
+    Approximate RAM held by an index: vectors not memory-mapped, BM25 postings and node texts
+    """
+    usage = index.vector_store.memory_usage()
+    texts = sum(len(node.text) for node in index.docstore.docs.values())
+    return usage['float_bytes'] + usage['quantized_bytes'] + index.vector_store.bm25.nbytes + texts
+
+class KnowledgeBaseManager:
+    """
+    Named knowledge bases, each persisted in its own directory (vectors, nodes and source registry, see save_vector_store)
+    Opened knowledge bases stay in memory in least recently used order; above the memory limit the coldest ones
+    are dropped (they are saved after every change) and loaded again, memory-mapped, when next opened
+    A save appends only the added and deleted rows to a change journal; the whole knowledge base is rewritten
+    when the journal grows past a fraction of it, so a change costs its own size rather than the index size
+    The default knowledge base is the shared read-only base index and is never evicted
+    """
+    def __init__(self, root=KNOWLEDGE_BASE_DIR, memory_limit_mb=KNOWLEDGE_BASE_MEMORY_LIMIT_MB):
+        self.root = root
+        self.memory_limit = int(memory_limit_mb * 1024 * 1024)
+        self.loads = 0
+        self.evictions = 0
+        self._loaded = OrderedDict()  # name -> index, least recently used first
+        self._memory = {}  # name -> approximate bytes, measured when loaded or saved
+        self._evicted = weakref.WeakValueDictionary()  # Evicted indexes still used by a session or an ingest job
+        self._journals = {}  # name -> change journal state of its saved files (see _append_vector_store_changes)
+        self._save_locks = defaultdict(threading.Lock)  # name -> lock serializing its saves (the store lock is not held while writing)
+        self._lock = threading.RLock()
+
+    def path(self, name):
+        if name == DEFAULT_KNOWLEDGE_BASE or not KNOWLEDGE_BASE_NAME_PATTERN.match(name):
+            raise ValueError(f"Invalid knowledge base name '{name}': use up to 64 letters, digits, '.', '_' or '-'")
+        return os.path.join(self.root, name)
+
+    def exists(self, name):
+        return name == DEFAULT_KNOWLEDGE_BASE or os.path.exists(os.path.join(self.path(name), 'nodes.json'))
+
+    def names(self):
+        """
+        Names of all knowledge bases, the default one first
+        """
+        saved = []
+        if os.path.isdir(self.root):
+            saved = sorted(name for name in os.listdir(self.root) if os.path.exists(os.path.join(self.root, name, 'nodes.json')))
+        return [DEFAULT_KNOWLEDGE_BASE] + saved
+
+    def create(self, name):
+        """
+        Create and save an empty knowledge base, raises ValueError if the name is invalid or taken
+        """
+        with self._lock:
+            if self.exists(name):
+                raise ValueError(f"Knowledge base '{name}' already exists")
+            index = create_vector_store([])
+            self._loaded[name] = index
+            self._save(name, index)
+        return index
+
+    def open(self, name):
+        """
+        Get a knowledge base by name, loading it from disk if it is not in memory
+        """
+        if name == DEFAULT_KNOWLEDGE_BASE:
+            return get_base_index()
+        with self._lock:
+            index = self._loaded.get(name)
+            if index is not None:
+                self._loaded.move_to_end(name)
+                self._evict()
+                return index
+            # An evicted index that is still in use is taken back, so there is never more than one copy
+            index = self._evicted.pop(name, None)
+            if index is None:
+                if not self.exists(name):
+                    raise KeyError(f"Unknown knowledge base '{name}'")
+                with tracer.span('load_knowledge_base', knowledge_base=name):
+                    index, self._journals[name] = _load_vector_store(self.path(name))
+                self.loads += 1
+            self._loaded[name] = index
+            self._memory[name] = index_memory_bytes(index)
+            self._evict()
+        return index
+
+    def name_of(self, index):
+        """
+        Name of a knowledge base index (None for session indexes and the base index)
+        """
+        with self._lock:
+            for name, candidate in list(self._loaded.items()) + list(self._evicted.items()):
+                if candidate is index:
+                    return name
+        return None
+
+    def save_index(self, index):
+        """
+        Save an index if it is a named knowledge base (called after every change), returns whether it was saved
+        """
+        name = self.name_of(index)
+        if name is None:
+            return False
+        self._save(name, index)
+        return True
+
+    def _save(self, name, index):
+        """
+        Collect the changes under the store lock, then write them without it so searches and ingests keep running:
+        appended to the change journal, or the whole knowledge base when there is no journal or it has grown too large
+        """
+        path = self.path(name)
+        with self._lock:
+            save_lock = self._save_locks[name]
+        with save_lock:
+            store = index.vector_store
+            with store.lock:
+                first_row, deleted = store.take_unsaved_changes()
+                journal = self._journals.get(name)
+                full = journal is None or (
+                    journal['entries'] >= KNOWLEDGE_BASE_JOURNAL_MAX_ENTRIES
+                    or journal['rows'] + store.count - first_row >= max(KNOWLEDGE_BASE_JOURNAL_MIN_ROWS, KNOWLEDGE_BASE_JOURNAL_FRACTION * journal['base_rows'])
+                )
+                if full:
+                    snapshot = _snapshot_vector_store(index)
+                else:
+                    changes = _snapshot_vector_store_changes(index, first_row, deleted)
+                memory = index_memory_bytes(index)
+            try:
+                with tracer.span('save_knowledge_base', knowledge_base=name, full=full):
+                    if full:
+                        self._journals[name] = _write_vector_store(snapshot, path)
+                    else:
+                        _append_vector_store_changes(path, journal, changes)
+            except BaseException:
+                # The changes taken above are not on disk, the next save rewrites everything
+                self._journals.pop(name, None)
+                raise
+        with self._lock:
+            self._memory[name] = memory
+            self._evict()
+
+    def memory_usage(self):
+        """
+        Approximate RAM held by each loaded knowledge base (as of its last load or save)
+        """
+        with self._lock:
+            return {name: self._memory.get(name, 0) for name in self._loaded}
+
+    def _evict(self):
+        """
+        Drop the least recently used knowledge bases while above the memory limit, always keeping the most recent one
+        """
+        total = sum(self.memory_usage().values())
+        while total > self.memory_limit and len(self._loaded) > 1:
+            name, index = self._loaded.popitem(last=False)
+            self._evicted[name] = index
+            total -= self._memory.pop(name, 0)
+            self.evictions += 1
+
+    def stats(self):
+        """
+        Return loaded knowledge bases with their memory use, the memory limit and load/eviction counters
+        """
+        usage = self.memory_usage()
+        return {
+            'loaded': usage,
+            'memory_bytes': sum(usage.values()),
+            'memory_limit_bytes': self.memory_limit,
+            'loads': self.loads,
+            'evictions': self.evictions
+        }
+
+# Shared knowledge base manager (process-wide, see KnowledgeBaseManager)
+knowledge_bases = KnowledgeBaseManager()
+
+# Retrieval Parameters
+SIMILARITY_TOP_K = 5
+SIMILARITY_CUTOFF = 0.75
+RETRIEVAL_MODE = os.getenv('RETRIEVAL_MODE', 'vector')  # 'vector' or 'hybrid' (vector + BM25, reciprocal-rank fusion, opt-in)
+
+def measure_ann_recall(index, query_embeddings=None, top_k=SIMILARITY_TOP_K, num_queries=100):
+    """
+    Measure recall@k and latency of approximate (IVF) search against exact search on the same vector store
+    Uses a random sample of stored vectors as queries when no query embeddings are given
+    """
+    store = index.vector_store
+    if query_embeddings is None:
+        rows = np.random.default_rng(0).choice(store.count, min(num_queries, store.count), replace=False)
+        query_embeddings = store.vectors[np.sort(rows)]
+
+    # Train the IVF index and build its posting lists before timing, so the latency covers queries only
+    ivf = store.ivf or store.build_ivf()
+    store.search(query_embeddings[:1], top_k, exact=False)
+
+    start = time.perf_counter()
+    exact_hits = store.search(query_embeddings, top_k, exact=True)
+    exact_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    ann_hits = store.search(query_embeddings, top_k, exact=False)
+    ann_seconds = time.perf_counter() - start
+
+    recalls = [
+        len({node_id for node_id, _ in ann} & {node_id for node_id, _ in exact}) / len(exact)
+        for ann, exact in zip(ann_hits, exact_hits) if exact
+    ]
+    return {
+        'recall': float(np.mean(recalls)) if recalls else 1.0,
+        'exact_ms_per_query': 1000 * exact_seconds / len(query_embeddings),
+        'ann_ms_per_query': 1000 * ann_seconds / len(query_embeddings),
+        'nlist': ivf.nlist if ivf is not None else 0,
+        'nprobe': store.nprobe or (ivf.default_nprobe if ivf is not None else 0),
+        'top_k': top_k
+    }
+
+def measure_quantization_recall(index, query_embeddings=None, top_k=SIMILARITY_TOP_K, num_queries=100):
+    """
+    Measure recall@k, latency and vector memory of quantized search against float search on the same vector store
+    Uses a random sample of stored vectors as queries when no query embeddings are given
+    """
+    store = index.vector_store
+    if query_embeddings is None:
+        rows = np.random.default_rng(0).choice(store.count, min(num_queries, store.count), replace=False)
+        query_embeddings = np.asarray(store.vectors[np.sort(rows)])
+
+    start = time.perf_counter()
+    float_hits = store.search(query_embeddings, top_k, exact=True, quantized=False)
+    float_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    quantized_hits = store.search(query_embeddings, top_k, exact=True)
+    quantized_seconds = time.perf_counter() - start
+
+    recalls = [
+        len({node_id for node_id, _ in quantized} & {node_id for node_id, _ in exact}) / len(exact)
+        for quantized, exact in zip(quantized_hits, float_hits) if exact
+    ]
+    return {
+        'recall': float(np.mean(recalls)) if recalls else 1.0,
+        'float_ms_per_query': 1000 * float_seconds / len(query_embeddings),
+        'quantized_ms_per_query': 1000 * quantized_seconds / len(query_embeddings),
+        'top_k': top_k,
+        **store.memory_usage()
+    }
+
+def embed_queries(queries):
+    """
+    Embed a batch of queries in one request (text and query embeddings are identical for text-embedding-ada-002)
+    Like single queries, the batch bypasses the embedding cache, which is kept for chunk texts
+    """
+    model = get_embed_model()
+    if isinstance(model, CachedEmbedding):
+        model = model.embed_model
+    return np.asarray(model.get_text_embedding_batch(queries), dtype=np.float32)
+
+def _chunk_tokens(node):
+    """
+    Token count of a chunk, precomputed at ingest (counted here for chunks ingested before it was stored)
+    """
+    tokens = node.metadata.get('chunk_tokens')
+    return tokens if tokens is not None else count_tokens(node.text)
+
+def expand_chunk(docstore, node, window=CHUNK_EXPANSION_WINDOW, max_tokens=CHUNK_EXPANSION_MAX_TOKENS):
+    """
+    Text of a chunk together with up to window neighboring chunks of the same document on each side
+    Neighbors are added nearest first, alternating sides, while the text stays within max_tokens
+    """
+    texts, tokens = [node.text], _chunk_tokens(node)
+    edges = {NodeRelationship.PREVIOUS: node, NodeRelationship.NEXT: node}
+    for _ in range(window):
+        for relationship in (NodeRelationship.PREVIOUS, NodeRelationship.NEXT):
+            edge = edges[relationship]
+            related = edge.relationships.get(relationship) if edge is not None else None
+            neighbor = docstore.get_node(related.node_id, raise_error=False) if related else None
+            if neighbor is None or tokens + _chunk_tokens(neighbor) > max_tokens:
+                edges[relationship] = None
+                continue
+            edges[relationship] = neighbor
+            tokens += _chunk_tokens(neighbor)
+            if relationship == NodeRelationship.PREVIOUS:
+                texts.insert(0, neighbor.text)
+            else:
+                texts.append(neighbor.text)
+
+    # Chunks split with overlap repeat the end of their predecessor
+    expanded = texts[0]
+    for text in texts[1:]:
+        trimmed = _trim_overlap(expanded, text)
+        expanded += trimmed if len(trimmed) < len(text) else '\n\n' + text
+    return expanded
+
+def _search_vector_stores(indexes, query_embeddings, query_texts=None):
+    """
+    Find top-k relevant nodes for a batch of query embeddings across one or more indexes
+    With query texts and RETRIEVAL_MODE 'hybrid', vector and BM25 results are fused (ranked by fused score)
+    Selected chunks get their text with neighbors ('expanded_text') when CHUNK_EXPANSION_WINDOW is set
+    Returns one list of (node_id, result dict) tuples per query, the result score is the cosine similarity
+    """
+    hybrid = query_texts is not None and RETRIEVAL_MODE == 'hybrid'
+    # Over-fetch candidates when a re-ranker picks the final chunks
+    rerank = query_texts is not None and reranker.enabled
+    top_k = max(RERANK_CANDIDATES, SIMILARITY_TOP_K) if rerank else SIMILARITY_TOP_K
+    outputs = [[] for _ in range(len(query_embeddings))]
+    found = {}
+    for index in indexes:
+        store = index.vector_store
+        # Hold the store lock until the nodes are fetched, a background ingest may be inserting into this index
+        with store.lock:
+            if hybrid:
+                hits_per_query = store.hybrid_search(query_embeddings, query_texts, top_k, SIMILARITY_CUTOFF, LEXICAL_SIMILARITY_CUTOFF)
+            else:
+                hits_per_query = [
+                    [(node_id, score, score) for node_id, score in hits]
+                    for hits in store.search(query_embeddings, top_k, SIMILARITY_CUTOFF)
+                ]
+            nodes_per_query = [index.docstore.get_nodes([node_id for node_id, _, _ in hits]) for hits in hits_per_query]
+        for output, hits, nodes in zip(outputs, hits_per_query, nodes_per_query):
+            for node, (node_id, score, rank_score) in zip(nodes, hits):
+                found[node_id] = (index.docstore, node)
+                output.append((rank_score, node_id, {
+                    'score': score,
+                    'source': get_node_source(node),
+                    'text': node.text
+                }))
+
+    # Merge top-k results across indexes
+    merged = [
+        [(node_id, result) for _, node_id, result in sorted(output, key=lambda hit: hit[0], reverse=True)[:top_k]]
+        for output in outputs
+    ]
+    if rerank:
+        with tracer.span('rerank', candidates=sum(len(hits) for hits in merged)):
+            merged = [reranker.rerank(query_text, hits) for query_text, hits in zip(query_texts, merged)]
+    if CHUNK_EXPANSION_WINDOW > 0:
+        # Expand only the final chunks, after ranking on the chunks themselves
+        for hits in merged:
+            for node_id, result in hits:
+                docstore, node = found[node_id]
+                result['expanded_text'] = expand_chunk(docstore, node)
+    return merged
+
+def search_vector_stores(indexes, query_embeddings, query_texts=None):
+    """
+    Find top-k relevant nodes for a batch of query embeddings across one or more indexes
+    Returns one list of result dicts per query
+    """
+    return [[result for _, result in hits] for hits in _search_vector_stores(indexes, query_embeddings, query_texts)]
+
 def query_vector_store(index, query):
     """
     Perform similarity search in vector store to find and retrieve top-k relevant text chunks
+    Accepts a single index or a list of indexes (e.g. shared base index + session index) and merges their top-k results
     Returns results with source information (URL for web pages, filename for documents)
     """
-    # Configure retriever
-    retriever = VectorIndexRetriever(
-        index=index,
-        similarity_top_k=SIMILARITY_TOP_K,
-    )
+    indexes = index if isinstance(index, (list, tuple)) else [index]
 
-    # Configure query engine
-    query_engine = RetrieverQueryEngine(
-        retriever=retriever,
-        node_postprocessors=[SimilarityPostprocessor(similarity_cutoff=SIMILARITY_CUTOFF)],
-    )
+    # Embed the query once and reuse it for every index
+    with tracer.span('embed_question'):
+        query_embedding = get_embed_model().get_query_embedding(query)
+    with tracer.span('retrieve', indexes=len(indexes), mode=RETRIEVAL_MODE) as span:
+        results = search_vector_stores(indexes, [query_embedding], [query])[0]
+        span.set(chunks=len(results))
+    return results
 
-    # Retrieve relevant documents
-    documents = query_engine.retrieve(query)
+def query_vector_store_batch(index, queries):
+    """
+    Batched variant of query_vector_store: embeds all queries together and scores them with one matrix product per index
+    Returns one list of results per query
+    """
+    if not queries:
+        return []
+    indexes = index if isinstance(index, (list, tuple)) else [index]
+    return search_vector_stores(indexes, embed_queries(queries), queries)
 
-    # Format the output into a dictionary
-    output = []
-    for doc in documents:
-        source = "N/A"
-        
-        # Case 1: Node is a document (PDF/DOCX files)
-        if 'file_name' in doc.node.metadata:
-            source = doc.node.metadata['file_name']
-        # Case 2: Node is a web page HTML
-        else:
-            source_relation = doc.node.relationships.get(NodeRelationship.SOURCE)
-            if source_relation and source_relation.node_id:
-                source = source_relation.node_id
-        
-        output.append({
-            'score': doc.score,
-            'source': source,
-            'text': doc.node.text
-        })
+def retrieve_with_cache_key(index, query):
+    """
+    Retrieve top-k results for a question and compute its answer cache key
+    Returns the results, the answer cache key and the question embedding
+    """
+    indexes = index if isinstance(index, (list, tuple)) else [index]
+    with tracer.span('embed_question'):
+        query_embedding = get_embed_model().get_query_embedding(query)
+    with tracer.span('retrieve', indexes=len(indexes), mode=RETRIEVAL_MODE) as span:
+        hits = _search_vector_stores(indexes, [query_embedding], [query])[0]
+        span.set(chunks=len(hits))
+    cache_key = AnswerCache.make_key(indexes, [node_id for node_id, _ in hits])
+    return [result for _, result in hits], cache_key, query_embedding
+
+async def aretrieve_with_cache_key(index, query):
+    """
+    Async variant of retrieve_with_cache_key: awaits the question embedding and searches in a worker thread
+    """
+    indexes = index if isinstance(index, (list, tuple)) else [index]
+    with tracer.span('embed_question'):
+        query_embedding = await get_embed_model().aget_query_embedding(query)
+    with tracer.span('retrieve', indexes=len(indexes), mode=RETRIEVAL_MODE) as span:
+        hits = (await asyncio.to_thread(_search_vector_stores, indexes, [query_embedding], [query]))[0]
+        span.set(chunks=len(hits))
+    cache_key = AnswerCache.make_key(indexes, [node_id for node_id, _ in hits])
+    return [result for _, result in hits], cache_key, query_embedding
 
-    return output
+# Chat Response Parameters
+llm = None  # Chat model, created by get_llm on first use (may be replaced, e.g. by a mock LLM in the benchmark)
+_llm_lock = threading.Lock()
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', 3000))  # Tokens for retrieved chunks in the system prompt
+HISTORY_TOKEN_BUDGET = int(os.getenv('HISTORY_TOKEN_BUDGET', 2000))  # Tokens for recent chat history
+HISTORY_SUMMARY_TOKEN_BUDGET = int(os.getenv('HISTORY_SUMMARY_TOKEN_BUDGET', 200))  # Tokens for the list of earlier questions replacing older history
 
-def chat_response(user_question, chat_memory, index):
+def count_tokens(text):
     """
-    Generates an LLM Q&A response based on vector embeddings and conversation memory.
+    Count tokens of a text (cl100k tokenizer, an approximation for non-OpenAI models)
+    """
+    return len(get_tokenizer()(text))
+
+def _trim_overlap(previous_text, text, probe_length=64):
+    """
+    Remove the beginning of text that repeats the end of previous_text (overlapping neighbor chunks)
+    """
+    probe = text[:probe_length]
+    position = previous_text.find(probe)
+    # The first matching position gives the longest overlap
+    while position >= 0:
+        if text.startswith(previous_text[position:]):
+            return text[len(previous_text) - position:]
+        position = previous_text.find(probe, position + 1)
+    return text
+
+def pack_context(results, token_budget=CONTEXT_TOKEN_BUDGET):
+    """
+    Pack retrieved results into the context token budget, best results first
+    Drops duplicate chunks, trims text repeated by overlapping chunks from the same source
+    Expanded chunks ('expanded_text') only replace their chunk with the budget left once every chunk is packed
+    Returns the packed results and their token count
+    """
+    packed, packed_results, seen_texts, tokens = [], [], set(), 0
+    for result in results:
+        text = result['text']
+        if text in seen_texts or any(text in other for other in seen_texts):
+            continue
+        for other in packed:
+            if other['source'] == result['source']:
+                text = _trim_overlap(other['text'], text)
+        if not text.strip():
+            continue
+        item = {'score': round(result['score'], 3), 'source': result['source'], 'text': text}
+        item_tokens = count_tokens(json.dumps(item, separators=(',', ':'), ensure_ascii=False))
+        if tokens + item_tokens > token_budget:
+            continue
+        packed.append(item)
+        packed_results.append(result)
+        seen_texts.add(result['text'])
+        tokens += item_tokens
+
+    # Expand the best chunks with their neighbors while the budget allows
+    for item, result in zip(packed, packed_results):
+        expanded = result.get('expanded_text')
+        if not expanded or expanded == result['text']:
+            continue
+        others = [other for other in packed if other is not item and other['source'] == item['source']]
+        # A neighbor already in the context would be repeated
+        if any(other['text'] in expanded for other in others):
+            continue
+        text = expanded
+        for other in others:
+            text = _trim_overlap(other['text'], text)
+        expanded_item = {**item, 'text': text}
+        extra_tokens = count_tokens(json.dumps(expanded_item, separators=(',', ':'), ensure_ascii=False)) - count_tokens(
+            json.dumps(item, separators=(',', ':'), ensure_ascii=False))
+        if tokens + extra_tokens > token_budget:
+            continue
+        item['text'] = text
+        tokens += extra_tokens
+    return packed, tokens
+
+def _earlier_questions_text(questions):
+    return "Earlier in this conversation the user asked: " + "; ".join(f"\"{question}\"" for question in questions)
+
+def compact_chat_history(chat_memory, token_budget=HISTORY_TOKEN_BUDGET, summary_token_budget=HISTORY_SUMMARY_TOKEN_BUDGET):
     """
-    # Find top-k results
-    results = query_vector_store(index, user_question)
+    Keep the most recent messages that fit the token budget (sliding window)
+    Older messages are replaced by one system message listing the user's earlier questions in the order they were asked
+    (a question list, not a summary: earlier answers are left out, and so are the oldest questions beyond its budget)
+    Returns the compacted messages, their token count and the number of older messages left out
+    """
+    window, tokens = [], 0
+    for message in reversed(chat_memory):
+        message_tokens = count_tokens(message.content or "")
+        if tokens + message_tokens > token_budget:
+            break
+        window.insert(0, message)
+        tokens += message_tokens
+
+    older_messages = chat_memory[:len(chat_memory) - len(window)]
+    older_questions = [message.content for message in older_messages if message.role == MessageRole.USER]
+    # Pick the most recent questions that fit, then list them oldest first
+    kept_questions = []
+    for question in reversed(older_questions):
+        candidate = [question] + kept_questions
+        if count_tokens(_earlier_questions_text(candidate)) > summary_token_budget:
+            break
+        kept_questions = candidate
+    if kept_questions:
+        questions_message = ChatMessage(role="system", content=_earlier_questions_text(kept_questions))
+        window.insert(0, questions_message)
+        tokens += count_tokens(questions_message.content)
+    return window, tokens, len(older_messages)
+
+def build_chat_messages(user_question, chat_memory, results, prompt_stats=None):
+    """
+    Build the LLM messages (system prompt with retrieved results, chat history, user question)
+    Retrieved results and chat history are kept within their token budgets
+    If a prompt_stats dict is given, it is filled with the prompt token counts of this turn
+    """
+    packed_results, context_tokens = pack_context(results)
 
     # Case 1: There are relevant results in vector store
-    if results:
-        json_internal_sources = json.dumps(results, indent=4) # Convert Python dict to JSON string
+    if packed_results:
+        json_internal_sources = json.dumps(packed_results, separators=(',', ':'), ensure_ascii=False) # Convert Python dict to compact JSON string
     # Case 2: No relevant results in vector store
     else:
         json_internal_sources = "No relevant information found using internal data sources."
@@ -134,35 +2193,293 @@ def chat_response(user_question, chat_memory, index):
     """
     messages = [ChatMessage(role="system", content=system_prompt)]
 
-    # Extend messages list to include existing chat history
-    messages.extend(chat_memory)
+    # Extend messages list to include recent chat history (older messages are replaced by the earlier questions)
+    history, history_tokens, compacted_messages = compact_chat_history(chat_memory)
+    messages.extend(history)
 
     # Append user question to end of chat history
     messages.append(ChatMessage(role="user", content=user_question))
 
-    # Generate response based on current messages
-    response = llm.chat(messages)
+    if prompt_stats is not None:
+        system_tokens = count_tokens(system_prompt)
+        question_tokens = count_tokens(user_question)
+        prompt_stats.update({
+            'prompt_tokens': system_tokens + history_tokens + question_tokens,
+            'system_tokens': system_tokens,
+            'context_tokens': context_tokens,
+            'history_tokens': history_tokens,
+            'question_tokens': question_tokens,
+            'context_chunks': len(packed_results),
+            'history_messages': len(history),
+            'history_messages_compacted': compacted_messages
+        })
+    return messages
+
+def get_llm():
+    """
+    Get the chat model, creating the DeepSeek client on first use (its import is the slowest part of startup)
+    """
+    global llm
+    with _llm_lock:
+        if llm is None:
+            with startup_timer.measure('llm client'):
+                from llama_index.llms.deepseek import DeepSeek
+                llm = DeepSeek(
+                    model="deepseek-chat",
+                    temperature=0.5,
+                    api_key=DEEPSEEK_API_KEY,
+                    api_base=DEEPSEEK_API_BASE
+                )
+    return llm
+
+def _prepare_turn(user_question, chat_memory, retrieval, prompt_stats=None):
+    """
+    Steps of a chat turn between retrieval and the LLM call: looks up the answer cache, then builds the prompt on a miss
+    retrieval is the (results, cache key, question embedding) of retrieve_with_cache_key
+    Returns the results, the cache key including the history, the question embedding, the cached answer (None on a miss)
+    and the chat messages (None on a hit)
+    """
+    results, cache_key, question_embedding = retrieval
+    cache_key = AnswerCache.with_history(cache_key, chat_memory)
+
+    # Reuse the answer to an equivalent question over the same retrieved nodes
+    with tracer.span('answer_cache') as span:
+        cached_answer = answer_cache.lookup(cache_key, question_embedding)
+        span.set(hit=cached_answer is not None)
+    messages = None
+    if cached_answer is None:
+        with tracer.span('build_prompt') as span:
+            stats = prompt_stats if prompt_stats is not None else ({} if tracer.enabled else None)
+            messages = build_chat_messages(user_question, chat_memory, results, stats)
+            span.set(**(stats or {}))
+    return results, cache_key, question_embedding, cached_answer, messages
+
+def _finish_turn(cache_key, question_embedding, answer, start):
+    """
+    Last step of a chat turn: caches the generated answer with the time it took since start (a perf_counter value)
+    """
+    answer_cache.store(cache_key, question_embedding, answer, time.perf_counter() - start)
+
+def chat_response(user_question, chat_memory, index, prompt_stats=None):
+    """
+    Generates an LLM Q&A response based on vector embeddings and conversation memory.
+    The index can be a single index or a list of indexes (see query_vector_store).
+    If a prompt_stats dict is given, it is filled with the prompt token counts (see build_chat_messages).
+    """
+    with tracer.span('chat_turn', streaming=False):
+        # Find top-k results, then reuse a cached answer or build the prompt
+        results, cache_key, question_embedding, cached_answer, messages = _prepare_turn(
+            user_question, chat_memory, retrieve_with_cache_key(index, user_question), prompt_stats)
+        if cached_answer is not None:
+            return cached_answer, results
+
+        # Generate response based on current messages
+        with tracer.span('llm') as span:
+            start = time.perf_counter()
+            response = get_llm().chat(messages)
+            span.set(response_chars=len(response.message.content or ""))
+        _finish_turn(cache_key, question_embedding, response.message.content, start)
 
     # Return LLM response and top-k results
     return response.message.content, results
 
+async def achat_response(user_question, chat_memory, index, prompt_stats=None):
+    """
+    Async variant of chat_response: the embedding and LLM requests are awaited instead of blocking the caller
+    """
+    with tracer.span('chat_turn', streaming=False):
+        results, cache_key, question_embedding, cached_answer, messages = _prepare_turn(
+            user_question, chat_memory, await aretrieve_with_cache_key(index, user_question), prompt_stats)
+        if cached_answer is not None:
+            return cached_answer, results
+
+        with tracer.span('llm') as span:
+            start = time.perf_counter()
+            response = await get_llm().achat(messages)
+            span.set(response_chars=len(response.message.content or ""))
+        _finish_turn(cache_key, question_embedding, response.message.content, start)
+
+    return response.message.content, results
+
+def stream_chat_response(user_question, chat_memory, index, prompt_stats=None):
+    """
+    Streaming variant of chat_response: retrieves the top-k results up front, then streams the LLM answer
+    Returns a generator of response text deltas and the top-k results
+    """
+    # The turn span stays open until the stream is consumed, it is ended inside the generator
+    turn_span = tracer.start_span('chat_turn', streaming=True)
+
+    # Find top-k results and build the prompt before streaming starts
+    with tracer.use_span(turn_span):
+        results, cache_key, question_embedding, cached_answer, messages = _prepare_turn(
+            user_question, chat_memory, retrieve_with_cache_key(index, user_question), prompt_stats)
+
+    def response_stream():
+        llm_span = None
+        try:
+            # Reuse the answer to an equivalent question over the same retrieved nodes
+            if cached_answer is not None:
+                yield cached_answer
+                return
+            llm_span = tracer.start_span('llm', parent=turn_span)
+            start = time.perf_counter()
+            answer = ""
+            for chunk in get_llm().stream_chat(messages):
+                if chunk.delta:
+                    if not answer:
+                        llm_span.set(time_to_first_token_ms=round(1000 * (time.perf_counter() - start), 3))
+                    answer += chunk.delta
+                    yield chunk.delta
+            llm_span.set(response_chars=len(answer))
+            llm_span.end()
+            _finish_turn(cache_key, question_embedding, answer, start)
+        except BaseException as e:
+            # The LLM failed or the consumer abandoned the stream (GeneratorExit), as Span.__exit__ records it
+            if llm_span is not None:
+                llm_span.set(error=type(e).__name__)
+            raise
+        finally:
+            if llm_span is not None:
+                llm_span.end()
+            turn_span.end()
+
+    return response_stream(), results
+
+
+# Batch Question Answering Parameters
+BATCH_QA_CONCURRENCY = int(os.getenv('BATCH_QA_CONCURRENCY', 8))  # Parallel LLM requests
+BATCH_QA_RETRIEVAL_BATCH = 256  # Questions embedded and scored together
+
+def read_questions(path):
+    """
+    Read questions from a JSONL file: one {"id": ..., "question": ...} object per line (id defaults to the line number)
+    """
+    questions = []
+    with open(path, encoding='utf-8') as f:
+        for line_number, line in enumerate(f, start=1):
+            if line.strip():
+                item = json.loads(line)
+                questions.append({**item, 'id': item.get('id', line_number)})
+    return questions
+
+def _answered_ids(output_path):
+    """
+    Ids of questions already answered without error in an output JSONL file (used to resume a batch run)
+    """
+    answered = set()
+    if os.path.exists(output_path):
+        with open(output_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # Partial line from an interrupted run
+                if not record.get('error'):
+                    answered.add(record['id'])
+    return answered
+
+def _ends_with_newline(path):
+    with open(path, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
+
+async def aanswer_questions(index, questions, output_path, concurrency=BATCH_QA_CONCURRENCY, batch_size=BATCH_QA_RETRIEVAL_BATCH):
+    """
+    Answer many questions without chat history and append one JSON line per answer (sources, timings) to output_path
+    Retrieval embeds and scores questions in batches, LLM calls run with bounded concurrency
+    Questions already answered in output_path are skipped, so an interrupted run can simply be restarted
+    Returns counts of answered, failed and skipped questions
+    """
+    indexes = index if isinstance(index, (list, tuple)) else [index]
+    answered = _answered_ids(output_path)
+    pending = [item for item in questions if item['id'] not in answered]
+    counts = {'answered': 0, 'failed': 0, 'skipped': len(questions) - len(pending)}
+
+    # Retrieved questions wait here for a free LLM worker, bounding memory to a few batches
+    retrieved = asyncio.Queue(maxsize=2 * max(batch_size, concurrency))
+
+    async def retrieve():
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start:start + batch_size]
+            texts = [item['question'] for item in batch]
+            started = time.perf_counter()
+            embeddings = await asyncio.to_thread(embed_queries, texts)
+            hits = await asyncio.to_thread(_search_vector_stores, indexes, embeddings, texts)
+            # Batched retrieval time is shared equally by the questions of the batch
+            retrieval_ms = 1000 * (time.perf_counter() - started) / len(batch)
+            for item, item_hits in zip(batch, hits):
+                await retrieved.put((item, [result for _, result in item_hits], retrieval_ms))
+        for _ in range(concurrency):
+            await retrieved.put(None)
+
+    async def answer(output):
+        while (entry := await retrieved.get()) is not None:
+            item, results, retrieval_ms = entry
+            record = {'id': item['id'], 'question': item['question']}
+            prompt_stats = {}
+            started = time.perf_counter()
+            try:
+                response = await get_llm().achat(build_chat_messages(item['question'], [], results, prompt_stats))
+                record['answer'] = response.message.content
+                counts['answered'] += 1
+            except Exception as e:
+                record['error'] = f"{type(e).__name__}: {e}"
+                counts['failed'] += 1
+            record['sources'] = [{'source': result['source'], 'score': result['score']} for result in results]
+            record['prompt_tokens'] = prompt_stats.get('prompt_tokens')
+            record['timings'] = {'retrieval_ms': retrieval_ms, 'llm_ms': 1000 * (time.perf_counter() - started)}
+            # One flushed line per answer, an interruption loses at most the answers in flight
+            output.write(json.dumps(record, ensure_ascii=False) + '\n')
+            output.flush()
+
+    with open(output_path, 'a', encoding='utf-8') as output:
+        # Terminate a partial last line left by an interrupted run, so the first new record stays readable
+        if output.tell() and not _ends_with_newline(output_path):
+            output.write('\n')
+        await asyncio.gather(retrieve(), *(answer(output) for _ in range(concurrency)))
+    return counts
+
+def answer_questions(index, questions, output_path, concurrency=BATCH_QA_CONCURRENCY, batch_size=BATCH_QA_RETRIEVAL_BATCH):
+    """
+    Synchronous wrapper around aanswer_questions
+    """
+    return asyncio.run(aanswer_questions(index, questions, output_path, concurrency, batch_size))
+
+startup_timer.record('module setup', time.perf_counter() - _libraries_imported)
 
 if __name__ == "__main__":
-    # List of web urls
-    urls = [
-                "https://www.apple.com/newsroom/2024/02/apple-reports-first-quarter-results/",
-                "https://www.apple.com/newsroom/2024/05/apple-reports-second-quarter-results/",
-                "https://www.apple.com/newsroom/2024/08/apple-reports-third-quarter-results/", 
-                "https://www.apple.com/newsroom/2024/10/apple-reports-fourth-quarter-results/"
-            ]
-    
-    # Load urls
-    documents = load_web_data(urls)
-
-    # Create vector store index
-    index = create_vector_store(documents)
-
-    # Start a chat session
+    parser = argparse.ArgumentParser(description="Chat with the knowledge base, or answer a JSONL file of questions in batch mode.")
+    parser.add_argument('--questions', help="JSONL file with one {\"id\", \"question\"} object per line (enables batch mode).")
+    parser.add_argument('--output', default='answers.jsonl', help="JSONL file the batch answers are appended to (resumable).")
+    parser.add_argument('--knowledge-base', default=DEFAULT_KNOWLEDGE_BASE, help="Name of the knowledge base to query.")
+    parser.add_argument('--index-dir', help="Saved index directory to query instead of a knowledge base.")
+    parser.add_argument('--concurrency', type=int, default=BATCH_QA_CONCURRENCY, help="Parallel LLM requests in batch mode.")
+    parser.add_argument('--batch-size', type=int, default=BATCH_QA_RETRIEVAL_BATCH, help="Questions embedded and scored together.")
+    parser.add_argument('--startup-report', action='store_true', help="Print the startup timing report (JSON) once the index is loaded and exit.")
+    parser.add_argument('--build-index', action='store_true', help="Build the default index in DEFAULT_INDEX_DIR if it does not exist yet and exit (deploy step).")
+    args = parser.parse_args()
+
+    if args.build_index:
+        index = get_base_index()
+        print(json.dumps({'index_dir': DEFAULT_INDEX_DIR, 'chunks': index.vector_store.count, 'sources': len(get_source_registry(index).sources())}))
+        raise SystemExit(0)
+
+    # Load the knowledge base (the default one is built from DEFAULT_URLS on first run)
+    index = load_vector_store(args.index_dir) if args.index_dir else knowledge_bases.open(args.knowledge_base)
+
+    if args.startup_report:
+        print(json.dumps(startup_timer.report()))
+        raise SystemExit(0)
+
+    if args.questions:
+        start = time.perf_counter()
+        reranker.warm_up()
+        counts = answer_questions(index, read_questions(args.questions), args.output, args.concurrency, args.batch_size)
+        print(json.dumps({**counts, 'seconds': round(time.perf_counter() - start, 3), 'output': args.output}))
+        raise SystemExit(1 if counts['failed'] else 0)
+
+    # Start a chat session (the re-ranking model loads while the user types)
+    reranker.start_warm_up()
     starting_message = "Hi! I'm your AI assistant, ready to help answer your questions using the resources you've added to the knowledge base. Ask me anything, and I'll provide accurate, relevant answers based on the information available!"
     chat_memory = [ChatMessage(role="assistant", content=starting_message)]
     while True:
@@ -172,11 +2489,14 @@ if __name__ == "__main__":
         if user_question.lower() == 'quit':
             break
         
-        # Generate a response
-        response = chat_response(user_question, chat_memory, index)[0]
-
-        # Print the chatbot's response
-        print(f"Bot: {response}")
+        # Generate a response and print it as it streams in
+        response_stream = stream_chat_response(user_question, chat_memory, index)[0]
+        print("Bot: ", end="", flush=True)
+        response = ""
+        for delta in response_stream:
+            print(delta, end="", flush=True)
+            response += delta
+        print()
 
         # Append to chat memory
         chat_memory.append(ChatMessage(role="user", content=user_question))
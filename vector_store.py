@@ -0,0 +1,887 @@
+from llama_index.core.vector_stores.types import BasePydanticVectorStore, VectorStoreQueryResult
+from llama_index.core.schema import MetadataMode, NodeRelationship
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from dotenv import load_dotenv
+import numpy as np
+import os
+import time
+import hashlib
+import threading
+import uuid
+import tempfile
+import weakref
+import re
+import contextlib
+from array import array
+from collections import Counter, defaultdict
+
+# In-memory vector store of the knowledge bases: float32 matrix search, IVF index, quantized vectors,
+# BM25 lexical index and source registry (saving and loading live in vector_search)
+
+load_dotenv()
+
+# Approximate Nearest-Neighbor Parameters
+VECTOR_SEARCH_MODE = os.getenv('VECTOR_SEARCH_MODE', 'exact')  # 'exact' or 'ivf'
+IVF_MIN_NODES = int(os.getenv('IVF_MIN_NODES', 20000))  # Smaller stores always use exact search
+IVF_NLIST = int(os.getenv('IVF_NLIST', 0))  # Number of clusters, 0 = 4 * sqrt(number of nodes)
+IVF_NPROBE = int(os.getenv('IVF_NPROBE', 0))  # Clusters scanned per query: higher = better recall, slower, 0 = scale with nlist
+IVF_PROBE_FRACTION = float(os.getenv('IVF_PROBE_FRACTION', 0.03))  # Share of clusters scanned when IVF_NPROBE is 0
+IVF_MIN_NPROBE = 16  # Lower bound of the scaled nprobe
+
+# Hybrid Retrieval Parameters
+BM25_K1 = 1.2  # Term frequency saturation
+BM25_B = 0.75  # Document length normalization
+RRF_K = 60  # Reciprocal-rank fusion constant: higher = flatter rank weights
+HYBRID_CANDIDATES = 20  # Candidates taken from each retriever before fusion
+LEXICAL_SIMILARITY_CUTOFF = float(os.getenv('LEXICAL_SIMILARITY_CUTOFF', 0.7))  # Cosine cutoff for BM25 hits (exact term matches)
+
+# Vector Quantization Parameters
+VECTOR_QUANTIZATION = os.getenv('VECTOR_QUANTIZATION', 'none')  # 'none', 'int8' (4x smaller) or 'binary' (32x smaller)
+QUANTIZATION_SPILL_DIR = os.getenv('QUANTIZATION_SPILL_DIR', './cache/vectors')  # Float vectors of quantized stores live here (memory-mapped)
+QUANTIZATION_RERANK_FACTOR = {'int8': 4, 'binary': 32}  # Shortlist size per top-k re-ranked with float vectors
+QUANTIZATION_BLOCK_ROWS = 4096  # Rows decoded per step when scanning quantized vectors
+
+def get_node_source(node):
+    """
+    Get the source of a node (filename for documents, URL for web pages)
+    """
+    # Case 1: Node is a document (PDF/DOCX files)
+    if 'file_name' in node.metadata:
+        return node.metadata['file_name']
+    # Case 2: Node is a web page HTML
+    source_relation = node.relationships.get(NodeRelationship.SOURCE)
+    if source_relation and source_relation.node_id:
+        return source_relation.node_id
+    return "N/A"
+
+class IVFIndex:
+    """
+    Inverted file index for approximate nearest-neighbor search over normalized vectors
+    Vectors are clustered with spherical k-means; a query only scores the vectors of its nprobe closest clusters
+    """
+    TRAIN_SAMPLE_SIZE = 65536
+    TRAIN_ITERATIONS = 10
+
+    def __init__(self, vectors, nlist=IVF_NLIST):
+        self.nlist = min(nlist or int(4 * np.sqrt(len(vectors))), len(vectors))
+        self.trained_size = len(vectors)
+        self.centroids = self._train(vectors)
+        self.assignments = self._assign(vectors)
+        self._postings = None
+
+    @classmethod
+    def from_arrays(cls, centroids, assignments, trained_size):
+        """
+        Restore a trained index (e.g. saved with save_vector_store) without re-clustering the vectors
+        """
+        ivf = cls.__new__(cls)
+        ivf.nlist = len(centroids)
+        ivf.trained_size = trained_size
+        ivf.centroids = centroids
+        ivf.assignments = assignments
+        ivf._postings = None
+        return ivf
+
+    @property
+    def default_nprobe(self):
+        """
+        Clusters scanned per query when nprobe is 0: a fixed share of nlist, so recall holds as nlist grows with the store
+        """
+        return max(IVF_MIN_NPROBE, int(np.ceil(IVF_PROBE_FRACTION * self.nlist)))
+
+    def _train(self, vectors):
+        rng = np.random.default_rng(0)
+        sample = vectors[np.sort(rng.choice(len(vectors), min(len(vectors), self.TRAIN_SAMPLE_SIZE), replace=False))]
+        centroids = sample[rng.choice(len(sample), self.nlist, replace=False)].copy()
+        for _ in range(self.TRAIN_ITERATIONS):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            order = np.argsort(assignments, kind='stable')
+            clusters, starts = np.unique(assignments[order], return_index=True)
+            # Sum members per cluster with one reduceat over the sorted sample
+            centroids[clusters] = np.add.reduceat(sample[order], starts, axis=0)
+            # Reseed empty clusters with random sample vectors
+            empty = np.setdiff1d(np.arange(self.nlist), clusters)
+            centroids[empty] = sample[rng.choice(len(sample), len(empty), replace=False)]
+            centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+        return centroids
+
+    def _assign(self, vectors, chunk_size=65536):
+        return np.concatenate([
+            np.argmax(vectors[start:start + chunk_size] @ self.centroids.T, axis=1).astype(np.int32)
+            for start in range(0, len(vectors), chunk_size)
+        ] or [np.empty(0, dtype=np.int32)])
+
+    def add(self, vectors):
+        """
+        Assign new vectors to their closest existing cluster (no retraining)
+        """
+        self.assignments = np.concatenate([self.assignments, self._assign(vectors)])
+        self._postings = None
+
+    def compact(self, keep):
+        """
+        Drop the assignments of deleted rows (keep is a boolean mask over rows)
+        """
+        self.assignments = self.assignments[keep]
+        self._postings = None
+
+    def candidates(self, query, nprobe):
+        """
+        Return the row numbers of all vectors in the nprobe clusters closest to the query
+        """
+        if self._postings is None:
+            # Posting lists as one row array sorted by cluster plus per-cluster offsets
+            order = np.argsort(self.assignments, kind='stable')
+            offsets = np.searchsorted(self.assignments[order], np.arange(self.nlist + 1))
+            self._postings = (order, offsets)
+        order, offsets = self._postings
+        centroid_scores = self.centroids @ query
+        nprobe = min(nprobe or self.default_nprobe, self.nlist)
+        probes = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe] if nprobe < self.nlist else np.arange(self.nlist)
+        return np.concatenate([order[offsets[probe]:offsets[probe + 1]] for probe in probes])
+
+def content_hash(text):
+    """
+    Hash of a text with whitespace normalized, used to detect duplicate documents and chunks
+    """
+    return hashlib.blake2b(' '.join(text.split()).encode('utf-8'), digest_size=16).hexdigest()
+
+def node_chunk_hash(node):
+    """
+    Dedup key of a chunk: the hash of its text without metadata, so the same header, footer or disclaimer
+    on two pages (whose page labels differ) shares one vector
+    """
+    return content_hash(node.get_content(metadata_mode=MetadataMode.NONE))
+
+class QuantizedVectors:
+    """
+    Quantized copy of normalized vectors, scanned to shortlist candidates that are re-ranked with the float vectors
+    int8 keeps one byte per dimension plus a per-row scale (4x smaller), binary keeps the sign bits (32x smaller)
+    """
+    def __init__(self, kind, dimension):
+        if kind not in QUANTIZATION_RERANK_FACTOR:
+            raise ValueError(f"Unknown vector quantization: {kind}")
+        self.kind = kind
+        self.dimension = dimension
+        width = dimension if kind == 'int8' else (dimension + 7) // 8
+        self.codes = np.empty((0, width), dtype=np.int8 if kind == 'int8' else np.uint8)
+        self.scales = np.empty(0, dtype=np.float32)
+        self.size = 0
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.scales.nbytes
+
+    def _encode(self, vectors):
+        if self.kind == 'int8':
+            # Symmetric per-row scale, so the largest component maps to +-127
+            scales = np.abs(vectors).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            return np.rint(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+        return np.packbits(vectors > 0, axis=1), np.ones(len(vectors), dtype=np.float32)
+
+    def add(self, vectors):
+        required = self.size + len(vectors)
+        if required > len(self.codes):
+            # Grow geometrically, like the float matrix of the vector store
+            capacity = max(required, 2 * len(self.codes), 64)
+            codes = np.empty((capacity, self.codes.shape[1]), dtype=self.codes.dtype)
+            scales = np.empty(capacity, dtype=np.float32)
+            codes[:self.size], scales[:self.size] = self.codes[:self.size], self.scales[:self.size]
+            self.codes, self.scales = codes, scales
+        for start in range(0, len(vectors), QUANTIZATION_BLOCK_ROWS):
+            block = np.asarray(vectors[start:start + QUANTIZATION_BLOCK_ROWS], dtype=np.float32)
+            stop = self.size + start + len(block)
+            self.codes[self.size + start:stop], self.scales[self.size + start:stop] = self._encode(block)
+        self.size = required
+
+    def compact(self, keep):
+        """
+        Drop the codes of deleted rows (keep is a boolean mask over rows)
+        """
+        self.codes = self.codes[:self.size][keep]
+        self.scales = self.scales[:self.size][keep]
+        self.size = len(self.codes)
+
+    def scores(self, queries):
+        """
+        Approximate similarity of normalized queries against every row, decoded block by block
+        """
+        scores = np.empty((len(queries), self.size), dtype=np.float32)
+        query_bits = np.packbits(queries > 0, axis=1) if self.kind == 'binary' else None
+        for start in range(0, self.size, QUANTIZATION_BLOCK_ROWS):
+            stop = min(start + QUANTIZATION_BLOCK_ROWS, self.size)
+            if self.kind == 'int8':
+                scores[:, start:stop] = (queries @ self.codes[start:stop].T.astype(np.float32)) * self.scales[start:stop]
+            else:
+                # Fewer differing sign bits (Hamming distance) = more similar
+                differing = np.bitwise_count(self.codes[start:stop][None, :, :] ^ query_bits[:, None, :])
+                scores[:, start:stop] = -differing.sum(axis=2, dtype=np.int32)
+        return scores
+
+def remove_file(path):
+    """
+    Delete a file if it exists, ignoring errors (e.g. a file still memory-mapped on Windows)
+    """
+    with contextlib.suppress(OSError):
+        os.remove(path)
+
+class BM25Index:
+    """
+    Inverted index for BM25 lexical search, rows aligned with the rows of the vector store matrix
+    Postings are compact per-term arrays of row numbers (uint32) and term frequencies (uint16)
+    """
+    TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[.,'][a-z0-9]+)*")
+
+    def __init__(self, k1=BM25_K1, b=BM25_B):
+        self.k1 = k1
+        self.b = b
+        self._postings = {}  # term -> (rows, frequencies)
+        self._lengths = array('I')
+        self._total_length = 0
+
+    @classmethod
+    def tokenize(cls, text):
+        # Keeps tickers, product names and figures like "94.9" or "q3" as single terms
+        return cls.TOKEN_PATTERN.findall(text.lower())
+
+    def __len__(self):
+        return len(self._lengths)
+
+    @property
+    def terms(self):
+        return len(self._postings)
+
+    @property
+    def nbytes(self):
+        return self._lengths.itemsize * len(self._lengths) + sum(
+            rows.itemsize * len(rows) + frequencies.itemsize * len(frequencies) for rows, frequencies in self._postings.values()
+        )
+
+    def add(self, texts):
+        """
+        Index texts as new rows appended after the existing ones
+        """
+        for row, text in enumerate(texts, start=len(self._lengths)):
+            tokens = self.tokenize(text)
+            for term, frequency in Counter(tokens).items():
+                postings = self._postings.get(term)
+                if postings is None:
+                    postings = self._postings[term] = (array('I'), array('H'))
+                postings[0].append(row)
+                postings[1].append(min(frequency, 65535))
+            self._lengths.append(len(tokens))
+            self._total_length += len(tokens)
+
+    def pad(self, count):
+        """
+        Append rows without text (e.g. vectors loaded without their nodes)
+        """
+        self._lengths.extend(array('I', bytes(4 * count)))
+
+    def compact(self, keep):
+        """
+        Drop deleted rows and renumber the remaining ones (keep is a boolean mask over rows)
+        """
+        new_rows = (np.cumsum(keep) - 1).astype(np.uint32)
+        postings = {}
+        for term, (rows, frequencies) in self._postings.items():
+            rows = np.frombuffer(rows, dtype=np.uint32)
+            mask = keep[rows]
+            if mask.any():
+                postings[term] = (array('I', new_rows[rows[mask]].tobytes()), array('H', np.frombuffer(frequencies, dtype=np.uint16)[mask].tobytes()))
+        lengths = np.frombuffer(self._lengths, dtype=np.uint32)[keep]
+        self._postings = postings
+        self._lengths = array('I', lengths.tobytes())
+        self._total_length = int(lengths.sum())
+
+    def clear(self):
+        self._postings = {}
+        self._lengths = array('I')
+        self._total_length = 0
+
+    def scores(self, query):
+        """
+        BM25 score of every row for a query text (zero for rows sharing no term with the query)
+        """
+        num_rows = len(self._lengths)
+        scores = np.zeros(num_rows, dtype=np.float32)
+        if not num_rows or not self._total_length:
+            return scores
+        lengths = np.frombuffer(self._lengths, dtype=np.uint32)
+        average_length = self._total_length / num_rows
+        for term in set(self.tokenize(query)):
+            postings = self._postings.get(term)
+            if postings is None:
+                continue
+            rows = np.frombuffer(postings[0], dtype=np.uint32)
+            frequencies = np.frombuffer(postings[1], dtype=np.uint16).astype(np.float32)
+            idf = np.log(1.0 + (num_rows - len(rows) + 0.5) / (len(rows) + 0.5))
+            norms = self.k1 * (1.0 - self.b + self.b * lengths[rows] / average_length)
+            # Rows are unique within a posting list, so fancy-indexed addition is safe
+            scores[rows] += idf * frequencies * (self.k1 + 1.0) / (frequencies + norms)
+        return scores
+
+class SourceRegistry:
+    """
+    Registry of the sources (websites and documents) in a vector store, updated on every insert and delete
+    Tracks per source: type, node ids, chunk count, byte size and ingest time
+    Thread-safe: ingest jobs update it while the UI lists sources, readers get copies of the entries
+    (listings leave out the node ids, see get for a full entry)
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._sources = {}
+        self._ref_docs = {}
+
+    def add_nodes(self, nodes, ingested_at=None):
+        ingested_at = ingested_at or time.time()
+        with self._lock:
+            for node in nodes:
+                source = get_node_source(node)
+                entry = self._sources.get(source)
+                if entry is None:
+                    entry = self._sources[source] = {
+                        'source': source,
+                        'type': 'Document' if 'file_name' in node.metadata else 'Website',
+                        'node_ids': set(),
+                        'chunk_count': 0,
+                        'byte_size': 0,
+                        'ingested_at': ingested_at
+                    }
+                byte_size = len(node.text.encode('utf-8'))
+                entry['node_ids'].add(node.node_id)
+                entry['chunk_count'] += 1
+                entry['byte_size'] += byte_size
+                self._ref_docs.setdefault(node.ref_doc_id, []).append((source, node.node_id, byte_size))
+
+    def remove_ref_doc(self, ref_doc_id):
+        with self._lock:
+            for source, node_id, byte_size in self._ref_docs.pop(ref_doc_id, []):
+                entry = self._sources[source]
+                entry['node_ids'].discard(node_id)
+                entry['chunk_count'] -= 1
+                entry['byte_size'] -= byte_size
+                if entry['chunk_count'] == 0:
+                    del self._sources[source]
+
+    def clear(self):
+        with self._lock:
+            self._sources = {}
+            self._ref_docs = {}
+
+    def __contains__(self, source):
+        with self._lock:
+            return source in self._sources
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sources)
+
+    def get(self, source):
+        """
+        Copy of the full registry entry of a source, including its node ids (None if the source is unknown)
+        """
+        with self._lock:
+            entry = self._sources.get(source)
+            return None if entry is None else {**entry, 'node_ids': set(entry['node_ids'])}
+
+    def sources(self, source_type=None):
+        """
+        List summaries of the registry entries in ingest order (every field but the node ids, so listing costs
+        O(sources) rather than O(chunks)), optionally only one type ('Website' or 'Document')
+        """
+        with self._lock:
+            return [
+                {key: value for key, value in entry.items() if key != 'node_ids'} for entry in self._sources.values()
+                if source_type is None or entry['type'] == source_type
+            ]
+
+class MatrixVectorStore(BasePydanticVectorStore):
+    """
+    In-memory vector store keeping all node embeddings in one pre-normalized float32 matrix
+    Similarity search is a single matrix product (cosine similarity), top-k uses argpartition
+    Optionally uses an IVF index for approximate search on large stores (search_mode='ivf')
+    """
+    stores_text: bool = False
+    search_mode: str = Field(default=VECTOR_SEARCH_MODE, description="'exact' or 'ivf'.")
+    nprobe: int = Field(default=IVF_NPROBE, description="IVF clusters scanned per query, 0 = scale with the number of clusters.")
+    quantization: str = Field(default=VECTOR_QUANTIZATION, description="'none', 'int8' or 'binary', fixed at creation.")
+    _ivf: IVFIndex = PrivateAttr(default=None)
+    _ivf_build: threading.Thread = PrivateAttr(default=None)
+    _ivf_epoch: int = PrivateAttr(default=0)
+    _matrix: np.ndarray = PrivateAttr()
+    _size: int = PrivateAttr(default=0)
+    _node_ids: list = PrivateAttr()
+    _ref_doc_ids: list = PrivateAttr()
+    _ref_doc_counts: Counter = PrivateAttr()
+    _registry: SourceRegistry = PrivateAttr()
+    _bm25: BM25Index = PrivateAttr()
+    _chunk_hashes: list = PrivateAttr()
+    _chunk_rows: dict = PrivateAttr(default=None)
+    _document_hashes: dict = PrivateAttr()
+    _quantized: QuantizedVectors = PrivateAttr(default=None)
+    _spill_path: str = PrivateAttr(default=None)
+    _spill_finalizer: weakref.finalize = PrivateAttr(default=None)
+    _uid: str = PrivateAttr()
+    _version: int = PrivateAttr(default=0)
+    _saved_rows: int = PrivateAttr(default=0)
+    _deleted_since_save: list = PrivateAttr()
+    _lock: threading.RLock = PrivateAttr()
+
+    def __init__(self, dimension=0, **kwargs):
+        super().__init__(**kwargs)
+        self._matrix = np.empty((0, dimension), dtype=np.float32)
+        self._node_ids = []
+        self._ref_doc_ids = []
+        self._ref_doc_counts = Counter()
+        self._registry = SourceRegistry()
+        self._bm25 = BM25Index()
+        self._chunk_hashes = []
+        self._document_hashes = {}
+        self._uid = uuid.uuid4().hex
+        self._deleted_since_save = []
+        self._lock = threading.RLock()
+
+    @classmethod
+    def class_name(cls):
+        return "MatrixVectorStore"
+
+    @classmethod
+    def from_arrays(cls, node_ids, ref_doc_ids, vectors, normalized=False, texts=None, quantization=None, chunk_hashes=None,
+                    ivf=None):
+        """
+        Create a vector store directly from an embedding matrix (e.g. a numpy.memmap), without copying it
+        Node texts, when given, are indexed for BM25 lexical search
+        Chunk content hashes, when given, let later inserts reuse these vectors for identical chunks
+        A saved IVF index, when given, is used as is; otherwise an 'ivf' store starts training one in the background
+        """
+        store = cls(dimension=vectors.shape[1], quantization=quantization or VECTOR_QUANTIZATION)
+        store._matrix = vectors if normalized else cls._normalize(np.asarray(vectors, dtype=np.float32))
+        store._size = len(node_ids)
+        store._node_ids = list(node_ids)
+        store._ref_doc_ids = list(ref_doc_ids)
+        store._ref_doc_counts = Counter(store._ref_doc_ids)
+        store._chunk_hashes = list(chunk_hashes) if chunk_hashes is not None else [None] * store._size
+        store._saved_rows = store._size
+        if texts is not None:
+            store._bm25.add(texts)
+        else:
+            store._bm25.pad(store._size)
+        # An empty store (e.g. a new knowledge base) gets its quantizer once the first vectors give the dimension
+        if store.quantization != 'none' and store._size:
+            store._quantized = QuantizedVectors(store.quantization, vectors.shape[1])
+            store._quantized.add(store._matrix[:store._size])
+            # Move in-memory float vectors to disk, a memory-mapped matrix is already there
+            if not isinstance(store._matrix, np.memmap):
+                store._spill_rows(np.empty((0, vectors.shape[1]), dtype=np.float32))
+        if ivf is not None and len(ivf.assignments) == store._size:
+            store._ivf = ivf
+        with store._lock:
+            if store._ivf_stale():
+                store._start_ivf_build()
+        return store
+
+    @property
+    def client(self):
+        return None
+
+    @property
+    def count(self):
+        return self._size
+
+    @property
+    def node_ids(self):
+        return list(self._node_ids)
+
+    @property
+    def ref_doc_ids(self):
+        return list(self._ref_doc_ids)
+
+    @property
+    def version(self):
+        """
+        Identifier of the current store contents, changes on every insert and delete (None while empty)
+        """
+        return (self._uid, self._version) if self._size else None
+
+    @property
+    def registry(self):
+        return self._registry
+
+    @property
+    def ivf(self):
+        """
+        Current IVF index (None until one has been built)
+        """
+        return self._ivf
+
+    @property
+    def document_hashes(self):
+        """
+        Document hash (see document_hash) -> reference document id of every document in the store
+        """
+        return dict(self._document_hashes)
+
+    def add_document_hashes(self, document_hashes):
+        with self._lock:
+            self._document_hashes.update(document_hashes)
+
+    def has_document(self, document_hash):
+        return document_hash in self._document_hashes
+
+    def chunk_embeddings(self, chunk_hashes):
+        """
+        Stored (normalized) vectors of chunks with the given content hashes, for the hashes that are known
+        """
+        with self._lock:
+            if self._chunk_rows is None:
+                # Built lazily after deletes renumber the rows, then kept up to date by add()
+                self._chunk_rows = {}
+                for row, chunk_hash in enumerate(self._chunk_hashes):
+                    if chunk_hash is not None:
+                        self._chunk_rows.setdefault(chunk_hash, row)
+            rows = {chunk_hash: self._chunk_rows[chunk_hash] for chunk_hash in chunk_hashes if chunk_hash in self._chunk_rows}
+            return {chunk_hash: np.array(self._matrix[row]) for chunk_hash, row in rows.items()}
+
+    @property
+    def lock(self):
+        """
+        Re-entrant lock guarding the store, also held by index-level inserts and deletes (see _insert_nodes)
+        """
+        return self._lock
+
+    def take_unsaved_changes(self):
+        """
+        Changes since the previous call (or since loading), for saving only what changed: returns the first row
+        added since then (rows keep their order, so the added rows that remain are the rows from there to count)
+        and the reference document ids deleted since then. The caller holds the lock and saves these changes
+        """
+        first_row, deleted = self._saved_rows, self._deleted_since_save
+        self._saved_rows, self._deleted_since_save = self._size, []
+        return first_row, deleted
+
+    @property
+    def bm25(self):
+        return self._bm25
+
+    @property
+    def vectors(self):
+        """
+        Normalized embedding matrix (one row per node, same order as node_ids)
+        """
+        return self._matrix[:self._size]
+
+    def memory_usage(self):
+        """
+        Vector memory held in RAM (memory-mapped float vectors are paged in from disk on demand)
+        """
+        float_bytes = 0 if isinstance(self._matrix, np.memmap) else self._matrix.nbytes
+        quantized_bytes = self._quantized.nbytes if self._quantized is not None else 0
+        return {
+            'quantization': self.quantization,
+            'chunks': self._size,
+            'float_bytes': float_bytes,
+            'quantized_bytes': quantized_bytes,
+            'bytes_per_chunk': (float_bytes + quantized_bytes) / self._size if self._size else 0.0,
+            'float_bytes_per_chunk': 4 * self._matrix.shape[1]
+        }
+
+    def _spill_rows(self, vectors):
+        """
+        Append float rows to the on-disk spill file and memory-map it (quantized stores keep no float vectors in RAM)
+        """
+        dimension = vectors.shape[1]
+        if self._spill_path is None:
+            os.makedirs(QUANTIZATION_SPILL_DIR, exist_ok=True)
+            descriptor, path = tempfile.mkstemp(suffix='.f32', dir=QUANTIZATION_SPILL_DIR)
+            with os.fdopen(descriptor, 'wb') as f:
+                for start in range(0, self._size, QUANTIZATION_BLOCK_ROWS):
+                    np.ascontiguousarray(self._matrix[start:min(start + QUANTIZATION_BLOCK_ROWS, self._size)]).tofile(f)
+            self._spill_path = path
+            self._spill_finalizer = weakref.finalize(self, remove_file, path)
+        with open(self._spill_path, 'ab') as f:
+            np.ascontiguousarray(vectors, dtype=np.float32).tofile(f)
+        total = self._size + len(vectors)
+        if total:
+            self._matrix = np.memmap(self._spill_path, dtype=np.float32, mode='r', shape=(total, dimension))
+
+    def _compact_spill(self, keep):
+        """
+        Rewrite the kept float rows into a new spill file (keep is a boolean mask over rows)
+        """
+        matrix, size = self._matrix, self._size
+        self._release_spill()
+        self._size = 0
+        self._spill_rows(np.empty((0, matrix.shape[1]), dtype=np.float32))
+        for start in range(0, size, QUANTIZATION_BLOCK_ROWS):
+            stop = min(start + QUANTIZATION_BLOCK_ROWS, size)
+            self._spill_rows(matrix[start:stop][keep[start:stop]])
+            self._size += int(keep[start:stop].sum())
+        if not self._size:
+            self._matrix = np.empty((0, matrix.shape[1]), dtype=np.float32)
+
+    def _release_spill(self):
+        if self._spill_finalizer is not None:
+            self._spill_finalizer()
+        self._spill_path = None
+        self._spill_finalizer = None
+
+    @staticmethod
+    def _normalize(vectors):
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def add(self, nodes, **add_kwargs):
+        if not nodes:
+            return []
+        vectors = self._normalize(np.asarray([node.get_embedding() for node in nodes], dtype=np.float32))
+        with self._lock:
+            if self._size and self._matrix.shape[1] != vectors.shape[1]:
+                raise ValueError(f"Embedding dimension {vectors.shape[1]} does not match vector store dimension {self._matrix.shape[1]}")
+            required = self._size + len(nodes)
+            if self.quantization != 'none':
+                # Float vectors go to disk, searches scan the quantized codes
+                self._spill_rows(vectors)
+                if self._quantized is None or self._quantized.dimension != vectors.shape[1]:
+                    self._quantized = QuantizedVectors(self.quantization, vectors.shape[1])
+                self._quantized.add(vectors)
+            else:
+                # Grow the matrix geometrically so repeated inserts stay amortized O(1) per row
+                if required > self._matrix.shape[0] or self._matrix.shape[1] != vectors.shape[1]:
+                    capacity = max(required, 2 * self._matrix.shape[0], 64)
+                    matrix = np.empty((capacity, vectors.shape[1]), dtype=np.float32)
+                    if self._size:
+                        matrix[:self._size] = self._matrix[:self._size]
+                    self._matrix = matrix
+                self._matrix[self._size:required] = vectors
+            self._size = required
+            if self._ivf is not None:
+                self._ivf.add(vectors)
+            if self._ivf_stale():
+                self._start_ivf_build()
+            self._node_ids.extend(node.node_id for node in nodes)
+            self._ref_doc_ids.extend(node.ref_doc_id for node in nodes)
+            self._ref_doc_counts.update(node.ref_doc_id for node in nodes)
+            self._registry.add_nodes(nodes)
+            self._bm25.add(node.get_content(metadata_mode=MetadataMode.NONE) for node in nodes)
+            for row, node in enumerate(nodes, start=len(self._chunk_hashes)):
+                chunk_hash = node_chunk_hash(node)
+                self._chunk_hashes.append(chunk_hash)
+                if self._chunk_rows is not None:
+                    self._chunk_rows.setdefault(chunk_hash, row)
+            self._version += 1
+        return [node.node_id for node in nodes]
+
+    def delete(self, ref_doc_id, **delete_kwargs):
+        with self._lock:
+            # VectorStoreIndex also calls delete() once per node id, skip those without scanning
+            if ref_doc_id not in self._ref_doc_counts:
+                return
+            del self._ref_doc_counts[ref_doc_id]
+            self._registry.remove_ref_doc(ref_doc_id)
+            self._document_hashes = {key: ref for key, ref in self._document_hashes.items() if ref != ref_doc_id}
+            self._version += 1
+            self._ivf_epoch += 1
+            keep = np.array([ref != ref_doc_id for ref in self._ref_doc_ids], dtype=bool)
+            # Compact into a new buffer (the current one may be a read-only memmap)
+            if self.quantization != 'none':
+                self._compact_spill(keep)
+            else:
+                self._matrix = np.ascontiguousarray(self._matrix[:self._size][keep])
+            if self._quantized is not None:
+                self._quantized.compact(keep)
+            if self._ivf is not None:
+                self._ivf.compact(keep)
+            self._bm25.compact(keep)
+            self._saved_rows = int(keep[:self._saved_rows].sum())
+            self._deleted_since_save.append(ref_doc_id)
+            self._size = int(keep.sum())
+            self._node_ids = [node_id for node_id, kept in zip(self._node_ids, keep) if kept]
+            self._ref_doc_ids = [ref for ref, kept in zip(self._ref_doc_ids, keep) if kept]
+            self._chunk_hashes = [chunk_hash for chunk_hash, kept in zip(self._chunk_hashes, keep) if kept]
+            self._chunk_rows = None
+
+    def clear(self):
+        with self._lock:
+            self._deleted_since_save.extend(self._ref_doc_counts)
+            self._saved_rows = 0
+            self._matrix = np.empty((0, self._matrix.shape[1]), dtype=np.float32)
+            self._size = 0
+            self._node_ids = []
+            self._ref_doc_ids = []
+            self._ref_doc_counts = Counter()
+            self._registry.clear()
+            self._bm25.clear()
+            self._chunk_hashes = []
+            self._chunk_rows = None
+            self._document_hashes = {}
+            self._quantized = None
+            self._release_spill()
+            self._ivf = None
+            self._ivf_epoch += 1
+            self._version += 1
+
+    def _ivf_stale(self):
+        """
+        Whether an 'ivf' store needs a (new) IVF index: none yet, or the store grew well past its training size
+        """
+        if self.search_mode != 'ivf' or self._size < IVF_MIN_NODES:
+            return False
+        return self._ivf is None or self._size > 4 * self._ivf.trained_size
+
+    def _start_ivf_build(self):
+        """
+        Train the IVF index in a background thread, unless a build is already running (caller holds the lock)
+        """
+        if self._ivf_build is None or not self._ivf_build.is_alive():
+            self._ivf_build = threading.Thread(target=self.build_ivf, name='ivf-build', daemon=True)
+            self._ivf_build.start()
+
+    def build_ivf(self):
+        """
+        Train an IVF index on the current vectors and install it, returns it (None if rows were deleted meanwhile)
+        Training runs without the store lock, so searches and inserts continue; rows added meanwhile are assigned at the end
+        """
+        with self._lock:
+            if not self._size:
+                return None
+            # Rows below the current size are never rewritten in place (inserts append, deletes swap in a new matrix)
+            matrix, size, epoch = self._matrix, self._size, self._ivf_epoch
+        ivf = IVFIndex(matrix[:size])
+        with self._lock:
+            if self._ivf_epoch != epoch:
+                return None
+            if self._size > size:
+                ivf.add(self._matrix[size:self._size])
+            self._ivf = ivf
+        return ivf
+
+    @staticmethod
+    def _top_k(scores, top_k):
+        """
+        Select the top-k columns of each row of a score matrix, sorted by descending score
+        """
+        k = min(top_k, scores.shape[1])
+        if k < scores.shape[1]:
+            # argpartition avoids sorting the full score matrix
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        else:
+            top = np.broadcast_to(np.arange(k), (len(scores), k))
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+    def _search_quantized(self, queries, top_k, batch_size=32):
+        """
+        Shortlist candidates with the quantized vectors, then re-rank them with the float vectors
+        """
+        shortlist = min(self._size, top_k * QUANTIZATION_RERANK_FACTOR[self.quantization])
+        top, top_scores = [], []
+        for start in range(0, len(queries), batch_size):
+            batch = queries[start:start + batch_size]
+            candidates, _ = self._top_k(self._quantized.scores(batch), shortlist)
+            for query, rows in zip(batch, candidates):
+                # Sorted rows read the memory-mapped float vectors sequentially
+                rows = np.sort(rows)
+                row_top, row_scores = self._top_k((self._matrix[rows] @ query)[None, :], top_k)
+                top.append(rows[row_top[0]])
+                top_scores.append(row_scores[0])
+        return top, top_scores
+
+    def _search_rows(self, queries, top_k, exact, quantized=True):
+        """
+        Top-k rows and cosine scores for normalized queries (caller holds the lock)
+        """
+        if exact and quantized and self._quantized is not None:
+            return self._search_quantized(queries, top_k)
+        if exact:
+            # Cosine similarity of every query against every node in one matrix product
+            return self._top_k(queries @ self._matrix[:self._size].T, top_k)
+        if self._ivf_stale():
+            self._start_ivf_build()
+        ivf = self._ivf
+        if ivf is None:
+            # The IVF index is still being trained in the background, search exactly meanwhile
+            return self._search_rows(queries, top_k, True, quantized)
+        # Score only the candidates from the closest IVF clusters, one query at a time
+        top, top_scores = [], []
+        for query in queries:
+            rows = ivf.candidates(query, self.nprobe)
+            row_top, row_scores = self._top_k((self._matrix[rows] @ query)[None, :], top_k)
+            top.append(rows[row_top[0]])
+            top_scores.append(row_scores[0])
+        return top, top_scores
+
+    def search(self, query_embeddings, top_k, similarity_cutoff=None, exact=None, quantized=True):
+        """
+        Find the top-k most similar nodes for a batch of query embeddings
+        Uses approximate IVF search when search_mode is 'ivf' and the store is large enough, unless exact=True
+        Scans the quantized vectors of a quantized store (with float re-ranking), unless quantized=False
+        Returns one list of (node_id, score) tuples per query, sorted by descending score
+        """
+        queries = self._normalize(np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32)))
+        if exact is None:
+            exact = self.search_mode != 'ivf' or self._size < IVF_MIN_NODES
+        with self._lock:
+            if self._size == 0 or top_k <= 0:
+                return [[] for _ in range(len(queries))]
+            node_ids = self._node_ids
+            top, top_scores = self._search_rows(queries, top_k, exact, quantized)
+
+        # Apply similarity cutoff as a vectorized mask
+        results = []
+        for row_top, row_scores in zip(top, top_scores):
+            if similarity_cutoff is not None:
+                mask = row_scores >= similarity_cutoff
+                row_top, row_scores = row_top[mask], row_scores[mask]
+            results.append([(node_ids[col], float(score)) for col, score in zip(row_top, row_scores)])
+        return results
+
+    def hybrid_search(self, query_embeddings, query_texts, top_k, similarity_cutoff=None,
+                      lexical_similarity_cutoff=LEXICAL_SIMILARITY_CUTOFF, candidates=HYBRID_CANDIDATES):
+        """
+        Fuse vector search and BM25 lexical search with reciprocal-rank fusion (no extra embedding call)
+        Vector hits must pass similarity_cutoff, BM25 hits the lower lexical_similarity_cutoff
+        Returns one list of (node_id, cosine score, fused score) tuples per query, sorted by descending fused score
+        """
+        queries = self._normalize(np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32)))
+        exact = self.search_mode != 'ivf' or self._size < IVF_MIN_NODES
+        results = []
+        with self._lock:
+            if self._size == 0 or top_k <= 0:
+                return [[] for _ in range(len(queries))]
+            vector_top, _ = self._search_rows(queries, max(top_k, candidates), exact)
+            for query, query_text, vector_rows in zip(queries, query_texts, vector_top):
+                lexical_scores = self._bm25.scores(query_text)
+                lexical_rows, lexical_top_scores = self._top_k(lexical_scores[None, :], max(top_k, candidates))
+                lexical_rows = lexical_rows[0][lexical_top_scores[0] > 0]
+
+                fused = defaultdict(float)
+                for ranked_rows in (vector_rows, lexical_rows):
+                    for rank, row in enumerate(ranked_rows.tolist()):
+                        fused[row] += 1.0 / (RRF_K + rank + 1)
+                rows = np.fromiter(fused, dtype=np.int64, count=len(fused))
+                cosine = self._matrix[rows] @ query
+
+                # Exact term matches are admitted at a lower similarity than pure vector hits
+                hits = []
+                lexical = set(lexical_rows.tolist())
+                for row, score in zip(rows.tolist(), cosine.tolist()):
+                    cutoff = similarity_cutoff
+                    if row in lexical and lexical_similarity_cutoff is not None:
+                        cutoff = lexical_similarity_cutoff if cutoff is None else min(cutoff, lexical_similarity_cutoff)
+                    if cutoff is None or score >= cutoff:
+                        hits.append((self._node_ids[row], score, fused[row]))
+                hits.sort(key=lambda hit: hit[2], reverse=True)
+                results.append(hits[:top_k])
+        return results
+
+    def query(self, query, **kwargs):
+        hits = self.search([query.query_embedding], query.similarity_top_k)[0]
+        return VectorStoreQueryResult(
+            nodes=None,
+            similarities=[score for _, score in hits],
+            ids=[node_id for node_id, _ in hits]
+        )